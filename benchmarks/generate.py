@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+# Synthetic ledger generator for the benchmarks
+#
+# Builds a realistic looking ledger (a few incomes, budgets, bills on their
+# days of the month and any number of expenses spread unevenly over the
+# budgets, dated through the month in order). The same seed always gives the
+# same ledger for a month. Names are stored the way rsbm stores what's typed
+# in, with underscores for spaces.
+#
+#   python benchmarks/generate.py <directory> [--expenses N] [--seed N]
+#                                 [--month YYYY-MM]
+
+import os
+import sys
+import random
+import argparse
+import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INCOME = ['salary', 'side_job', 'rent_allowance', 'child_benefit']
+BUDGETS = ['groceries', 'eating_out', 'transport', 'clothing', 'household', 'health', 'gifts', 'hobbies', 'subscriptions', 'savings', 'pets', 'uncategorized']
+BILLS = ['rent', 'electricity', 'water', 'internet', 'phone', 'insurance', 'health_insurance', 'gym', 'streaming', 'taxes']
+SHOPS = ['albert_heijn', 'jumbo', 'lidl', 'shell', 'ns', 'hema', 'action', 'bol', 'coffee', 'bakery', 'pharmacy', 'pet_shop', 'restaurant', 'cinema', 'book_store']
+
+def generate(expenses=10000, seed=1, month=None):
+    # Expenses are dated, like rsbm dates them, so loading the ledger
+    # doesn't have to fill in dates first. month (YYYY-MM) defaults to this
+    # one.
+    if month is None:
+        month = datetime.date.today().strftime('%Y-%m')
+
+    rng = random.Random(seed)
+
+    data = {
+        'income': [],
+        'budgets': [],
+        'expenses': [],
+        'monthly_bills': [],
+    }
+
+    for name in INCOME:
+        data['income'].append({'name': name, 'price': float(rng.randrange(200, 3000)), 'paid': rng.random() < 0.5})
+
+    for name in BUDGETS:
+        data['budgets'].append({'name': name, 'price': float(rng.randrange(20, 600))})
+
+    for name in BILLS:
+        data['monthly_bills'].append({'name': name, 'price': round(rng.uniform(10, 900), 2), 'day': rng.randrange(1, 29), 'paid': rng.random() < 0.5})
+
+    # Some budgets see far more expenses than others
+    weights = [rng.random()**2 for budget in BUDGETS]
+    total_weight = sum(weights)
+    thresholds = []
+    running = 0.00
+    for weight in weights:
+        running += weight/total_weight
+        thresholds.append(running)
+
+    for number in range(expenses):
+        pick = rng.random()
+        budget = BUDGETS[-1]
+        for position in range(len(thresholds)):
+            if pick < thresholds[position]:
+                budget = BUDGETS[position]
+                break
+
+        name = "%s_%d" % (rng.choice(SHOPS), rng.randrange(100))
+        date = "%s-%02d" % (month, 1+number*28//expenses)
+        data['expenses'].append({'name': name, 'price': round(rng.lognormvariate(2.5, 1.0), 2), 'budget': budget, 'date': date})
+
+    return data
+
+def write(path, data):
+    # Writes the ledger as current_month.yaml, which the SQLite backend also
+    # migrates from the first time it's opened
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import rsbm_storage
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    rsbm_storage.atomic_write(os.path.join(path, 'current_month.yaml'), rsbm_storage._snapshot_contents(data, 0))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Writes a synthetic ledger for the benchmarks.")
+    parser.add_argument('directory', help="where to write current_month.yaml")
+    parser.add_argument('--expenses', type=int, default=10000, help="how many expenses to generate")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--month', help="YYYY-MM the expenses are dated in, this month by default")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+
+    write(args.directory, generate(args.expenses, args.seed, args.month))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Multi-ledger benchmark
+#
+# Generates many small ledgers (see generate.py) and answers 'api bank'
+# requests spread over them the way real traffic is, with a few
+# households far busier than the rest. Runs the requests once opening each
+# ledger from disk, the way one-shot rsbm calls do, and once through a
+# rsbm_storage.LedgerPool, the way the server does, and reports both along
+# with the pool's hit rate.
+#
+#   python benchmarks/ledgers.py [--ledgers 1000] [--expenses 200]
+#                                [--requests 5000] [--pool 100]
+
+import sys
+import time
+import random
+import argparse
+import shutil
+import tempfile
+
+import generate
+
+ROOT = generate.ROOT
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from config import CONFIG
+import rsbm_storage
+import rsbm_main_interpreter
+
+def traffic(ledgers, requests, seed=1):
+    # Ledger ids to ask for, busiest households first
+    rng = random.Random(seed)
+    return ['household_%d' % min(int(rng.paretovariate(1.0))-1, ledgers-1) for request in range(requests)]
+
+def run(ledger_ids, open_storage):
+    start_time = time.time()
+    for ledger_id in ledger_ids:
+        interpreter = rsbm_main_interpreter.MainInterpreter(open_storage(ledger_id))
+        interpreter.interpret(['rsbm', 'api', 'bank'])
+
+    return time.time()-start_time
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Times 'api bank' requests spread over many ledgers, from disk and through a ledger pool.")
+    parser.add_argument('--ledgers', type=int, default=1000, help="how many ledgers to generate")
+    parser.add_argument('--expenses', type=int, default=200, help="expenses in every ledger")
+    parser.add_argument('--requests', type=int, default=5000, help="how many requests to time")
+    parser.add_argument('--pool', type=int, default=100, help="ledgers the pool keeps loaded")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    ledgers = args.ledgers
+    expenses = args.expenses
+    requests = args.requests
+    pool_size = args.pool
+
+    path = tempfile.mkdtemp()+'/'
+    CONFIG['path'] = path
+    CONFIG['ledgers_path'] = path+'ledgers/'
+
+    try:
+        for number in range(ledgers):
+            ledger_id = 'household_%d' % number
+            generate.write(rsbm_storage.ledger_path(ledger_id), generate.generate(expenses, seed=number))
+            # Past the first-open migrations
+            rsbm_storage.open_ledger(ledger_id).save()
+
+        ledger_ids = traffic(ledgers, requests)
+
+        seconds = run(ledger_ids, rsbm_storage.open_ledger)
+        print("%-8s %10.3fms per request" % ("disk", seconds*1000/requests))
+
+        pool = rsbm_storage.LedgerPool(max_ledgers=pool_size)
+        seconds = run(ledger_ids, pool.get)
+        stats = pool.stats()
+        print("%-8s %10.3fms per request (%d%% hits, %d evictions, %.1fMB loaded)" % (
+            "pool", seconds*1000/requests, 100*stats['hit_rate'], stats['evictions'], stats['bytes']/1e6))
+    finally:
+        shutil.rmtree(path)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+# Startup time benchmark for rsbm.py
+#
+# Runs short rsbm invocations against a throwaway ledger and reports the
+# median wall time of each. Pass --max-ms to fail (exit status 1) when any of
+# them gets slower than that, and the help path is also checked to make sure
+# it doesn't import yaml or open the ledger.
+#
+#   python benchmarks/startup.py [--runs N] [--max-ms MS]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+RSBM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rsbm.py')
+
+SCENARIOS = [
+    ['help'],
+    ['unknown_command'],
+    ['bank'],
+    ['status'],
+    ['list', 'budgets'],
+]
+
+def run(args, env):
+    if args == ['help']:
+        args = []
+
+    start_time = time.time()
+    subprocess.check_call([sys.executable, RSBM]+args, env=env, stdout=subprocess.PIPE)
+    return time.time()-start_time
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def lazy_modules(env):
+    # Modules the help path must not pull in
+    code = "import sys; sys.argv = ['rsbm.py']; exec(open(%r).read()); print('imported: ' + ' '.join(sorted(m for m in ('yaml', 'rsbm_storage') if m in sys.modules)))" % RSBM
+    output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=os.path.dirname(RSBM))
+    return output.decode('utf-8').strip().split('\n')[-1][len('imported:'):].split()
+
+def main(argv):
+    runs = 10
+    max_ms = None
+    if '--runs' in argv:
+        runs = int(argv[argv.index('--runs')+1])
+    if '--max-ms' in argv:
+        max_ms = float(argv[argv.index('--max-ms')+1])
+
+    home = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['HOME'] = home
+
+    failed = False
+    try:
+        # Give the commands that read the ledger something to read
+        for command in [['add', 'income', 'job', '2000'], ['check', 'income', 'job'], ['add', 'budget', 'food'],
+                        ['set', 'budget', 'food', '300'], ['add', 'bill', 'rent', '800', '1'], ['add', 'expense', 'bread', '3', 'food']]:
+            run(command, env)
+
+        for args in SCENARIOS:
+            timing = median([run(args, env) for i in range(runs)])*1000
+            status = ""
+            if max_ms is not None and timing > max_ms:
+                status = "  SLOWER THAN %.1fms" % max_ms
+                failed = True
+
+            print("%-20s %8.1fms%s" % (' '.join(args), timing, status))
+
+        imported = lazy_modules(env)
+        if imported:
+            print("help path imported: %s" % ', '.join(imported))
+            failed = True
+    finally:
+        shutil.rmtree(home)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
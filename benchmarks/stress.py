@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+# Concurrency stress test for rsbm storage
+#
+# Starts many writer processes adding expenses and reader processes listing
+# them, all against one throwaway ledger at the same time. Readers fail if
+# they ever see a ledger they can't parse or one that shrank, and at the end
+# every expense every writer added has to be in the ledger exactly once.
+# Exit status is 1 when anything went wrong.
+#
+#   python benchmarks/stress.py [--writers N] [--readers N] [--ops N]
+#                               [--backend yaml|sqlite|sections]
+#                               [--mode snapshot|journal]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def configure(path, backend, mode):
+    sys.path.insert(0, ROOT)
+
+    from config import CONFIG
+    CONFIG['path'] = path
+    CONFIG['storage_backend'] = backend
+    CONFIG['storage_mode'] = mode
+    # Give up rather than hang if something livelocks
+    CONFIG['stale_retries'] = 1000
+
+# -------------
+
+def writer(worker_id, ops):
+    import rsbm_main_interpreter
+
+    for op in range(ops):
+        interpreter = rsbm_main_interpreter.MainInterpreter()
+        output = interpreter.interpret(['rsbm', 'api', 'add', 'expense', 'w%d_%d' % (worker_id, op), '1', 'stress'])
+        if 'false' in output:
+            print("writer %d: add %d failed: %s" % (worker_id, op, output.strip()))
+            return 1
+
+    return 0
+
+def reader(worker_id, ops):
+    import rsbm_main_interpreter
+
+    seen = 0
+    for op in range(ops):
+        interpreter = rsbm_main_interpreter.MainInterpreter()
+        output = ''.join(interpreter.interpret(['rsbm', 'api', '--format', 'json', 'list', 'expenses']))
+
+        try:
+            count = len(json.loads(output))
+        except ValueError:
+            print("reader %d: unreadable ledger: %r" % (worker_id, output[:200]))
+            return 1
+
+        if count < seen:
+            print("reader %d: ledger went from %d to %d expenses" % (worker_id, seen, count))
+            return 1
+        seen = count
+
+    return 0
+
+def verify(writers, ops):
+    import rsbm_storage
+
+    names = [expense['name'] for expense in rsbm_storage.StorageManager().data['expenses']]
+    expected = set(['w%d_%d' % (worker_id, op) for worker_id in range(writers) for op in range(ops)])
+
+    problems = []
+    if len(names) != len(set(names)):
+        problems.append("%d duplicate expenses" % (len(names)-len(set(names))))
+    if expected-set(names):
+        problems.append("%d lost expenses" % len(expected-set(names)))
+
+    return problems
+
+# -------------
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Runs concurrent writers and readers against one ledger and checks nothing was lost.")
+    parser.add_argument('--writers', type=int, default=8, help="writer processes")
+    parser.add_argument('--readers', type=int, default=4, help="reader processes")
+    parser.add_argument('--ops', type=int, default=20, help="commands each process runs")
+    parser.add_argument('--backend', choices=['yaml', 'sqlite', 'sections'], default='yaml')
+    parser.add_argument('--mode', choices=['snapshot', 'journal'], default='snapshot')
+
+    # How main() starts the worker processes
+    parser.add_argument('--worker', choices=['writer', 'reader'], help=argparse.SUPPRESS)
+    parser.add_argument('--id', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    backend = args.backend
+    mode = args.mode
+
+    if args.worker is not None:
+        configure(args.path, backend, mode)
+
+        worker = {'writer': writer, 'reader': reader}[args.worker]
+        return worker(args.id, args.ops)
+
+    writers = args.writers
+    readers = args.readers
+    ops = args.ops
+
+    path = tempfile.mkdtemp()+'/'
+    configure(path, backend, mode)
+
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--path', path, '--backend', backend, '--mode', mode, '--ops', str(ops)]
+
+        start_time = time.time()
+        processes = []
+        for worker_id in range(writers):
+            processes.append(subprocess.Popen(command+['--worker', 'writer', '--id', str(worker_id)]))
+        for worker_id in range(readers):
+            processes.append(subprocess.Popen(command+['--worker', 'reader', '--id', str(worker_id)]))
+
+        failed = [process for process in processes if process.wait() != 0]
+        seconds = time.time()-start_time
+
+        problems = verify(writers, ops)
+        if failed:
+            problems.append("%d of %d processes failed" % (len(failed), len(processes)))
+
+        print("%s/%s: %d writers, %d readers, %d ops each in %.2fs (%.0f writes/s)" % (
+            backend, mode, writers, readers, ops, seconds, writers*ops/seconds))
+        for problem in problems:
+            print("  %s" % problem)
+    finally:
+        shutil.rmtree(path)
+
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
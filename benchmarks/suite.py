@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+# Large ledger benchmark suite
+#
+# Generates ledgers of each size (see generate.py) and times loading,
+# saving and every interpreter command against them, in process. Each
+# scenario runs on a fresh copy of the ledger, and its peak memory is
+# measured in one extra run under tracemalloc (Python 3 only).
+#
+# Results are written as JSON. Given a baseline written by an earlier run,
+# anything more than --tolerance slower (or bigger) than it is reported and
+# the exit status is 1.
+#
+#   python benchmarks/suite.py [--sizes 10000,100000] [--repeat N]
+#                              [--backend yaml|sqlite|sections]
+#                              [--mode snapshot|journal]
+#                              [--output results.json] [--baseline baseline.json]
+#                              [--tolerance 0.25]
+
+import os
+import sys
+import glob
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import generate
+
+ROOT = generate.ROOT
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from config import CONFIG
+import rsbm_storage
+import rsbm_main_interpreter
+
+# Differences below this are timer noise, not regressions
+MIN_SECONDS = 0.002
+
+def commands(data):
+    # (name, rsbm arguments, runs it once only), aimed at items that exist in
+    # the generated ledger
+    expense = data['expenses'][0]['name']
+
+    return [
+        ('add', ['add', 'expense', 'bench_item', '12.5', 'groceries'], False),
+        ('set', ['set', 'expense', expense, '3.2', 'eating_out'], False),
+        ('del', ['del', 'expense', expense], False),
+        ('check', ['check', 'bill', 'rent'], False),
+        ('list_budgets', ['list', 'budgets'], False),
+        ('list_income', ['list', 'income'], False),
+        ('list_bills', ['list', 'bills'], False),
+        ('list_expenses', ['list', 'expenses'], False),
+        ('status', ['status'], False),
+        ('bank', ['bank'], False),
+        ('next_month', ['next_month'], True),
+    ]
+
+def run_command(interpreter, args):
+    # Streamed output only gets rendered as it's read
+    output = interpreter.interpret(['rsbm']+list(args))
+    if isinstance(output, types.GeneratorType):
+        for chunk in output:
+            pass
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+class Workspace(object):
+    # Fresh copies of a generated ledger, one per scenario
+    def __init__(self, base_path):
+        self._base_path = base_path
+        self.path = None
+
+    def fresh(self, keep_cache=True):
+        self.clean()
+
+        self.path = tempfile.mkdtemp()+'/'
+        shutil.rmtree(self.path)
+        shutil.copytree(self._base_path, self.path)
+        if not keep_cache:
+            for cache_path in glob.glob(self.path+'current_month.cache')+glob.glob(self.path+'sections/*.cache'):
+                os.remove(cache_path)
+
+        CONFIG['path'] = self.path
+        return self.path
+
+    def clean(self):
+        if self.path is not None:
+            shutil.rmtree(self.path)
+            self.path = None
+
+def measure(setup, run, repeat):
+    # Returns {'seconds': median, 'peak_bytes': ...} for run(setup())
+    timings = []
+    for attempt in range(repeat):
+        state = setup()
+        start_time = time.time()
+        run(state)
+        timings.append(time.time()-start_time)
+
+    result = {'seconds': median(timings), 'peak_bytes': None}
+
+    if tracemalloc is not None:
+        state = setup()
+        tracemalloc.start()
+        try:
+            run(state)
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+def bench_size(base_path, data, repeat):
+    workspace = Workspace(base_path)
+    results = {}
+
+    try:
+        # Loading, without and with the parsed ledger cache
+        results['load'] = measure(lambda: workspace.fresh(keep_cache=False), lambda state: rsbm_storage.StorageManager(), repeat)
+        workspace.fresh()
+        rsbm_storage.StorageManager()
+        results['load_cached'] = measure(lambda: None, lambda state: rsbm_storage.StorageManager(), repeat)
+
+        def save_setup():
+            workspace.fresh()
+            storage = rsbm_storage.StorageManager()
+            storage.add_item('expenses', {'name': 'bench_item', 'price': 1.0, 'budget': 'groceries'})
+            return storage
+        results['save'] = measure(save_setup, lambda storage: storage.save(), repeat)
+
+        for name, args, once in commands(data):
+            def command_setup():
+                workspace.fresh()
+                interpreter = rsbm_main_interpreter.MainInterpreter(rsbm_storage.StorageManager())
+                # Reports are built lazily, time them as part of the command
+                return interpreter
+
+            if once:
+                command_repeat = 1
+            else:
+                command_repeat = repeat
+
+            results[name] = measure(command_setup, lambda interpreter: run_command(interpreter, args), command_repeat)
+    finally:
+        workspace.clean()
+
+    return results
+
+# -------------
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size in sorted(results.keys(), key=int):
+        if size not in baseline:
+            continue
+
+        for scenario in sorted(results[size].keys()):
+            old = baseline[size].get(scenario)
+            new = results[size][scenario]
+            if old is None:
+                continue
+
+            if new['seconds'] > old['seconds']*(1+tolerance) and new['seconds']-old['seconds'] > MIN_SECONDS:
+                regressions.append("%s expenses, %s: %.1fms, was %.1fms" % (size, scenario, new['seconds']*1000, old['seconds']*1000))
+
+            if new['peak_bytes'] and old['peak_bytes'] and new['peak_bytes'] > old['peak_bytes']*(1+tolerance):
+                regressions.append("%s expenses, %s: peak %.1fMB, was %.1fMB" % (size, scenario, new['peak_bytes']/1e6, old['peak_bytes']/1e6))
+
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Times loading, saving and every command on generated ledgers of each size.")
+    parser.add_argument('--sizes', default='10000,100000', help="expense counts to generate ledgers of, comma separated")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario, the median counts")
+    parser.add_argument('--backend', choices=['yaml', 'sqlite', 'sections'], default=CONFIG['storage_backend'])
+    parser.add_argument('--mode', choices=['snapshot', 'journal'], default=CONFIG['storage_mode'])
+    parser.add_argument('--output', help="file to write the results to, as JSON")
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="how much slower (or bigger) than the baseline is a regression")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    repeat = args.repeat
+    output_path = args.output
+    baseline_path = args.baseline
+    tolerance = args.tolerance
+
+    CONFIG['storage_backend'] = args.backend
+    CONFIG['storage_mode'] = args.mode
+
+    report = {
+        'python': platform.python_version(),
+        'backend': CONFIG['storage_backend'],
+        'mode': CONFIG['storage_mode'],
+        'repeat': repeat,
+        'results': {},
+    }
+
+    for size in sizes:
+        base_path = tempfile.mkdtemp()+'/'
+        try:
+            data = generate.generate(size)
+            generate.write(base_path, data)
+            # Lets the SQLite and sectioned backends migrate once, up front
+            rsbm_storage.open_backend(base_path).load()
+
+            results = bench_size(base_path, data, repeat)
+        finally:
+            shutil.rmtree(base_path)
+
+        report['results'][str(size)] = results
+        for scenario in sorted(results.keys()):
+            peak = ""
+            if results[scenario]['peak_bytes'] is not None:
+                peak = "%8.1fMB" % (results[scenario]['peak_bytes']/1e6)
+            print("%-8d %-16s %10.1fms%s" % (size, scenario, results[scenario]['seconds']*1000, peak))
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True)+'\n')
+
+    if baseline_path is not None:
+        with open(baseline_path, 'r') as f:
+            baseline = json.loads(f.read())
+
+        if (baseline['backend'], baseline['mode']) != (report['backend'], report['mode']):
+            print("Baseline was measured with %s/%s storage, not %s/%s" % (baseline['backend'], baseline['mode'], report['backend'], report['mode']))
+            return 1
+
+        regressions = compare(report['results'], baseline['results'], tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -3,4 +3,76 @@ import os
 CONFIG = {
     'path': os.path.expanduser('~/.rsbm/'),
     'help_msg': 'Placeholder help message',
+
+    # 'yaml' keeps the ledger in current_month.yaml, 'sqlite' in rsbm.sqlite3
+    # (migrated from the YAML files the first time it's opened), 'sections'
+    # in a file per list under sections/ that's only read once it's used
+    # (split up from current_month.yaml the first time, ignores storage_mode)
+    'storage_backend': 'yaml',
+
+    # 'snapshot' rewrites current_month.yaml on every change, 'journal'
+    # appends changes to current_month.journal and only rewrites the
+    # snapshot once the journal grows past these limits
+    'storage_mode': 'snapshot',
+    'journal_max_entries': 1000,
+    'journal_max_bytes': 1024*1024,
+
+    # Keep a parsed copy of current_month.yaml in current_month.cache
+    'load_cache': True,
+
+    # Keep what 'status', 'bank' and 'list' print in reports/, and print it
+    # again while the ledger hasn't been saved since. The least recently
+    # used reports go past these limits.
+    'report_cache': True,
+    'report_cache_max_entries': 64,
+    'report_cache_max_bytes': 16*1024*1024,
+
+    # How many times a command is run again when another rsbm process saved
+    # the ledger between our load and our save
+    'stale_retries': 10,
+
+    # Ledgers picked with --ledger <id> each get a directory in here
+    'ledgers_path': os.path.expanduser('~/.rsbm/ledgers/'),
+    # How many ledgers the server keeps loaded, and roughly how much memory
+    # they may take up, before the least recently used are saved and dropped
+    'ledger_pool_max_ledgers': 1000,
+    'ledger_pool_max_bytes': 512*1024*1024,
+
+    # Where 'rsbm serve' listens. 'rsbm api ...' goes through the server
+    # whenever one is running there.
+    'server_socket': os.path.expanduser('~/.rsbm/rsbm.sock'),
+    # How long the server waits to gather writes into one save
+    'group_commit_ms': 5,
+
+    # 'rsbm forecast' looks this many months ahead, counting income without
+    # a day of its own as coming in on payday
+    'forecast_months': 3,
+    'payday': 1,
+
+    # How next_month compresses its month backups, 'zlib' or 'lzma'
+    # (Python 3 only, smaller but slower)
+    'backup_compression': 'zlib',
+
+    # 'rsbm shell' saves held writes after this many seconds without input
+    # (0 only saves on 'save' and on exit)
+    'shell_autosave_seconds': 30,
+
+    # How 'rsbm import' reads bank statement CSVs. Use 'debit'/'credit'
+    # columns instead of 'amount' for statements that split them.
+    # budget_rules are [regex, budget] pairs matched against the description,
+    # first match wins. 'rsbm import <csv> --rules <file>' overrides these
+    # from a YAML file.
+    'import': {
+        'columns': {
+            'date': 'Date',
+            'description': 'Description',
+            'amount': 'Amount',
+        },
+        'delimiter': ',',
+        'decimal_comma': False,
+        # How the date column is written, for dating imported expenses
+        'date_format': '%Y-%m-%d',
+        'budget_rules': [],
+        'default_budget': 'uncategorized',
+    },
 }
@@ -4,21 +4,89 @@
 
 import os
 import sys
+import errno
+import types
 
-# Import all the stuff specific to RSBM
-from config import *
-import rsbm_storage
-import rsbm_main_interpreter
+# Instrumentation comes first so it can time everything after it, see
+# rsbm_profile for the flags
+import rsbm_profile
+sys.argv = rsbm_profile.configure(sys.argv)
 
-# Save file system
-app_storage = rsbm_storage.StorageManager()
+# Import all the stuff specific to RSBM. The interpreter opens the save file
+# (and imports yaml) only once a command actually needs it.
+with rsbm_profile.phase('import'):
+    from config import *
+    import rsbm_main_interpreter
 
 app_functions = {
 }
 
+# --ledger <id> works on one of many separate ledgers instead of the usual
+# one, see rsbm_storage.ledger_path
+ledger_id = None
+storage_factory = None
+if '--ledger' in sys.argv:
+    position = sys.argv.index('--ledger')
+    ledger_id = ''.join(sys.argv[position+1:position+2])
+    del sys.argv[position:position+2]
+
+    def storage_factory(read_only=False):
+        import rsbm_storage
+        return rsbm_storage.open_ledger(ledger_id, read_only)
+
+profiler = None
+if rsbm_profile.CPROFILE_PATH:
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+# API calls go to the rsbm server when one is running, which already has
+# the ledger loaded
+cmd_output = None
+handled = False
+if len(sys.argv) > 2 and sys.argv[1] == 'api':
+    import rsbm_client
+    try:
+        with rsbm_profile.phase('dispatch'):
+            cmd_output = rsbm_client.request(sys.argv, ledger_id=ledger_id)
+        handled = True
+    except rsbm_client.ServerUnavailable:
+        pass
+
 # Heart of the program
-app_interpreter = rsbm_main_interpreter.MainInterpreter(app_storage)
-cmd_output = app_interpreter.interpret(sys.argv)
+if not handled:
+    # Reports on a ledger that hasn't changed since come out of the report
+    # cache, see rsbm_report_cache
+    report_cache = None
+    if CONFIG['report_cache']:
+        import rsbm_report_cache
+        report_cache = rsbm_report_cache.ReportCache(ledger_id)
+
+    app_interpreter = rsbm_main_interpreter.MainInterpreter(storage_factory=storage_factory, report_cache=report_cache)
+    cmd_output = app_interpreter.interpret(sys.argv)
+
+# Streamed output (lists, json/ndjson api lists) is written out as it's
+# produced
+try:
+    with rsbm_profile.phase('render'):
+        if isinstance(cmd_output, types.GeneratorType):
+            for chunk in cmd_output:
+                sys.stdout.write(chunk)
+        elif cmd_output not in [True, None]:
+            print(cmd_output)
+
+        sys.stdout.flush()
+except IOError as e:
+    # Whatever we were piped into stopped reading (| head)
+    if e.errno != errno.EPIPE:
+        raise
+
+    # Nowhere left to flush the rest of stdout to on exit
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+if profiler is not None:
+    profiler.disable()
+    profiler.dump_stats(rsbm_profile.CPROFILE_PATH)
 
-if cmd_output not in [True, None]:
-    print cmd_output
+rsbm_profile.report()
@@ -0,0 +1,238 @@
+# Month backups made by next_month, deduplicated and compressed.
+#
+# Income, budgets and bills hardly change from one month to the next, so
+# instead of a full copy of the ledger per month every item is stored once,
+# under the hash of its contents:
+#
+#   backups/objects/ab/cdef...    one item each (income, budget or bill)
+#   backups/months/2026-09        the month's manifest: the hashes of its
+#                                 items per list, in order, and its expenses
+#
+# Every file is compressed, with a one-byte tag up front saying how ('z' for
+# zlib, 'x' for lzma), so archives written with different settings mix fine.
+# A month is only in the archive once its manifest is written, which happens
+# after all of its items are.
+
+import os
+import re
+import glob
+import json
+import zlib
+import hashlib
+import datetime
+
+try:
+    import lzma
+except ImportError:
+    # Python 2 has no lzma, zlib it is
+    lzma = None
+
+import yaml
+
+import rsbm_storage
+from config import *
+
+# Lists whose items are mostly new every month are kept in the manifest
+# itself rather than stored item by item
+INLINE_LISTS = ['expenses']
+
+MANIFEST_FORMAT = 1
+
+def _backups_path(path):
+    return path+'backups/'
+
+def _compress(contents):
+    if CONFIG['backup_compression'] == 'lzma' and lzma is not None:
+        return b'x'+lzma.compress(contents)
+
+    return b'z'+zlib.compress(contents, 9)
+
+def _decompress(contents):
+    tag, contents = contents[:1], contents[1:]
+    if tag == b'x':
+        if lzma is None:
+            raise Exception("This backup is lzma compressed, which needs Python 3.")
+        return lzma.decompress(contents)
+    elif tag == b'z':
+        return zlib.decompress(contents)
+
+    raise Exception("Unknown backup compression %r" % tag)
+
+def _encode(value):
+    # Same value, same bytes: that's what makes the hashes match up
+    return rsbm_storage.to_bytes(json.dumps(value, sort_keys=True, separators=(',', ':')))
+
+def _decode(contents):
+    return _plain(json.loads(contents.decode('utf-8')))
+
+def _plain(value):
+    # Python 2's json hands back unicode where PyYAML gives str
+    if isinstance(value, dict):
+        return dict([(_plain(key), _plain(item)) for key, item in value.items()])
+    elif isinstance(value, list):
+        return [_plain(item) for item in value]
+    elif isinstance(value, type(u'')) and not isinstance(value, str):
+        # Only plain ASCII, like PyYAML does it
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+
+    return value
+
+def _object_path(path, digest):
+    return _backups_path(path)+'objects/'+digest[:2]+'/'+digest[2:]
+
+def _month_path(path, month):
+    return _backups_path(path)+'months/'+month
+
+def _read(file_path):
+    with open(file_path, 'rb') as f:
+        return _decode(_decompress(f.read()))
+
+def _store_item(path, item):
+    # Returns (hash, bytes written), nothing gets written for an item that's
+    # already stored
+    contents = _encode(item)
+    digest = hashlib.sha1(contents).hexdigest()
+
+    object_path = _object_path(path, digest)
+    if os.path.exists(object_path):
+        return digest, 0
+
+    if not os.path.exists(os.path.dirname(object_path)):
+        os.makedirs(os.path.dirname(object_path))
+
+    compressed = _compress(contents)
+    rsbm_storage.atomic_write(object_path, compressed, 'wb')
+
+    return digest, len(compressed)
+
+# -------------
+
+def has_month(path, month):
+    return os.path.exists(_month_path(path, month))
+
+def remove_month(path, month):
+    # Forgets month's backup. The items it kept stay stored, other months
+    # can share them.
+    try:
+        os.remove(_month_path(path, month))
+    except OSError:
+        pass
+
+def months(path):
+    # Every backed up month, oldest first
+    months_path = _backups_path(path)+'months/'
+    if not os.path.exists(months_path):
+        return []
+
+    return sorted([month for month in os.listdir(months_path) if re.match(r'^\d{4}-\d{2}$', month)])
+
+def backup_month(path, month, data):
+    # Backs up the ledger as month (YYYY-MM). Returns how it went, or None
+    # if that month was backed up already.
+    if has_month(path, month):
+        return None
+
+    stats = {'items': 0, 'new_items': 0, 'bytes': 0}
+
+    manifest = {'format': MANIFEST_FORMAT, 'month': month, 'lists': {}, 'inline': {}}
+    for list_name, items in rsbm_storage.plain_ledger(data).items():
+        if list_name in INLINE_LISTS:
+            manifest['inline'][list_name] = items
+            continue
+
+        digests = []
+        for item in items:
+            digest, size = _store_item(path, item)
+            digests.append(digest)
+
+            stats['items'] += 1
+            if size:
+                stats['new_items'] += 1
+                stats['bytes'] += size
+
+        manifest['lists'][list_name] = digests
+
+    month_path = _month_path(path, month)
+    if not os.path.exists(os.path.dirname(month_path)):
+        os.makedirs(os.path.dirname(month_path))
+
+    compressed = _compress(_encode(manifest))
+    rsbm_storage.atomic_write(month_path, compressed, 'wb')
+    stats['bytes'] += len(compressed)
+
+    return stats
+
+def restore_month(path, month):
+    # The ledger as it was backed up for month, or None if it never was
+    if not has_month(path, month):
+        return None
+
+    manifest = _read(_month_path(path, month))
+    if manifest['format'] > MANIFEST_FORMAT:
+        raise Exception("Backup of %s was made by a newer rsbm." % month)
+
+    data = {}
+    for list_name, digests in manifest['lists'].items():
+        data[list_name] = [_read(_object_path(path, digest)) for digest in digests]
+    for list_name, items in manifest['inline'].items():
+        data[list_name] = items
+
+    return data
+
+def write_ledger(file_path, data):
+    # Writes data as a ledger file that can be used as current_month.yaml
+    rsbm_storage.atomic_write(file_path, rsbm_storage._snapshot_contents(data, 0))
+
+# -------------
+
+def yaml_backups(path):
+    # [(YYYY-MM, file)] for the rsbm_<month>_<year>.yaml full copies older
+    # versions of next_month made, oldest first
+    backups = []
+    for backup_path in glob.glob(path+'rsbm_*_*.yaml'):
+        match = re.match(r'rsbm_([a-z]+_\d{4})\.yaml$', os.path.basename(backup_path))
+        if match is None:
+            continue
+
+        try:
+            date = datetime.datetime.strptime(match.group(1), '%B_%Y')
+        except ValueError:
+            continue
+
+        backups.append((date.strftime('%Y-%m'), backup_path))
+
+    backups.sort()
+    return backups
+
+def convert(path, remove=False):
+    # Moves the old full YAML backups into the archive. With remove, each
+    # YAML file is deleted once its month restores to the same ledger.
+    stats = {'converted': 0, 'skipped': 0, 'removed': 0, 'yaml_bytes': 0}
+
+    for month, backup_path in yaml_backups(path):
+        with open(backup_path, 'rb') as f:
+            data = yaml.load(f.read(), Loader=rsbm_storage.Loader)
+
+        if backup_month(path, month, data) is None:
+            stats['skipped'] += 1
+        else:
+            stats['converted'] += 1
+
+        if remove and restore_month(path, month) == rsbm_storage.plain_ledger(data):
+            stats['yaml_bytes'] += os.path.getsize(backup_path)
+            os.remove(backup_path)
+            stats['removed'] += 1
+
+    return stats
+
+def size(path):
+    # Bytes the archive takes up on disk
+    total = 0
+    for directory, directories, file_names in os.walk(_backups_path(path)):
+        for file_name in file_names:
+            total += os.path.getsize(os.path.join(directory, file_name))
+
+    return total
@@ -1,22 +1,105 @@
+def to_cents(price):
+    return int(round(float(price)*100))
+
 def total_price(items, only_paid=False):
-    total_price = 0.00
+    # Column stores already hold their prices in cents
+    if not only_paid and hasattr(items, 'total_cents'):
+        return items.total_cents()/100.0
+
+    total_cents = 0
     for item in items:
         if only_paid and not item['paid']:
             continue
 
-        total_price += float(item['price'])
+        total_cents += to_cents(item['price'])
 
-    return total_price
+    return total_cents/100.0
 
 def total_price_bills(monthly_bills, only_paid=False):
-    total_price_bills = 0.00
-    for bill in monthly_bills:
-        if only_paid and not bill['paid']:
-            continue
-
-        total_price_bills += float(bill['price'])
-
-    return total_price_bills
+    return total_price(monthly_bills, only_paid)
 
 def total_budgetable(income, monthly_bills):
     return float(income)-total_price_bills(monthly_bills)
+
+def _cents_total(field):
+    # A total kept in integer cents, read and written as a float amount
+    def get(self):
+        return self._cents[field]/100.0
+
+    def set(self, value):
+        self._cents[field] = to_cents(value)
+
+    return property(get, set)
+
+class LedgerSummary(object):
+    # Keeps every total the reports need, computed in a single pass over the
+    # ledger and then kept up to date as items are added, changed or removed.
+    # Totals are kept in cents so they don't drift however often they change.
+    income = _cents_total('income')
+    paid_income = _cents_total('paid_income')
+    bills = _cents_total('bills')
+    paid_bills = _cents_total('paid_bills')
+    spent = _cents_total('spent')
+    budgeted = _cents_total('budgeted')
+
+    def __init__(self, data=None):
+        self.reset()
+
+        if data is not None:
+            self.load(data)
+
+    def reset(self):
+        self._cents = {
+            'income': 0,
+            'paid_income': 0,
+            'bills': 0,
+            'paid_bills': 0,
+            'spent': 0,
+            'budgeted': 0,
+        }
+
+    def load(self, data):
+        self.reset()
+
+        for list_name in data.keys():
+            # A column store adds itself up
+            if list_name == "expenses" and hasattr(data[list_name], 'total_cents'):
+                self._cents['spent'] = data[list_name].total_cents()
+                continue
+
+            for item in data[list_name]:
+                self.add(list_name, item)
+
+    def add(self, list_name, item, sign=1):
+        price = sign*to_cents(item['price'])
+
+        if list_name == "income":
+            self._cents['income'] += price
+            if item.get('paid'):
+                self._cents['paid_income'] += price
+        elif list_name == "monthly_bills":
+            self._cents['bills'] += price
+            if item.get('paid'):
+                self._cents['paid_bills'] += price
+        elif list_name == "expenses":
+            self._cents['spent'] += price
+        elif list_name == "budgets":
+            self._cents['budgeted'] += price
+
+    def remove(self, list_name, item):
+        self.add(list_name, item, sign=-1)
+
+    def replace(self, list_name, old_item, new_item):
+        self.remove(list_name, old_item)
+        self.add(list_name, new_item)
+
+    # -------------
+
+    def budgetable(self):
+        return (self._cents['income']-self._cents['bills'])/100.0
+
+    def currently_budgetable(self):
+        return (self._cents['paid_income']-self._cents['bills'])/100.0
+
+    def bank_balance(self):
+        return (self._cents['paid_income']-self._cents['paid_bills']-self._cents['spent'])/100.0
@@ -0,0 +1,63 @@
+# Thin client for rsbm_server. Sends one command over the server's Unix
+# socket and hands back the command's output, exactly as the interpreter
+# would have returned it.
+
+import os
+import json
+import socket
+
+from config import *
+
+class ServerUnavailable(Exception):
+    pass
+
+def _connect(socket_path):
+    if not os.path.exists(socket_path):
+        raise ServerUnavailable(socket_path)
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error:
+        connection.close()
+        raise ServerUnavailable(socket_path)
+
+    return connection
+
+def request(args, socket_path=None, ledger_id=None):
+    # Raises ServerUnavailable if no server is listening, before anything has
+    # been sent, so the caller can safely run the command itself instead
+    if socket_path is None:
+        socket_path = CONFIG['server_socket']
+
+    message = {'args': list(args)}
+    if ledger_id is not None:
+        message['ledger'] = ledger_id
+
+    connection = _connect(socket_path)
+    try:
+        connection.sendall((json.dumps(message)+'\n').encode('utf-8'))
+
+        chunks = []
+        while not chunks or not chunks[-1].endswith(b'\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                raise Exception("rsbm server closed the connection")
+            chunks.append(chunk)
+    finally:
+        connection.close()
+
+    response = json.loads(b''.join(chunks).decode('utf-8'))
+    if 'error' in response:
+        raise Exception(response['error'])
+
+    output = response['output']
+    if isinstance(output, type(u'')) and not isinstance(output, str):
+        # Python 2: hand back a plain str like the interpreter does
+        output = output.encode('utf-8')
+
+    # Streamed output was written out as-is, not printed
+    if response.get('stream'):
+        return (chunk for chunk in [output])
+
+    return output
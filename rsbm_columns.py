@@ -0,0 +1,237 @@
+# Column store for the expenses list.
+#
+# Instead of one dict per expense, prices are kept as integer cents in an
+# array and names, budgets and dates (YYYY-MM-DD strings) as ids into
+# interned string tables. That's a
+# few bytes per row rather than a few hundred, and totals become sum() over
+# an array of ints, which doesn't drift the way adding up floats does.
+#
+# ExpenseColumns behaves like the list of dicts it replaces: indexing hands
+# out a fresh {'name', 'price', 'budget', 'date'} dict (no 'date' for rows
+# that have none), and assigning or appending a dict stores it back into the
+# columns.
+
+import array
+
+from rsbm_calculator import to_cents
+
+# 64-bit ints. Python 2's array has no 'q', but its 'l' is 64 bits on the
+# platforms rsbm runs on.
+try:
+    array.array('q')
+    CENTS_TYPECODE = 'q'
+except ValueError:
+    CENTS_TYPECODE = 'l'
+
+class ExpenseColumns(object):
+    def __init__(self, items=()):
+        self._cents = array.array(CENTS_TYPECODE)
+        self._budget_ids = array.array('i')
+        self._name_ids = array.array('i')
+        self._date_ids = array.array('i')
+
+        # Fields other than name, price and budget, per row (None for none)
+        self._extra = []
+
+        self._names = []
+        self._name_lookup = {}
+        self._budgets = []
+        self._budget_lookup = {}
+        # Date id 0 is "no date"
+        self._dates = [None]
+        self._date_lookup = {None: 0}
+
+        # Rough bytes the string tables take up, kept as strings are
+        # interned so footprint() doesn't have to go through them
+        self._strings_size = 60
+
+        for item in items:
+            self.append(item)
+
+    def _intern(self, values, lookup, value):
+        value_id = lookup.get(value)
+        if value_id is None:
+            value_id = len(values)
+            values.append(value)
+            lookup[value] = value_id
+            self._strings_size += len(value)+50
+
+        return value_id
+
+    def _position(self, position):
+        if position < 0:
+            position += len(self._cents)
+        if position < 0 or position >= len(self._cents):
+            raise IndexError("expense index out of range")
+
+        return position
+
+    def _row(self, item):
+        extra = None
+        for key in item.keys():
+            if key not in ['name', 'price', 'budget', 'date']:
+                if extra is None:
+                    extra = {}
+                extra[key] = item[key]
+
+        return (
+            to_cents(item['price']),
+            self._intern(self._budgets, self._budget_lookup, item['budget']),
+            self._intern(self._names, self._name_lookup, item['name']),
+            self._intern(self._dates, self._date_lookup, item.get('date')),
+            extra,
+        )
+
+    def copy(self):
+        # An independent copy, for StorageManager's savepoints
+        copied = ExpenseColumns()
+        copied._cents = array.array(CENTS_TYPECODE, self._cents)
+        copied._budget_ids = array.array('i', self._budget_ids)
+        copied._name_ids = array.array('i', self._name_ids)
+        copied._date_ids = array.array('i', self._date_ids)
+        copied._extra = list(self._extra)
+        copied._names = list(self._names)
+        copied._name_lookup = dict(self._name_lookup)
+        copied._budgets = list(self._budgets)
+        copied._budget_lookup = dict(self._budget_lookup)
+        copied._dates = list(self._dates)
+        copied._date_lookup = dict(self._date_lookup)
+        copied._strings_size = self._strings_size
+
+        return copied
+
+    # -------------
+
+    def __len__(self):
+        return len(self._cents)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[index] for index in range(*position.indices(len(self._cents)))]
+
+        position = self._position(position)
+
+        item = {
+            'name': self._names[self._name_ids[position]],
+            'price': self._cents[position]/100.0,
+            'budget': self._budgets[self._budget_ids[position]],
+        }
+        if self._date_ids[position]:
+            item['date'] = self._dates[self._date_ids[position]]
+        if self._extra[position] is not None:
+            item.update(self._extra[position])
+
+        return item
+
+    def __iter__(self):
+        for position in range(len(self._cents)):
+            yield self[position]
+
+    def __setitem__(self, position, item):
+        position = self._position(position)
+        self._cents[position], self._budget_ids[position], self._name_ids[position], self._date_ids[position], self._extra[position] = self._row(item)
+
+    def __delitem__(self, position):
+        position = self._position(position)
+        del self._cents[position]
+        del self._budget_ids[position]
+        del self._name_ids[position]
+        del self._date_ids[position]
+        del self._extra[position]
+
+    def append(self, item):
+        cents, budget_id, name_id, date_id, extra = self._row(item)
+        self._cents.append(cents)
+        self._budget_ids.append(budget_id)
+        self._name_ids.append(name_id)
+        self._date_ids.append(date_id)
+        self._extra.append(extra)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    # -------------
+
+    def budget_of(self, position):
+        return self._budgets[self._budget_ids[self._position(position)]]
+
+    def undated(self):
+        # How many rows have no date
+        return self._date_ids.count(0)
+
+    def fill_dates(self, date):
+        date_id = self._intern(self._dates, self._date_lookup, date)
+        for position in range(len(self._date_ids)):
+            if not self._date_ids[position]:
+                self._date_ids[position] = date_id
+
+    def date_index(self):
+        # [(date, position)] of every dated row, sorted by date. Rows mostly
+        # come in date order already, which sorting takes advantage of.
+        dates = self._dates
+        index = [(dates[date_id], position) for position, date_id in enumerate(self._date_ids) if date_id]
+        index.sort()
+
+        return index
+
+    def footprint(self):
+        # Rough bytes of memory the columns take up
+        size = len(self._cents)*(self._cents.itemsize+self._budget_ids.itemsize+self._name_ids.itemsize+self._date_ids.itemsize)
+        # A list slot each, plus the odd row with extra fields
+        size += 8*len(self._extra)
+        size += self._strings_size
+
+        return size
+
+    def price_cents(self, position):
+        return self._cents[self._position(position)]
+
+    def total_cents(self):
+        return sum(self._cents)
+
+    def name_positions(self):
+        # {name: [positions]}, for StorageManager's name index
+        positions = {}
+        names = self._names
+        position = 0
+        for name_id in self._name_ids:
+            positions.setdefault(names[name_id], []).append(position)
+            position += 1
+
+        return positions
+
+    def budget_positions(self):
+        # {budget: [positions]}, for when the totals come from elsewhere
+        positions = {}
+        budgets = self._budgets
+        position = 0
+        for budget_id in self._budget_ids:
+            positions.setdefault(budgets[budget_id], []).append(position)
+            position += 1
+
+        return positions
+
+    def budget_groups(self):
+        # {budget: {'cents': total, 'count': expenses, 'positions': [...]}} in
+        # one pass over the columns
+        groups = {}
+        budget_ids = self._budget_ids
+        cents = self._cents
+        for position in range(len(cents)):
+            budget_id = budget_ids[position]
+            group = groups.get(budget_id)
+            if group is None:
+                group = {'cents': 0, 'count': 0, 'positions': []}
+                groups[budget_id] = group
+
+            group['cents'] += cents[position]
+            group['count'] += 1
+            group['positions'].append(position)
+
+        return dict([(self._budgets[budget_id], group) for budget_id, group in groups.items()])
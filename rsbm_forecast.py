@@ -0,0 +1,273 @@
+# Cash-flow forecast.
+#
+# Projects the bank balance over the coming months without walking through
+# them day by day. Every whole month goes the same way: income and bills
+# land on their day of the month, and the budgets are spent at an even rate
+# over it. So a month is worked out once per month length, into a day-sorted
+# schedule of income and bills with prefix sums, and the balance on any day
+# is the month's opening balance plus a bisection into that schedule minus
+# what the budgets have used up by then. Each whole month changes the
+# balance by the same amount, so any month's opening balance is one
+# multiplication away.
+#
+# This month is the odd one out: it starts today, income and bills that are
+# already paid don't come again, and only what's left of each budget still
+# gets spent.
+#
+# Budgets are spent at their budgeted amount per month, or faster when this
+# month's spending so far is on course for more than that. Balances are
+# end-of-day, amounts are in cents.
+
+import bisect
+import calendar
+import datetime
+
+from rsbm_calculator import to_cents
+from config import *
+
+# How far ahead a forecast can look, well short of where dates run out
+MAX_MONTHS = 1200
+
+def _month_length(year, month):
+    return calendar.monthrange(year, month)[1]
+
+def _ceil_div(numerator, denominator):
+    return -(-numerator//denominator)
+
+class MonthPlan(object):
+    # The cash flow of (the rest of) one month, from first_day to last_day.
+    # events are (day, cents) pairs; days outside the plan land on its
+    # first or last day, so a bill on the 31st is paid on the 30th in April.
+    def __init__(self, first_day, last_day, events, burn):
+        self.first_day = first_day
+        self.last_day = last_day
+        # What the budgets spend over the whole plan
+        self.burn = burn
+
+        # Day-sorted schedule, one entry per day, with running totals
+        self.days = []
+        self.totals = []
+        running = 0
+        for day, cents in sorted([(min(max(day, first_day), last_day), cents) for day, cents in events]):
+            running += cents
+            if self.days and self.days[-1] == day:
+                self.totals[-1] = running
+            else:
+                self.days.append(day)
+                self.totals.append(running)
+
+        self.net = running-burn
+
+        # Between events the balance only goes down, so the month's low
+        # points are at the end of each event day, the day before it, and
+        # the month's last day. The lowest of those so far, for each one:
+        low_days = set(self.days+[day-1 for day in self.days if day > first_day]+[last_day])
+        self.low_days = sorted(low_days)
+        self.lows = []
+        self.low_at = []
+        for day in self.low_days:
+            offset = self.offset(day)
+            if not self.lows or offset < self.lows[-1]:
+                self.lows.append(offset)
+                self.low_at.append(day)
+            else:
+                self.lows.append(self.lows[-1])
+                self.low_at.append(self.low_at[-1])
+
+        # Ascending, for bisecting
+        self._negated_lows = [-low for low in self.lows]
+
+    def events_through(self, day):
+        position = bisect.bisect_right(self.days, day)
+        if not position:
+            return 0
+
+        return self.totals[position-1]
+
+    def burned_through(self, day):
+        return self.burn*(day-self.first_day+1)//(self.last_day-self.first_day+1)
+
+    def offset(self, day):
+        # How far the balance has moved from the opening by the end of day
+        return self.events_through(day)-self.burned_through(day)
+
+    def lowest_through(self, day):
+        # (lowest offset, day it's reached) over first_day..day
+        lowest = (self.offset(day), day)
+
+        position = bisect.bisect_right(self.low_days, day)
+        if position and self.lows[position-1] <= lowest[0]:
+            lowest = (self.lows[position-1], self.low_at[position-1])
+
+        return lowest
+
+    def first_below(self, threshold):
+        # First day the offset drops below threshold, or None
+        position = bisect.bisect_right(self._negated_lows, -threshold)
+        if position == len(self.lows):
+            return None
+
+        day = self.low_days[position]
+        previous = self.first_day-1
+        if position:
+            previous = self.low_days[position-1]
+
+        if day in self.days:
+            return day
+
+        # Nothing comes in or goes out after previous until day, only the
+        # budgets keep spending: solve for the day they take it under
+        if not self.burn:
+            return previous+1
+
+        needed = self.events_through(day)-threshold+1
+        spent_day = self.first_day-1+_ceil_div(needed*(self.last_day-self.first_day+1), self.burn)
+
+        return max(previous+1, min(spent_day, day))
+
+class Forecast(object):
+    def __init__(self, data, spent, balance, today=None, months=3):
+        # spent is {budget: cents spent this month}, balance the bank
+        # balance in cents right now
+        if today is None:
+            today = datetime.date.today()
+
+        self.today = today
+        self.months = months
+        self.balance = balance
+
+        length = _month_length(today.year, today.month)
+
+        # Monthly spending per budget, and what's left of it this month
+        budgeted = {}
+        for budget in data['budgets']:
+            budgeted[budget['name']] = budgeted.get(budget['name'], 0)+to_cents(budget['price'])
+
+        monthly_burn = 0
+        remaining_burn = 0
+        for budget_name in set(list(budgeted.keys())+list(spent.keys())):
+            so_far = spent.get(budget_name, 0)
+            rate = max(budgeted.get(budget_name, 0), so_far*length//today.day)
+            monthly_burn += rate
+            remaining_burn += max(rate-so_far, 0)
+
+        monthly = []
+        this_month = []
+        self._paydays = []
+        for income in data['income']:
+            day = income.get('day', CONFIG['payday'])
+            monthly.append((day, to_cents(income['price'])))
+            self._paydays.append(day)
+            if not income['paid']:
+                this_month.append((day, to_cents(income['price'])))
+        for bill in data['monthly_bills']:
+            monthly.append((bill['day'], -to_cents(bill['price'])))
+            if not bill['paid']:
+                this_month.append((bill['day'], -to_cents(bill['price'])))
+
+        self._paydays.sort()
+        self._unpaid_paydays = sorted([day for day, cents in this_month if cents > 0])
+
+        self._first = MonthPlan(today.day, length, this_month, remaining_burn)
+
+        # Whole months only differ in their length
+        self._plans = {}
+        for length in [28, 29, 30, 31]:
+            self._plans[length] = MonthPlan(1, length, monthly, monthly_burn)
+        self.monthly_net = self._plans[31].net
+
+    # -------------
+
+    def _month(self, number):
+        # (year, month, plan, opening balance) of month number, this month
+        # being 0
+        month = self.today.month+number
+        year = self.today.year+(month-1)//12
+        month = (month-1)%12+1
+
+        if not number:
+            return year, month, self._first, self.balance
+
+        opening = self.balance+self._first.net+(number-1)*self.monthly_net
+        return year, month, self._plans[_month_length(year, month)], opening
+
+    def _number(self, date):
+        return (date.year-self.today.year)*12+date.month-self.today.month
+
+    @property
+    def end(self):
+        # The last day forecast
+        year, month, plan, opening = self._month(self.months)
+        return datetime.date(year, month, plan.last_day)
+
+    def balance_on(self, date):
+        if date < self.today or date > self.end:
+            return None
+
+        year, month, plan, opening = self._month(self._number(date))
+        return opening+plan.offset(date.day)
+
+    def month_summaries(self):
+        # Per month: opening, lowest (and when), closing
+        summaries = []
+        for number in range(self.months+1):
+            year, month, plan, opening = self._month(number)
+            lowest, day = plan.lowest_through(plan.last_day)
+            summaries.append({
+                'month': "%04d-%02d" % (year, month),
+                'opening': opening,
+                'lowest': opening+lowest,
+                'lowest_on': datetime.date(year, month, day),
+                'closing': opening+plan.net,
+            })
+
+        return summaries
+
+    def lowest(self, last=None):
+        # (lowest balance, day) from today through last (the end by default)
+        if last is None or last > self.end:
+            last = self.end
+
+        lowest = None
+        for number in range(self._number(last)+1):
+            year, month, plan, opening = self._month(number)
+
+            day = plan.last_day
+            if number == self._number(last):
+                day = last.day
+
+            low, low_day = plan.lowest_through(day)
+            if lowest is None or opening+low < lowest[0]:
+                lowest = (opening+low, datetime.date(year, month, low_day))
+
+        return lowest
+
+    def first_below(self, threshold=0):
+        # The first day the balance is under threshold, or None
+        for number in range(self.months+1):
+            year, month, plan, opening = self._month(number)
+            if opening+plan.lows[-1] >= threshold:
+                continue
+
+            return datetime.date(year, month, plan.first_below(threshold-opening))
+
+        return None
+
+    def next_payday(self):
+        # The first day after today that income comes in, or None
+        for day in self._unpaid_paydays:
+            if day > self.today.day:
+                return datetime.date(self.today.year, self.today.month, min(day, self._first.last_day))
+
+        if not self._paydays or not self.months:
+            return None
+
+        year, month, plan, opening = self._month(1)
+        return datetime.date(year, month, min(self._paydays[0], plan.last_day))
+
+    def daily(self):
+        # (day, balance) for every day forecast, for showing all of it
+        for number in range(self.months+1):
+            year, month, plan, opening = self._month(number)
+            for day in range(plan.first_day, plan.last_day+1):
+                yield datetime.date(year, month, day), opening+plan.offset(day)
@@ -0,0 +1,218 @@
+# Archive of past months, kept up to date by next_month.
+#
+# history/index.yaml holds per-month totals (income, bills, spending per
+# budget, ...) so trend queries never have to open the old monthly backups.
+# The archived expense rows themselves are stored column by column in flat
+# arrays next to it:
+#
+#   prices.d    price of every row (array 'd')
+#   budgets.i   budget of every row, as an id into the index's budget_names
+#   names.i     name of every row, as a line number into names.txt
+#
+# Each month in the index records the [start, end) range of its rows.
+
+import os
+import array
+
+import yaml
+
+import rsbm_backup
+import rsbm_calculator
+import rsbm_storage
+from config import *
+
+def _history_path(path):
+    return path+'history/'
+
+def load_index(path):
+    index_path = _history_path(path)+'index.yaml'
+    if not os.path.exists(index_path):
+        return {'months': [], 'budget_names': [], 'row_count': 0, 'name_count': 0, 'names_size': 0}
+
+    with open(index_path, 'rb') as f:
+        return yaml.load(f.read(), Loader=rsbm_storage.Loader)
+
+def _save_index(path, index):
+    rsbm_storage.atomic_write(_history_path(path)+'index.yaml', yaml.dump(index, Dumper=rsbm_storage.Dumper))
+
+def _truncate(file_path, size):
+    # Drops whatever an interrupted archive appended past what the index knows
+    if os.path.exists(file_path) and os.path.getsize(file_path) > size:
+        with open(file_path, 'r+b') as f:
+            f.truncate(size)
+
+def _load_names(path, index):
+    names_path = _history_path(path)+'names.txt'
+    if not os.path.exists(names_path):
+        return []
+
+    with open(names_path, 'rb') as f:
+        contents = f.read(index['names_size'])
+
+    names = contents.split(b'\n')[:index['name_count']]
+    if not isinstance(contents, str):
+        names = [name.decode('utf-8') for name in names]
+
+    return names
+
+def _month_totals(data):
+    summary = rsbm_calculator.LedgerSummary(data)
+
+    # Spending is added up in cents, like LedgerSummary does
+    budgets = {}
+    spent_cents = {}
+    for budget in data['budgets']:
+        budgets[budget['name']] = {'budgeted': float(budget['price']), 'spent': 0.00, 'count': 0}
+    for expense in data['expenses']:
+        totals = budgets.setdefault(expense['budget'], {'budgeted': 0.00, 'spent': 0.00, 'count': 0})
+        spent_cents[expense['budget']] = spent_cents.get(expense['budget'], 0)+rsbm_calculator.to_cents(expense['price'])
+        totals['count'] += 1
+    for budget_name, cents in spent_cents.items():
+        budgets[budget_name]['spent'] = cents/100.0
+
+    bills = {}
+    for bill in data['monthly_bills']:
+        bills[bill['name']] = float(bill['price'])
+
+    return {
+        'income': summary.income,
+        'paid_income': summary.paid_income,
+        'bills': summary.bills,
+        'paid_bills': summary.paid_bills,
+        'spent': summary.spent,
+        'budgeted': summary.budgeted,
+        'budgets': budgets,
+        'bill_prices': bills,
+    }
+
+def archive_month(path, month, data):
+    # Adds one month to the archive. Returns False if it's already in there.
+    history_path = _history_path(path)
+    if not os.path.exists(history_path):
+        os.mkdir(history_path)
+
+    index = load_index(path)
+    if find_month(path, month, index) is not None:
+        return False
+
+    row_count = index['row_count']
+    _truncate(history_path+'prices.d', row_count*array.array('d').itemsize)
+    _truncate(history_path+'budgets.i', row_count*array.array('i').itemsize)
+    _truncate(history_path+'names.i', row_count*array.array('i').itemsize)
+
+    # Intern budget and expense names
+    budget_ids = {}
+    for budget_id, budget_name in enumerate(index['budget_names']):
+        budget_ids[budget_name] = budget_id
+
+    names = _load_names(path, index)
+    names_path = history_path+'names.txt'
+    _truncate(names_path, index['names_size'])
+
+    name_ids = {}
+    for name_id, name in enumerate(names):
+        name_ids[name] = name_id
+
+    prices = array.array('d')
+    budget_column = array.array('i')
+    name_column = array.array('i')
+    new_names = []
+    for expense in data['expenses']:
+        if expense['budget'] not in budget_ids:
+            budget_ids[expense['budget']] = len(index['budget_names'])
+            index['budget_names'].append(expense['budget'])
+        if expense['name'] not in name_ids:
+            name_ids[expense['name']] = len(names)+len(new_names)
+            new_names.append(expense['name'])
+
+        prices.append(float(expense['price']))
+        budget_column.append(budget_ids[expense['budget']])
+        name_column.append(name_ids[expense['name']])
+
+    with open(history_path+'prices.d', 'ab') as f:
+        prices.tofile(f)
+    with open(history_path+'budgets.i', 'ab') as f:
+        budget_column.tofile(f)
+    with open(history_path+'names.i', 'ab') as f:
+        name_column.tofile(f)
+    with open(names_path, 'ab') as f:
+        f.write(rsbm_storage.to_bytes(''.join([name+'\n' for name in new_names])))
+
+    totals = _month_totals(data)
+    totals['month'] = month
+    totals['rows'] = [row_count, row_count+len(prices)]
+
+    index['months'].append(totals)
+    index['months'].sort(key=lambda archived: archived['month'])
+    index['row_count'] = row_count+len(prices)
+    index['name_count'] = len(names)+len(new_names)
+    index['names_size'] = os.path.getsize(names_path)
+
+    # The index goes last, it's what makes the appended rows count
+    _save_index(path, index)
+
+    return True
+
+def find_month(path, month, index=None):
+    if index is None:
+        index = load_index(path)
+
+    for archived in index['months']:
+        if archived['month'] == month:
+            return archived
+
+    return None
+
+def month_expenses(path, month):
+    # The archived expense rows of one month, as expense items
+    index = load_index(path)
+    archived = find_month(path, month, index)
+    if archived is None:
+        return None
+
+    start, end = archived['rows']
+    history_path = _history_path(path)
+
+    columns = []
+    for file_name, typecode in [('prices.d', 'd'), ('budgets.i', 'i'), ('names.i', 'i')]:
+        column = array.array(typecode)
+        with open(history_path+file_name, 'rb') as f:
+            f.seek(start*column.itemsize)
+            column.fromfile(f, end-start)
+        columns.append(column)
+
+    names = _load_names(path, index)
+
+    expenses = []
+    for price, budget_id, name_id in zip(*columns):
+        expenses.append({'name': names[name_id], 'price': price, 'budget': index['budget_names'][budget_id]})
+
+    return expenses
+
+def last_months(path, count):
+    return load_index(path)['months'][-count:]
+
+# -------------
+
+def rebuild(path):
+    # Builds the archive from scratch out of the month backups next_month
+    # has made so far, old full YAML copies included
+    history_path = _history_path(path)
+    for file_name in ['index.yaml', 'prices.d', 'budgets.i', 'names.i', 'names.txt']:
+        if os.path.exists(history_path+file_name):
+            os.remove(history_path+file_name)
+
+    backups = dict(rsbm_backup.yaml_backups(path))
+    for month in rsbm_backup.months(path):
+        backups[month] = None
+
+    for month in sorted(backups.keys()):
+        if backups[month] is None:
+            data = rsbm_backup.restore_month(path, month)
+        else:
+            with open(backups[month], 'rb') as f:
+                data = yaml.load(f.read(), Loader=rsbm_storage.Loader)
+
+        archive_month(path, month, data)
+
+    return len(backups)
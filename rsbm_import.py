@@ -0,0 +1,236 @@
+# Imports bank statement CSVs into the ledger.
+#
+# Rows are streamed through a chain of generators (read, parse, fingerprint,
+# map to items), so a statement is never held in memory as a whole. Money
+# going out becomes an expense, money coming in becomes received income.
+# Every imported transaction's fingerprint is kept in import_fingerprints, so
+# importing the same (or an overlapping) statement again skips what's
+# already there. A transaction entered by hand before the import is matched
+# on its name, price and date, once.
+
+import io
+import os
+import re
+import csv
+import sys
+import hashlib
+import datetime
+
+from rsbm_calculator import to_cents
+from config import *
+
+def load_options(rules_path=None):
+    options = dict(CONFIG['import'])
+
+    # A rules file can override any of the CONFIG['import'] settings
+    if rules_path is not None:
+        import yaml
+        with open(rules_path, 'rb') as f:
+            options.update(yaml.safe_load(f.read()) or {})
+
+    options['budget_rules'] = [(re.compile(pattern, re.IGNORECASE), budget) for pattern, budget in options['budget_rules']]
+
+    return options
+
+# -------------
+
+def read_rows(path, options):
+    if sys.version_info[0] < 3:
+        f = open(path, 'rb')
+    else:
+        f = io.open(path, 'r', newline='', encoding='utf-8-sig')
+
+    try:
+        for row in csv.DictReader(f, delimiter=str(options['delimiter'])):
+            yield row
+    finally:
+        f.close()
+
+def parse_amount(text, options):
+    text = (text or '').strip()
+    if not text:
+        return 0.00
+
+    if options['decimal_comma']:
+        text = text.replace('.', '').replace(',', '.')
+    else:
+        text = text.replace(',', '')
+
+    # Currency signs, spaces and the like
+    text = re.sub(r'[^0-9.\-]', '', text)
+
+    return float(text)
+
+def transactions(rows, options):
+    # Yields (date, description, amount), amount negative for money going out
+    columns = options['columns']
+
+    for row in rows:
+        if 'amount' in columns:
+            amount = parse_amount(row.get(columns['amount']), options)
+        else:
+            amount = parse_amount(row.get(columns['credit']), options)-parse_amount(row.get(columns['debit']), options)
+
+        if amount == 0:
+            continue
+
+        date = (row.get(columns.get('date')) or '').strip()
+        description = (row.get(columns['description']) or '').strip()
+
+        yield date, description, amount
+
+def fingerprinted(parsed):
+    # Identical rows on the same day (two coffees) are told apart by how many
+    # times they've been seen that day. Statements come sorted by date, so
+    # the counts only ever cover one day.
+    seen = {}
+    current_date = None
+
+    for date, description, amount in parsed:
+        if date != current_date:
+            seen = {}
+            current_date = date
+
+        key = "%s|%s|%.2f" % (date, description, amount)
+        seen[key] = seen.get(key, 0)+1
+
+        fingerprint = hashlib.sha1(("%s|%d" % (key, seen[key])).encode('utf-8')).hexdigest()
+
+        yield fingerprint, date, description, amount
+
+def parse_date(text, options):
+    # The statement's date as YYYY-MM-DD, or None if it can't be read
+    try:
+        return datetime.datetime.strptime(text, options['date_format']).date().isoformat()
+    except ValueError:
+        return None
+
+def to_items(parsed, options, format_name):
+    # Yields (fingerprint, list name, item) for every transaction
+    for fingerprint, date, description, amount in parsed:
+        name = format_name(description)
+
+        if amount < 0:
+            budget = options['default_budget']
+            for pattern, rule_budget in options['budget_rules']:
+                if pattern.search(description):
+                    budget = rule_budget
+                    break
+
+            item = {'name': name, 'price': -amount, 'budget': format_name(budget)}
+
+            # Undated expenses get one when the ledger is next loaded
+            expense_date = parse_date(date, options)
+            if expense_date is not None:
+                item['date'] = expense_date
+
+            yield fingerprint, 'expenses', item
+        else:
+            item = {'name': name, 'price': amount, 'paid': True}
+            yield fingerprint, 'income', item
+
+# -------------
+
+class Fingerprints(object):
+    # Persisted set of the fingerprints of everything imported so far
+    def __init__(self, path):
+        self._path = path
+        self._seen = set()
+        self._new = []
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    self._seen.add(line.strip())
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._seen
+
+    def add(self, fingerprint):
+        self._seen.add(fingerprint)
+        self._new.append(fingerprint)
+
+    def save(self):
+        if not self._new:
+            return
+
+        with open(self._path, 'a') as f:
+            f.write(''.join([fingerprint+'\n' for fingerprint in self._new]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._new = []
+
+class LedgerMatches(object):
+    # What was in the ledger before this import started, as a multiset of
+    # (name, price in cents, date) per list, so a statement line can be
+    # told apart from something already entered by hand. Every ledger item
+    # stands for one statement line at most. Built a name at a time, only
+    # for the names the statement has.
+    def __init__(self, storage):
+        self._storage = storage
+        self._existing_counts = {
+            'expenses': len(storage.data['expenses']),
+            'income': len(storage.data['income']),
+        }
+        self._counts = {}
+
+    def _key(self, item):
+        return (to_cents(item['price']), item.get('date'))
+
+    def _for_name(self, list_name, name):
+        counts = self._counts.get((list_name, name))
+        if counts is None:
+            counts = {}
+            for position in self._storage.find_all(list_name, name):
+                if position >= self._existing_counts[list_name]:
+                    break
+
+                key = self._key(self._storage.data[list_name][position])
+                counts[key] = counts.get(key, 0)+1
+
+            self._counts[(list_name, name)] = counts
+
+        return counts
+
+    def take(self, list_name, item):
+        # Uses up a ledger item matching item, True if there was one left
+        counts = self._for_name(list_name, item['name'])
+        key = self._key(item)
+        if not counts.get(key):
+            return False
+
+        counts[key] -= 1
+        return True
+
+def import_statement(storage, path, options, format_name):
+    fingerprints = Fingerprints(storage.path+'import_fingerprints')
+
+    stats = {'expenses': 0, 'income': 0, 'duplicates': 0}
+    matches = LedgerMatches(storage)
+
+    rows = read_rows(path, options)
+    items = to_items(fingerprinted(transactions(rows, options)), options, format_name)
+
+    with storage.transaction():
+        for fingerprint, list_name, item in items:
+            if fingerprint in fingerprints:
+                # Imported before, and that import's item is used up by it
+                matches.take(list_name, item)
+                stats['duplicates'] += 1
+                continue
+
+            if matches.take(list_name, item):
+                stats['duplicates'] += 1
+                continue
+
+            storage.add_item(list_name, item)
+            fingerprints.add(fingerprint)
+            stats[list_name] += 1
+
+        if stats['expenses'] or stats['income']:
+            # Only remember what was imported once the ledger has it
+            storage.after_save(fingerprints.save)
+            storage.save()
+
+    return stats
@@ -1,3 +1,5 @@
+import rsbm_profile
+
 class BaseInterpreter(object):
     def __init__(self):
         # Contains a directory that maps words to functions
@@ -8,18 +10,14 @@ class BaseInterpreter(object):
     def interpret(self, args):
         # No args? display help
         if len(args) <= 1:
-            print self._helpmsg
+            print(self._helpmsg)
             return True
 
         # Don't proceed if the command doesn't exist
-        proceed = False
-        for command in self._funcmap.keys():
-            if command == args[1]:
-                proceed = True
-
-        if not proceed:
+        func = self._funcmap.get(args[1])
+        if func is None:
             return False
 
         # Run the instance method determined by the user's chosen command
-        func = self._funcmap.get(args[1])
-        return func(args)
+        with rsbm_profile.phase('compute'):
+            return func(args)
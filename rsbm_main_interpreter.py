@@ -1,15 +1,69 @@
-import datetime
-import yaml
+import re
+import sys
+import json
+import time
+import types
+import random
+import heapq
+import shlex
+import itertools
 
 import rsbm_interpreter
-import rsbm_calculator
+import rsbm_profile
 from config import *
 
+# yaml, datetime and the storage modules are imported where they're used, so
+# the help text and unknown commands don't pay for loading them
+
+# Commands that only read the ledger. When one of them is the first to open
+# it, the ledger is opened read-only, without any of the write-side setup.
+READ_ONLY_COMMANDS = ['list', 'status', 'bank', 'history', 'trend', 'forecast', 'cache']
+
+# Reports whose output only depends on the ledger and the command line, which
+# the report cache can answer while the ledger is unchanged
+REPORT_COMMANDS = ['status', 'bank', 'list']
+
+class BatchAborted(Exception):
+    pass
+
+def command_name(args):
+    # The command args run, past 'api' and its --format
+    words = args[1:]
+    if words[:1] == ['api']:
+        words = words[1:]
+        if words[:1] == ['--format']:
+            words = words[2:]
+
+    if not words:
+        return None
+
+    return words[0]
+
 class MainInterpreter(rsbm_interpreter.BaseInterpreter):
-    def __init__(self, storage):
+    def __init__(self, storage=None, storage_factory=None, pool=None, report_cache=None):
         super(MainInterpreter, self).__init__()
 
-        self._storage = storage
+        # Storage is only opened once a command first touches it
+        self._storage_instance = storage
+        self._storage_factory = storage_factory
+        self._read_only = False
+
+        # Today's date as of when the current command started, see _today()
+        self._date = None
+
+        # The rsbm_storage.LedgerPool this ledger came from, when the server
+        # hosts many of them
+        self._pool = pool
+
+        # The rsbm_report_cache.ReportCache reports are kept in between runs,
+        # for one-shot rsbm calls
+        self._report_cache = report_cache
+
+        # How api results are returned: 'yaml', 'json' or 'ndjson' text, or
+        # 'raw' Python values for callers (like batch) that collect them.
+        # Lists come back as generators of text chunks in json and ndjson, so
+        # they can be written out row by row.
+        self._api_format = 'yaml'
         self._funcmap = {
             'add': self.add,
             'set': self.set,
@@ -20,6 +74,15 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             'bank': self.bank_balance,
             'status': self.status,
             'next_month': self.next_month,
+            'cache': self.cache,
+            'serve': self.serve,
+            'shell': self.shell,
+            'batch': self.batch,
+            'import': self.import_statement,
+            'history': self.history,
+            'backup': self.backup,
+            'trend': self.trend,
+            'forecast': self.forecast,
             'api': self.api,
         }
 
@@ -31,36 +94,190 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
 
         self._helpmsg = "Commands: %s" % ', '.join(commands)
 
+    def interpret(self, args, date=None):
+        # Commands run against the ledger as it was loaded. If another rsbm
+        # process saved in the meantime, the save is refused and the command
+        # is run again on the fresh data, so neither change gets lost.
+        # date (YYYY-MM-DD) is today's date as far as the command is
+        # concerned, for running it again later the way it first ran.
+        self._date = date
+
+        if self._storage_instance is None:
+            self._read_only = self._reads_only(args)
+
+            # A report on a ledger that hasn't been saved since it was last
+            # made comes out of the report cache, without loading anything
+            if self._report_cache is not None and self._command(args) in REPORT_COMMANDS:
+                return self._report_cache.report(args, lambda: self._interpret(args))
+
+        return self._interpret(args)
+
+    def _interpret(self, args):
+        attempt = 0
+        while True:
+            try:
+                with rsbm_profile.phase('dispatch'):
+                    return super(MainInterpreter, self).interpret(list(args))
+            except Exception as e:
+                if not self._is_stale(e) or attempt >= CONFIG['stale_retries']:
+                    raise
+
+            attempt += 1
+            rsbm_profile.count('stale_retries')
+            self._stale_backoff(attempt)
+            self._storage.rollback()
+
+    def _command(self, args):
+        return command_name(args)
+
+    def _reads_only(self, args):
+        return self._command(args) in READ_ONLY_COMMANDS
+
+    def _is_stale(self, error):
+        # rsbm_storage is only imported once the storage has been opened
+        storage_module = sys.modules.get('rsbm_storage')
+        return storage_module is not None and isinstance(error, storage_module.StaleVersion)
+
+    def _stale_backoff(self, attempt):
+        # A little random wait, so processes that keep colliding spread out
+        time.sleep(random.uniform(0, 0.005*attempt))
+
     # -------------
 
+    @property
+    def _storage(self):
+        if self._storage_instance is None:
+            if self._storage_factory is None:
+                with rsbm_profile.phase('import'):
+                    import rsbm_storage
+                self._storage_factory = rsbm_storage.StorageManager
+
+            self._storage_instance = self._storage_factory(read_only=self._read_only)
+
+        return self._storage_instance
+
+    def _dump(self, value):
+        with rsbm_profile.phase('render'):
+            return self._dump_value(value)
+
+    def _dump_value(self, value):
+        is_list = isinstance(value, (list, types.GeneratorType))
+
+        if self._api_format == 'raw':
+            # Lists are live storage data, later commands shouldn't change
+            # what was returned
+            if is_list:
+                return list(value)
+            return value
+        elif self._api_format == 'json':
+            if is_list:
+                return self._stream_json(value)
+            return json.dumps(value)
+        elif self._api_format == 'ndjson':
+            if is_list:
+                return self._stream_ndjson(value)
+            return json.dumps(value)
+
+        if isinstance(value, types.GeneratorType):
+            value = list(value)
+
+        import yaml
+        return yaml.dump(value)
+
+    def _stream_json(self, rows):
+        separator = "["
+        for row in rows:
+            yield separator+json.dumps(row)
+            separator = ","
+
+        if separator == "[":
+            yield "[]\n"
+        else:
+            yield "]\n"
+
+    def _stream_ndjson(self, rows):
+        for row in rows:
+            yield json.dumps(row)+"\n"
+
     def _format_name(self, name):
         return name.replace('_', ' ')
     def _format_name_reverse(self, name):
         return name.replace(' ', '_').lower()
 
+    def _parse_date(self, text):
+        # YYYY-MM-DD, normalised, or None if it isn't a valid date
+        import datetime
+        try:
+            return datetime.datetime.strptime(text, '%Y-%m-%d').date().isoformat()
+        except (TypeError, ValueError):
+            return None
+
+    def _parse_day(self, text):
+        # A day of the month, 1-31, or None if text isn't one
+        if not text.isdigit() or not 1 <= int(text) <= 31:
+            return None
+
+        return int(text)
+
+    def _today(self):
+        # Taken once per command, so a command that's run again after a
+        # stale save dates things the same way
+        if self._date is None:
+            import datetime
+            self._date = datetime.date.today().isoformat()
+
+        return self._date
+
+    def _pop_option(self, args, name):
+        # Takes '<name> <value>' out of args. Returns the value, None when
+        # the option isn't there, or '' when its value is missing.
+        if name not in args:
+            return None
+
+        position = args.index(name)
+        value = ''
+        if position+1 < len(args):
+            value = args[position+1]
+        del args[position:position+2]
+
+        return value
+
+    def _parse_date_option(self, arg, args, options):
+        # --from/--to <YYYY-MM-DD> and --days <N> (the last N days, today
+        # included) fill in options['from'] and options['to']. Returns False
+        # when the option is malformed.
+        if not args:
+            return False
+
+        value = args.pop(0)
+        if arg == '--days':
+            if not value.isdigit() or int(value) < 1:
+                return False
+
+            # The same today as everything else the command does
+            import datetime
+            today = datetime.datetime.strptime(self._today(), '%Y-%m-%d').date()
+            options['from'] = (today-datetime.timedelta(days=int(value)-1)).isoformat()
+            options['to'] = today.isoformat()
+            return True
+
+        date = self._parse_date(value)
+        if date is None:
+            return False
+
+        options[arg[2:]] = date
+        return True
+
     def _add_to_list(self, list_name, item_type, item):
         if list_name not in self._storage.data:
             raise Exception("Program tried to add something to list %s, list doesn't exist." % list_name)
 
-        self._storage.data[list_name].append(item)
+        self._storage.add_item(list_name, item)
         self._storage.save()
 
         return "%s added." % item_type
-    def _find_by_name(self, list, name):
-        index = 0
-        target_index = 0
-        found = False
-        for item in list:
-            if item['name'] == name:
-                target_index = index
-                found = True
-
-            index += 1
-
-        if not found:
-            return None
-
-        return target_index
+    def _find_by_name(self, list_name, name):
+        return self._storage.find(list_name, name)
     def _del_from_list(self, list_name, item_type, item_name):
         if list_name not in self._storage.data:
             raise Exception("Program tried to delete something from list %s, list doesn't exist." % list_name)
@@ -68,11 +285,11 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
         if not item_name:
             return "Please specify a %s" % item_type
 
-        target_index = self._find_by_name(self._storage.data[list_name], item_name)
+        target_index = self._find_by_name(list_name, item_name)
         if target_index == None:
             return "%s not found" % item_type
 
-        del self._storage.data[list_name][target_index]
+        self._storage.delete_item(list_name, target_index)
         self._storage.save()
         return "%s deleted." % item_type
 
@@ -96,27 +313,51 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
         if item_type == "bill":
             return "<name> <price> <day of month>"
         elif item_type == "expense":
-            return "<category> <name> <price>"
+            return "<name> <price> <budget> [--date YYYY-MM-DD]"
         elif item_type == "budget":
             return "<budget>"
         elif item_type == "income":
-            return "<name> <price>"
+            return "<name> <price> [day of month]"
 
     # -------------
 
     def api(self, args):
-        # Calls the command supplied with API mode turned on
+        # Calls the command supplied with API mode turned on.
+        # Usage: api [--format yaml|json|ndjson] <command> ...
 
-        cmd = args[2]
-        if cmd not in self._funcmap.keys():
-            return yaml.dump(False)
+        api_format = self._api_format
+        if len(args) > 3 and args[2] == '--format':
+            if args[3] not in ['yaml', 'json', 'ndjson']:
+                return self._dump(False)
 
-        del(args[0])
-        return self._funcmap[cmd](args, api=True)
+            # Batches collect raw values whatever format a line asks for
+            if self._api_format != 'raw':
+                self._api_format = args[3]
+            del args[2:4]
+
+        try:
+            cmd = args[2]
+            if cmd not in self._funcmap.keys():
+                return self._dump(False)
+
+            del(args[0])
+            return self._funcmap[cmd](args, api=True)
+        finally:
+            self._api_format = api_format
 
     # -------------
 
     def add(self, args, api=False):
+        # Expenses are dated today unless --date says otherwise
+        date = self._pop_option(args, '--date')
+        if date is not None:
+            date = self._parse_date(date)
+            if date is None:
+                if not api:
+                    return "Dates are written as YYYY-MM-DD."
+                else:
+                    return self._dump(False)
+
         if len(args) <= 2:
             if not api:
                 available_types = ', '.join(self._storage.data.keys())
@@ -126,13 +367,13 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
                 output += "Available types: %s\n" % available_types
                 return output
             else:
-                return yaml.dump(False)
+                return self._dump(False)
         if len(args) <= 3:
             if not api:
                 output = "Usage: add %s %s" % (args[2], self._help_on_type(args[2]))
                 return output
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
         list_name = self._translate_item_type(args[2])
 
@@ -142,6 +383,14 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             new_item['name'] = args[3]
             new_item['price'] = float(args[4])
             new_item['paid'] = False
+            # When it comes in, for forecasts (CONFIG['payday'] otherwise)
+            if len(args) > 5:
+                new_item['day'] = self._parse_day(args[5])
+                if new_item['day'] is None:
+                    if not api:
+                        return "Usage: add %s %s" % (args[2], self._help_on_type(args[2]))
+                    else:
+                        return self._dump(False)
         elif list_name == "budgets":
             new_item['name'] = args[3]
             new_item['price'] = 0.00
@@ -154,20 +403,32 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             new_item['name'] = args[3]
             new_item['price'] = float(args[4])
             new_item['budget'] = self._format_name_reverse(args[5])
-        else:
+            new_item['date'] = date or self._today()
+        elif not api:
             return "Unknown item type."
+        else:
+            return self._dump(False)
 
         new_item['name'] = self._format_name_reverse(new_item['name'])
 
-        self._storage.data[list_name].append(new_item)
+        self._storage.add_item(list_name, new_item)
         self._storage.save()
 
         if api:
-            return yaml.dump(True)
+            return self._dump(True)
 
         return "New %s \"%s\" added to %s" % (args[2], self._format_name(new_item['name']), self._format_name(list_name))
 
     def set(self, args, api=False):
+        date = self._pop_option(args, '--date')
+        if date is not None:
+            date = self._parse_date(date)
+            if date is None:
+                if not api:
+                    return "Dates are written as YYYY-MM-DD."
+                else:
+                    return self._dump(False)
+
         if len(args) <= 2:
             if not api:
                 available_types = ', '.join(self._storage.data.keys())
@@ -177,29 +438,42 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
                 output += "Available types: %s\n" % available_types
                 return output
             else:
-                return yaml.dump(False)
+                return self._dump(False)
         if len(args) <= 3:
             if not api:
                 output = "Usage: set %s %s" % (args[2], self._help_on_type(args[2]))
                 return output
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
         list_name = self._translate_item_type(args[2])
+        if not list_name:
+            if not api:
+                return "Unknown item type."
+            else:
+                return self._dump(False)
+
         item_name = self._format_name_reverse(args[3])
-        target_index = self._find_by_name(self._storage.data[list_name], item_name)
+        target_index = self._find_by_name(list_name, item_name)
 
         if target_index == None:
             if not api:
                 return "Could not find that %s" % args[2]
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
-        modified_item = self._storage.data[list_name][target_index]
+        modified_item = dict(self._storage.data[list_name][target_index])
         if list_name == "income":
             modified_item['name'] = args[3]
             modified_item['price'] = float(args[4])
             modified_item['paid'] = False
+            if len(args) > 5:
+                modified_item['day'] = self._parse_day(args[5])
+                if modified_item['day'] is None:
+                    if not api:
+                        return "Usage: set %s %s" % (args[2], self._help_on_type(args[2]))
+                    else:
+                        return self._dump(False)
         elif list_name == "budgets":
             modified_item['name'] = args[3]
             modified_item['price'] = float(args[4])
@@ -212,16 +486,20 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             modified_item['name'] = args[3]
             modified_item['price'] = float(args[4])
             modified_item['budget'] = self._format_name_reverse(args[5])
-        else:
+            if date is not None:
+                modified_item['date'] = date
+        elif not api:
             return "Unknown item type."
+        else:
+            return self._dump(False)
 
         modified_item['name'] = self._format_name_reverse(modified_item['name'])
 
-        self._storage.data[list_name][target_index] = modified_item
+        self._storage.replace_item(list_name, target_index, modified_item)
         self._storage.save()
 
         if api:
-            return yaml.dump(True)
+            return self._dump(True)
 
         return "%s \"%s\" modified." % (args[2], self._format_name(args[3]))
 
@@ -235,23 +513,23 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
                 output += "Available types: %s\n" % available_types
                 return output
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
         item_name = self._format_name_reverse(args[3])
         list_name = self._translate_item_type(args[2])
-        target_index = self._find_by_name(self._storage.data[list_name], item_name)
+        target_index = self._find_by_name(list_name, item_name)
 
         if target_index == None:
             if not api:
                 return "Could not find that %s" % args[2]
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
-        del self._storage.data[list_name][target_index]
+        self._storage.delete_item(list_name, target_index)
         self._storage.save()
 
         if api:
-            return yaml.dump(True)
+            return self._dump(True)
 
         return "%s \"%s\" deleted from %s." % (args[2].capitalize(), self._format_name(item_name), self._format_name(list_name))
 
@@ -266,87 +544,158 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
                 output += "Available types: %s\n" % available_types
                 return output
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
         list_name = args[2]
         if list_name == "bills": list_name = "monthly_bills"
 
-        # API support.. spit out pure YAML data
+        # API support.. spit out pure data
         if api:
-            return yaml.dump(self._storage.data[list_name])
+            return self._api_list(list_name, args[3:])
 
         if list_name not in self._storage.data.keys():
             return "That type does not exist."
 
+        # Rendered as it's written out, see _render_list
+        return self._render_list(list_name, args)
+
+    def _list_options(self, args):
+        # [<budget>] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--days N]
+        # [--limit N] [--sort price|name|day|date] [--top N]
+        options = {'budget': None, 'limit': None, 'sort': None, 'top': None, 'from': None, 'to': None}
+
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in ['--limit', '--top']:
+                if not args or not args[0].isdigit():
+                    return None
+                options[arg[2:]] = int(args.pop(0))
+            elif arg == '--sort':
+                if not args or args[0] not in ['price', 'name', 'day', 'date']:
+                    return None
+                options['sort'] = args.pop(0)
+            elif arg in ['--from', '--to', '--days']:
+                if not self._parse_date_option(arg, args, options):
+                    return None
+            elif not arg.startswith('--') and options['budget'] is None:
+                options['budget'] = self._format_name_reverse(arg)
+            else:
+                return None
+
+        return options
+
+    def _list_rows(self, list_name, options):
+        # The items to show, in the order to show them in
+        items = self._storage.data[list_name]
+
+        # Date ranges come straight out of the date index, oldest first
+        if options['from'] is not None or options['to'] is not None:
+            expenses = items
+            positions = self._storage.expenses_between(options['from'], options['to'])
+            if options['budget'] is not None:
+                positions = [position for position in positions if expenses.budget_of(position) == options['budget']]
+            items = (expenses[position] for position in positions)
+
+            # The footer total for the range, straight from the price column
+            options['range_cents'] = sum([expenses.price_cents(position) for position in positions])
+
+        # Expenses filtered by budget only need that budget's rows
+        elif list_name == "expenses" and options['budget'] is not None:
+            expenses = items
+            positions = self._storage.budget_group(options['budget'])['positions']
+            items = (expenses[position] for position in positions)
+            rsbm_profile.count('items_scanned', len(positions))
+        else:
+            rsbm_profile.count('items_scanned', len(items))
+
+        sort = options['sort']
+        if options['top'] is not None:
+            # Biggest first, without sorting the whole list
+            if sort is None:
+                sort = 'price'
+            items = heapq.nlargest(options['top'], items, key=lambda item: item.get(sort, 0))
+        elif sort is not None:
+            items = sorted(items, key=lambda item: item.get(sort, 0))
+
+        if options['limit'] is not None:
+            items = itertools.islice(items, options['limit'])
+
+        return items
+
+    def _render_list(self, list_name, args):
+        # Yields the table line by line, so long lists start printing right
+        # away and are never held as one big string
+        options = self._list_options(args[3:])
+        dated = options is not None and (options['from'] is not None or options['to'] is not None)
+        if options is None or (dated and list_name != "expenses"):
+            yield "Usage: list type [budget] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--days N] [--limit N] [--sort price|name|day|date] [--top N]\n"
+            return
+
         # Headers
         if list_name == "budgets":
-            output += "| %-60s| %-10s| %-11s| %-10s |\n\n" % ("Name", "Budgeted", "Spent", "Available")
+            yield "| %-60s| %-10s| %-11s| %-10s |\n\n" % ("Name", "Budgeted", "Spent", "Available")
         elif list_name == "monthly_bills":
-            output += "| %-2s| %-60s| %-10s| %-4s |\n\n" % ("P", "Name", "Cost", "Day")
+            yield "| %-2s| %-60s| %-10s| %-4s |\n\n" % ("P", "Name", "Cost", "Day")
         elif list_name == "income":
-            output += "| %-2s| %-60s| %-10s |\n\n" % ("P", "Name", "Cost")
+            yield "| %-2s| %-60s| %-10s |\n\n" % ("P", "Name", "Cost")
+        elif list_name == "expenses" and dated:
+            yield "| %-10s | %-30s| %-30s| %-8s|\n\n" % ("Date", "Name", "Budget", "Price")
         elif list_name == "expenses":
-            output += "| %-30s| %-30s| %-8s|\n\n" % ("Name", "Budget", "Price")
+            yield "| %-30s| %-30s| %-8s|\n\n" % ("Name", "Budget", "Price")
 
         if len(self._storage.data[list_name]) == 0:
-            output += "No items\n"
+            yield "No items\n"
 
         # Different list depending on list type
-        total_price = 0
-        for item in self._storage.data[list_name]:
+        for item in self._list_rows(list_name, options):
             if list_name == "budgets":
-                total_spent_in_budget = 0.00
-                for expense in self._storage.data['expenses']:
-                    if expense['budget'] == item['name']:
-                        total_spent_in_budget += expense['price']
+                total_spent_in_budget = self._storage.budget_group(item['name'])['spent']
 
-                output += "| %-60s| $%-9.2f| -$%-9.2f| $%-9.2f |\n" % (self._format_name(item['name']).capitalize(), item['price'], total_spent_in_budget, item['price']-total_spent_in_budget)
-                total_price += item['price']
+                yield "| %-60s| $%-9.2f| -$%-9.2f| $%-9.2f |\n" % (self._format_name(item['name']).capitalize(), item['price'], total_spent_in_budget, item['price']-total_spent_in_budget)
             elif list_name == "monthly_bills":
                 paid_string = "O"
                 if item['paid']: paid_string = "X"
-                output += "| %-2s| %-60s| $%-9.2f| %-4d |\n" % (paid_string, self._format_name(item['name']).capitalize(), item['price'], item['day'])
-                total_price += item['price']
+                yield "| %-2s| %-60s| $%-9.2f| %-4d |\n" % (paid_string, self._format_name(item['name']).capitalize(), item['price'], item['day'])
             elif list_name == "expenses":
-                if len(args) > 3:
-                    if item['budget'] == self._format_name_reverse(args[3]):
-                        output += "| %-60s| $%.2f|\n" % (self._format_name(item['name']).capitalize(), item['price'])
-                        total_price += item['price']
+                if dated:
+                    yield "| %-10s | %-30s| %-30s| $%-6.2f |\n" % (item.get('date', ''), self._format_name(item['name']).capitalize(), self._format_name(item['budget']).capitalize(), item['price'])
+                elif options['budget'] is not None:
+                    yield "| %-60s| $%.2f|\n" % (self._format_name(item['name']).capitalize(), item['price'])
                 else:
-                    output += "| %-30s| %-30s| $%-6.2f |\n" % (self._format_name(item['name']).capitalize(), self._format_name(item['budget']).capitalize(), item['price'])
-                    total_price += item['price']
+                    yield "| %-30s| %-30s| $%-6.2f |\n" % (self._format_name(item['name']).capitalize(), self._format_name(item['budget']).capitalize(), item['price'])
             elif list_name == "income":
                 paid_string = "O"
                 if item['paid']: paid_string = "X"
 
-                output += "| %-2s| %-60s| $%-9.2f |\n" % (paid_string, self._format_name(item['name']).capitalize(), item['price'])
-                total_price += item['price']
+                yield "| %-2s| %-60s| $%-9.2f |\n" % (paid_string, self._format_name(item['name']).capitalize(), item['price'])
 
-        output += "\n"
+        yield "\n"
 
         if len(self._storage.data[list_name]) == 0:
-            return output
+            yield "\n"
+            return
 
-        # Footer
+        # Footer. Totals come from the ledger summary, so they cover the whole
+        # list whatever --limit or --top left out.
+        summary = self._storage.summary
         if list_name == "budgets":
-            total_income = rsbm_calculator.total_price(self._storage.data['income'], only_paid=False)
-            total_current_income = rsbm_calculator.total_price(self._storage.data['income'], only_paid=True)
-            total_bills = rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=False)
-            total_paid_bills = rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=True)
-            total_spent = rsbm_calculator.total_price(self._storage.data['expenses'])
-            total_budgeted = rsbm_calculator.total_price(self._storage.data['budgets'])
-            total_budgetable = rsbm_calculator.total_price(self._storage.data['income'], only_paid=False)-rsbm_calculator.total_price(self._storage.data['monthly_bills'])
-            total_currently_budgetable = rsbm_calculator.total_price(self._storage.data['income'], only_paid=True)-rsbm_calculator.total_price(self._storage.data['monthly_bills'])
+            total_price = summary.budgeted
+            total_spent = summary.spent
+            total_budgeted = summary.budgeted
+            total_budgetable = summary.budgetable()
+            total_currently_budgetable = summary.currently_budgetable()
             overbudgeted = -(total_budgetable-total_price)
             currently_overbudgeted = (-(total_currently_budgetable-total_price))
             overspent = -(total_price-total_spent)
 
             if total_price == 0:
-                return output
+                yield "\n"
+                return
 
-            bank_balance = total_current_income-total_paid_bills-total_spent
+            bank_balance = summary.bank_balance()
 
-            output += "%d%% ($%.2f) of total currently budgetable $%.2f is assigned to budgets." % ((100*(total_price/total_currently_budgetable)), total_price, total_currently_budgetable)
+            output = "%d%% ($%.2f) of total currently budgetable $%.2f is assigned to budgets." % ((100*(total_price/total_currently_budgetable)), total_price, total_currently_budgetable)
             if (currently_overbudgeted >= 1):
                 output += " You've gone $%.2f over the working budget.\n" % currently_overbudgeted
             else:
@@ -370,27 +719,183 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             output += "\n"
             output += "Your current bank balance should be: $%.2f\n" % bank_balance
         elif list_name == "income":
-            output += "Total currently received: $%.2f\n" % rsbm_calculator.total_price(self._storage.data['income'], only_paid=True)
-            output += "Total to still receive: $%.2f\n" % (
-                rsbm_calculator.total_price(self._storage.data['income'], only_paid=False)
-                - rsbm_calculator.total_price(self._storage.data['income'], only_paid=True)
-            )
-            output += "Total expected income: $%.2f\n" % total_price
+            output = "Total currently received: $%.2f\n" % summary.paid_income
+            output += "Total to still receive: $%.2f\n" % (summary.income-summary.paid_income)
+            output += "Total expected income: $%.2f\n" % summary.income
         elif list_name == "monthly_bills":
-            output += "Total paid so far: %.2f\n" % rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=True)
-            output += "Total still to be paid: %.2f\n" % (total_price-rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=True))
-            output += "Total: $%.2f\n" % total_price
+            output = "Total paid so far: %.2f\n" % summary.paid_bills
+            output += "Total still to be paid: %.2f\n" % (summary.bills-summary.paid_bills)
+            output += "Total: $%.2f\n" % summary.bills
+        elif dated:
+            output = "Total: $%.2f\n" % (options['range_cents']/100.0)
+        elif options['budget'] is not None:
+            output = "Total: $%.2f\n" % self._storage.budget_group(options['budget'])['spent']
+        else:
+            output = "Total: $%.2f\n" % summary.spent
+
+        # print() would have ended the output with a newline
+        yield output+"\n"
+
+    def _api_list_options(self, args):
+        # [<budget>] [--where <field><op><value>]... [--from YYYY-MM-DD]
+        # [--to YYYY-MM-DD] [--days N] [--fields a,b] [--offset N] [--limit N]
+        # [--count]
+        options = {'where': [], 'fields': None, 'offset': 0, 'limit': None, 'count': False, 'from': None, 'to': None}
+
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg == '--count':
+                options['count'] = True
+            elif arg in ['--where', '--fields', '--offset', '--limit'] and not args:
+                return None
+            elif arg == '--where':
+                match = re.match(r'^(\w+)(>=|<=|!=|=|>|<)(.*)$', args.pop(0))
+                if match is None:
+                    return None
+                # Prices and days are compared as numbers
+                if match.group(1) in ['price', 'day'] and not self._is_number(match.group(3)):
+                    return None
+                options['where'].append(match.groups())
+            elif arg == '--fields':
+                options['fields'] = args.pop(0).split(',')
+            elif arg in ['--offset', '--limit']:
+                value = args.pop(0)
+                if not value.isdigit():
+                    return None
+                options[arg[2:]] = int(value)
+            elif arg in ['--from', '--to', '--days']:
+                if not self._parse_date_option(arg, args, options):
+                    return None
+            elif not arg.startswith('--'):
+                # Same as 'list expenses <budget>'
+                options['where'].append(('budget', '=', arg))
+            else:
+                return None
+
+        # Names are stored the way _format_name_reverse writes them
+        where = []
+        for field, operator, value in options['where']:
+            if field in ['name', 'budget']:
+                value = self._format_name_reverse(value)
+            where.append((field, operator, value))
+
+        # Dates compare fine as YYYY-MM-DD strings
+        if options['from'] is not None:
+            where.append(('date', '>=', options['from']))
+        if options['to'] is not None:
+            where.append(('date', '<=', options['to']))
+        options['where'] = where
+
+        return options
+
+    def _is_number(self, text):
+        try:
+            float(text)
+        except ValueError:
+            return False
+
+        return True
+
+    def _matches(self, item, where):
+        for field, operator, value in where:
+            if field not in item:
+                return False
+
+            item_value = item[field]
+            if isinstance(item_value, bool):
+                value = value.lower() in ['true', 'yes', '1', 'x']
+            elif isinstance(item_value, (int, float)):
+                value = float(value)
+
+            if operator == '=' and not item_value == value:
+                return False
+            elif operator == '!=' and not item_value != value:
+                return False
+            elif operator == '>' and not item_value > value:
+                return False
+            elif operator == '<' and not item_value < value:
+                return False
+            elif operator == '>=' and not item_value >= value:
+                return False
+            elif operator == '<=' and not item_value <= value:
+                return False
+
+        return True
+
+    def _candidates(self, list_name, where):
+        # Narrows the rows down with an index when the filter allows it, then
+        # checks the remaining conditions row by row
+        items = self._storage.data[list_name]
+
+        # Date ranges bisect the date index
+        if list_name == 'expenses':
+            first = None
+            last = None
+            for field, operator, value in where:
+                if field != 'date':
+                    continue
+                if operator in ['>=', '>', '='] and (first is None or value > first):
+                    first = value
+                if operator in ['<=', '<', '='] and (last is None or value < last):
+                    last = value
+
+            if first is not None or last is not None:
+                return [items[position] for position in self._storage.expenses_between(first, last)]
+
+        for field, operator, value in where:
+            if operator != '=':
+                continue
+            if field == 'budget' and list_name == 'expenses':
+                return [items[position] for position in self._storage.budget_group(value)['positions']]
+            if field == 'name':
+                return [items[position] for position in self._storage.find_all(list_name, value)]
+
+        return items
+
+    def _api_list(self, list_name, args):
+        if list_name not in self._storage.data:
+            return self._dump(False)
+
+        options = self._api_list_options(args)
+        if options is None:
+            return self._dump(False)
+
+        where = options['where']
+
+        if options['count']:
+            if not where:
+                return self._dump(len(self._storage.data[list_name]))
+            if list_name == 'expenses' and where == [('budget', '=', where[0][2])]:
+                return self._dump(self._storage.budget_group(where[0][2])['count'])
+
+        candidates = self._candidates(list_name, where)
+        rsbm_profile.count('items_scanned', len(candidates))
+
+        rows = (item for item in candidates if self._matches(item, where))
+
+        if options['count']:
+            return self._dump(sum([1 for item in rows]))
+
+        stop = None
+        if options['limit'] is not None:
+            stop = options['offset']+options['limit']
+        rows = itertools.islice(rows, options['offset'], stop)
+
+        fields = options['fields']
+        if fields is None:
+            rows = (item for item in rows)
         else:
-            output += "Total: $%.2f\n" % total_price
+            rows = (dict([(field, item[field]) for field in fields if field in item]) for item in rows)
 
-        return output
+        return self._dump(rows)
 
     def check(self, args, api=False):
         if len(args) <= 3:
             if not api:
                 return "Usage: check income/bill <name>"
             else :
-                return yaml.dump(False)
+                return self._dump(False)
 
         target_category = ''
         if args[2] == 'bill':
@@ -401,19 +906,24 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             if not api:
                 return "That is not a bill or income source."
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
-        target_index = self._find_by_name(self._storage.data[target_category], self._format_name_reverse(args[3]))
+        target_index = self._find_by_name(target_category, self._format_name_reverse(args[3]))
 
         if target_index == None:
-            return "Could not find that bill."
+            if not api:
+                return "Could not find that bill."
+            else:
+                return self._dump(False)
 
 
-        self._storage.data[target_category][target_index]['paid'] = True
+        checked_item = dict(self._storage.data[target_category][target_index])
+        checked_item['paid'] = True
+        self._storage.replace_item(target_category, target_index, checked_item)
         self._storage.save()
 
         if api:
-            return yaml.dump(True)
+            return self._dump(True)
 
         return "%s \"%s\" marked as paid." % (args[2], args[3])
 
@@ -422,7 +932,7 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             if not api:
                 return "Usage: check income/bill <name>"
             else :
-                return yaml.dump(False)
+                return self._dump(False)
 
         target_category = ''
         if args[2] == 'bill':
@@ -433,22 +943,24 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
             if not api:
                 return "That is not a bill or income source."
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
-        target_index = self._find_by_name(self._storage.data[target_category], self._format_name_reverse(args[3]))
+        target_index = self._find_by_name(target_category, self._format_name_reverse(args[3]))
 
         if target_index == None:
             if not api:
                 return "Could not find that bill."
             else:
-                return yaml.dump(False)
+                return self._dump(False)
 
 
-        self._storage.data[target_category][target_index]['paid'] = False
+        checked_item = dict(self._storage.data[target_category][target_index])
+        checked_item['paid'] = False
+        self._storage.replace_item(target_category, target_index, checked_item)
         self._storage.save()
 
         if api:
-            return yaml.dump(True)
+            return self._dump(True)
 
         return "%s \"%s\" marked as not paid." % (args[2], args[3])
 
@@ -457,15 +969,16 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
     def bank_balance(self, args, api=False):
         output = ""
 
-        total_current_income = float(rsbm_calculator.total_price(self._storage.data['income'], only_paid=True))
-        total_paid_bills = rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=True)
-        total_spent = rsbm_calculator.total_price(self._storage.data['expenses'])
+        summary = self._storage.summary
+        total_current_income = summary.paid_income
+        total_paid_bills = summary.paid_bills
+        total_spent = summary.spent
 
-        bank_balance = total_current_income-total_paid_bills-total_spent
+        bank_balance = summary.bank_balance()
 
         if api:
             formatted_balance = "%.2f" % (bank_balance)
-            return yaml.dump(float(formatted_balance))
+            return self._dump(float(formatted_balance))
 
         output += "BANK BALANCE CALCULATION\n"
         output += "Your bank balance should match the outcome of this calculation.\n"
@@ -476,18 +989,29 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
 
         return output
 
-    def status(self, args):
+    def status(self, args, api=False):
         output = ""
 
-        total_current_income = rsbm_calculator.total_price(self._storage.data['income'], only_paid=True)
-        total_bills = rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=False)
-        total_paid_bills = rsbm_calculator.total_price(self._storage.data['monthly_bills'], only_paid=True)
-        total_spent = rsbm_calculator.total_price(self._storage.data['expenses'])
-        total_budgeted = rsbm_calculator.total_price(self._storage.data['budgets'])
-        total_budgetable = rsbm_calculator.total_price(self._storage.data['income'], only_paid=False)-rsbm_calculator.total_price(self._storage.data['monthly_bills'])
-        total_currently_budgetable = rsbm_calculator.total_price(self._storage.data['income'], only_paid=True)-rsbm_calculator.total_price(self._storage.data['monthly_bills'])
+        summary = self._storage.summary
+        total_current_income = summary.paid_income
+        total_paid_bills = summary.paid_bills
+        total_spent = summary.spent
+        total_budgeted = summary.budgeted
+        total_budgetable = summary.budgetable()
+        total_currently_budgetable = summary.currently_budgetable()
 
-        bank_balance = total_current_income-total_paid_bills-total_spent
+        bank_balance = summary.bank_balance()
+
+        if api:
+            return self._dump({
+                'received_income': total_current_income,
+                'paid_bills': total_paid_bills,
+                'spent': total_spent,
+                'budgeted': total_budgeted,
+                'budgetable': total_budgetable,
+                'currently_budgetable': total_currently_budgetable,
+                'bank_balance': bank_balance,
+            })
 
         output += "Total money spent (includes bills):\n  Bills total at $%.2f\n  Total $%.2f spent out of received income $%.2f\n" % (
             total_paid_bills,
@@ -507,30 +1031,490 @@ class MainInterpreter(rsbm_interpreter.BaseInterpreter):
 
         return output
 
+    def cache(self, args, api=False):
+        import rsbm_storage
+
+        # The numbers are for this process. When nothing has been loaded yet
+        # (a one-off 'rsbm cache'), the ledger is loaded now so there's a
+        # load to report on.
+        if not rsbm_storage.LOAD_STATS['loads']:
+            data = self._storage.data
+            for list_name in data.keys():
+                data[list_name]
+
+        stats = rsbm_storage.load_stats()
+        if self._pool is not None:
+            stats['pool'] = self._pool.stats()
+        if self._report_cache is not None:
+            stats['reports'] = self._report_cache.stats()
+
+        if api:
+            return self._dump(stats)
+
+        output = ""
+        output += "LEDGER LOAD CACHE\n"
+        output += self._separator
+        output += "Last load: %s in %.2fms\n" % (stats['last_load_source'], stats['last_load_seconds']*1000)
+        output += "Cache hits: %d, misses: %d (%d%% hit rate)\n" % (stats['cache_hits'], stats['cache_misses'], 100*stats['cache_hit_rate'])
+        output += "Total load time: %.2fms over %d loads\n" % (stats['load_seconds']*1000, stats['loads'])
+
+        if self._pool is not None:
+            pool = stats['pool']
+            output += "\nLEDGER POOL\n"
+            output += self._separator
+            output += "Loaded: %d of %d ledgers, %.1fMB of %.1fMB\n" % (pool['ledgers'], pool['max_ledgers'], pool['bytes']/1e6, pool['max_bytes']/1e6)
+            output += "Hits: %d, misses: %d (%d%% hit rate)\n" % (pool['hits'], pool['misses'], 100*pool['hit_rate'])
+            output += "Evictions: %d, saves: %d (%d failed)\n" % (pool['evictions'], pool['flushes'], pool['flush_failures'])
+
+        if self._report_cache is not None:
+            reports = stats['reports']
+            output += "\nREPORT CACHE\n"
+            output += self._separator
+            output += "Stored: %d of %d reports, %.1fkB of %.1fkB\n" % (reports['entries'], reports['max_entries'], reports['bytes']/1e3, reports['max_bytes']/1e3)
+
+        return output
+
+    def serve(self, args):
+        # Keeps this ledger loaded and answers 'rsbm api' calls until stopped
+        try:
+            import rsbm_server
+        except (ImportError, SyntaxError):
+            return "The rsbm server needs Python 3."
+
+        return rsbm_server.serve(self._storage)
+
+    def shell(self, args):
+        # Keeps this ledger loaded and runs the commands typed in until exit,
+        # see rsbm_shell
+        import rsbm_shell
+        return rsbm_shell.Shell(self._storage).run()
+
+    def batch(self, args, api=False):
+        # Runs one api command per line from a file (or stdin) against a
+        # single loaded ledger, saving once at the end. The results come
+        # back in the api format, whether or not batch was run as api.
+        # Usage: batch [file] [--strict]
+        strict = '--strict' in args
+        paths = [arg for arg in args[2:] if arg != '--strict']
+
+        source = sys.stdin
+        if paths and paths[0] != '-':
+            source = open(paths[0], 'r')
+
+        # Read up front: if another process saves while the batch runs, the
+        # whole batch is run again on its data, and stdin can't be re-read
+        try:
+            lines = source.readlines()
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        api_format = self._api_format
+        self._api_format = 'raw'
+
+        attempt = 0
+        try:
+            while True:
+                try:
+                    results, aborted = self._run_batch(lines, strict)
+                    break
+                except Exception as e:
+                    if not self._is_stale(e) or attempt >= CONFIG['stale_retries']:
+                        raise
+
+                attempt += 1
+                self._stale_backoff(attempt)
+                self._storage.rollback()
+        finally:
+            self._api_format = api_format
+
+        return self._dump({
+            'ok': not aborted and all([result['ok'] for result in results]),
+            'saved': not aborted,
+            'results': results,
+        })
+
+    def _run_batch(self, lines, strict):
+        results = []
+        try:
+            with self._storage.transaction():
+                for line in lines:
+                    words = shlex.split(line, comments=True)
+                    if not words:
+                        continue
+                    if words[0] == 'api':
+                        words = words[1:]
+
+                    result = self._batch_command(words)
+                    results.append(result)
+
+                    # Strict batches are all or nothing
+                    if strict and not result['ok']:
+                        raise BatchAborted()
+        except BatchAborted:
+            return results, True
+
+        return results, False
+
+    def _batch_command(self, words):
+        result = {'command': ' '.join(words)}
+
+        if not words or words[0] in ['batch', 'serve', 'shell', 'api']:
+            result['ok'] = False
+            result['error'] = "Command not allowed in a batch"
+            return result
+
+        try:
+            value = self.api(['rsbm', 'api']+words)
+        except Exception as e:
+            result['ok'] = False
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+            return result
+
+        # Api commands answer with values; text is a usage or error message
+        # some command gave back instead
+        if isinstance(value, type('')) or isinstance(value, type(u'')):
+            result['ok'] = False
+            result['error'] = value
+            return result
+
+        result['ok'] = value is not False
+        result['result'] = value
+
+        return result
+
+    def import_statement(self, args, api=False):
+        # Usage: import <statement.csv> [--rules <rules.yaml>]
+        if len(args) <= 2:
+            if not api:
+                return "Usage: import <statement.csv> [--rules <rules.yaml>]"
+            else:
+                return self._dump(False)
+
+        import rsbm_import
+
+        rules_path = None
+        if '--rules' in args:
+            if args.index('--rules')+1 >= len(args):
+                if not api:
+                    return "Usage: import <statement.csv> [--rules <rules.yaml>]"
+                else:
+                    return self._dump(False)
+
+            rules_path = args[args.index('--rules')+1]
+
+        options = rsbm_import.load_options(rules_path)
+        stats = rsbm_import.import_statement(self._storage, args[2], options, self._format_name_reverse)
+
+        if api:
+            return self._dump(stats)
+
+        return "Imported %d expenses and %d income items, skipped %d duplicates." % (stats['expenses'], stats['income'], stats['duplicates'])
+
+    # -------------
+
+    def history(self, args, api=False):
+        # Usage: history [months], history <YYYY-MM>, history rebuild
+        import rsbm_history
+
+        if len(args) > 2 and args[2] == 'rebuild':
+            month_count = rsbm_history.rebuild(self._storage.path)
+            if api:
+                return self._dump(month_count)
+            return "Archive rebuilt from %d monthly backups." % month_count
+
+        if len(args) > 2 and '-' in args[2]:
+            return self._history_month(args[2], api)
+
+        month_count = 12
+        if len(args) > 2:
+            if not args[2].isdigit():
+                if not api:
+                    return "Usage: history [months], history <YYYY-MM>, history rebuild"
+                else:
+                    return self._dump(False)
+
+            month_count = int(args[2])
+
+        months = rsbm_history.last_months(self._storage.path, month_count)
+
+        if api:
+            return self._dump(months)
+
+        output = ""
+        output += "| %-8s| %-11s| %-11s| %-11s| %-11s| %-11s |\n\n" % ("Month", "Income", "Bills", "Budgeted", "Spent", "Left over")
+        if not months:
+            output += "No months archived yet\n"
+
+        for month in months:
+            output += "| %-8s| $%-10.2f| $%-10.2f| $%-10.2f| $%-10.2f| $%-10.2f |\n" % (
+                month['month'], month['income'], month['bills'], month['budgeted'], month['spent'],
+                month['paid_income']-month['paid_bills']-month['spent']
+            )
+
+        return output
+
+    def _history_month(self, month_name, api=False):
+        import rsbm_history
+
+        month = rsbm_history.find_month(self._storage.path, month_name)
+        if month is None:
+            if not api:
+                return "That month is not in the archive."
+            else:
+                return self._dump(False)
+
+        if api:
+            return self._dump(month)
+
+        output = ""
+        output += "| %-60s| %-10s| %-11s| %-10s |\n\n" % ("Budget", "Budgeted", "Spent", "Available")
+        for budget_name in sorted(month['budgets'].keys()):
+            budget = month['budgets'][budget_name]
+            output += "| %-60s| $%-9.2f| -$%-9.2f| $%-9.2f |\n" % (self._format_name(budget_name).capitalize(), budget['budgeted'], budget['spent'], budget['budgeted']-budget['spent'])
+
+        output += "\n"
+        output += "Income $%.2f, bills $%.2f, spent $%.2f\n" % (month['income'], month['bills'], month['spent'])
+
+        return output
+
+    def backup(self, args, api=False):
+        # Usage: backup [list], backup restore <YYYY-MM> [file],
+        # backup convert [--remove]
+        import rsbm_backup
+
+        action = 'list'
+        if len(args) > 2:
+            action = args[2]
+
+        if action == 'list':
+            months = rsbm_backup.months(self._storage.path)
+            if api:
+                return self._dump(months)
+
+            if not months:
+                return "No months backed up yet."
+
+            return "Backed up months: %s (%.1fkB)" % (', '.join(months), rsbm_backup.size(self._storage.path)/1000.0)
+        elif action == 'restore' and len(args) > 3:
+            month = args[3]
+            file_path = self._storage.path+"current_month_"+month+".yaml"
+            if len(args) > 4:
+                file_path = args[4]
+
+            data = rsbm_backup.restore_month(self._storage.path, month)
+            if data is None:
+                if not api:
+                    return "That month has not been backed up."
+                else:
+                    return self._dump(False)
+
+            if os.path.exists(file_path):
+                if not api:
+                    return "%s already exists, restore to another file." % file_path
+                else:
+                    return self._dump(False)
+
+            rsbm_backup.write_ledger(file_path, data)
+
+            if api:
+                return self._dump(True)
+            return "%s restored to %s" % (month, file_path)
+        elif action == 'convert':
+            stats = rsbm_backup.convert(self._storage.path, '--remove' in args)
+            if api:
+                return self._dump(stats)
+
+            output = "Converted %d YAML backups, %d were backed up already.\n" % (stats['converted'], stats['skipped'])
+            if stats['removed']:
+                output += "Removed %d YAML backups (%.1fkB), the archive takes %.1fkB.\n" % (stats['removed'], stats['yaml_bytes']/1000.0, rsbm_backup.size(self._storage.path)/1000.0)
+            return output
+
+        if not api:
+            return "Usage: backup [list], backup restore <YYYY-MM> [file], backup convert [--remove]"
+        else:
+            return self._dump(False)
+
+    def trend(self, args, api=False):
+        # Usage: trend <budget> [months], trend bills [months]
+        if len(args) <= 2:
+            if not api:
+                return "Usage: trend <budget>/bills [months]"
+            else:
+                return self._dump(False)
+
+        import rsbm_history
+
+        month_count = 12
+        if len(args) > 3:
+            if not args[3].isdigit():
+                if not api:
+                    return "Usage: trend <budget>/bills [months]"
+                else:
+                    return self._dump(False)
+
+            month_count = int(args[3])
+
+        months = rsbm_history.last_months(self._storage.path, month_count)
+
+        target = self._format_name_reverse(args[2])
+        points = []
+        for month in months:
+            if target == 'bills':
+                value = month['bills']
+            else:
+                value = month['budgets'].get(target, {'spent': 0.00})['spent']
+            points.append({'month': month['month'], 'value': value})
+
+        if api:
+            return self._dump(points)
+
+        column = "Spent"
+        if target == 'bills':
+            column = "Bills"
+
+        output = ""
+        output += "| %-8s| %-11s| %-8s |\n\n" % ("Month", column, "Change")
+        if not points:
+            output += "No months archived yet\n"
+
+        previous = None
+        for point in points:
+            change = ""
+            if previous:
+                change = "%+d%%" % (100*(point['value']-previous)/previous)
+            output += "| %-8s| $%-10.2f| %-8s |\n" % (point['month'], point['value'], change)
+            previous = point['value']
+
+        if len(points) > 1:
+            output += "\n"
+            output += "Average $%.2f a month over %d months\n" % (sum([point['value'] for point in points])/len(points), len(points))
+
+        return output
+
+    def forecast(self, args, api=False):
+        # Usage: forecast [months] [--daily]
+        import datetime
+        import rsbm_forecast
+
+        daily = '--daily' in args
+        args = [arg for arg in args if arg != '--daily']
+
+        months = CONFIG['forecast_months']
+        if len(args) > 2:
+            if not args[2].isdigit() or int(args[2]) > rsbm_forecast.MAX_MONTHS:
+                if not api:
+                    return "Usage: forecast [months] [--daily], up to %d months" % rsbm_forecast.MAX_MONTHS
+                else:
+                    return self._dump(False)
+            months = int(args[2])
+
+        spent = {}
+        for budget_name, group in self._storage.budget_groups.items():
+            spent[budget_name] = group['cents']
+
+        balance = rsbm_forecast.to_cents(self._storage.summary.bank_balance())
+        forecast = rsbm_forecast.Forecast(self._storage.data, spent, balance, months=months)
+
+        if daily:
+            days = forecast.daily()
+            if api:
+                return self._dump(({'date': day.isoformat(), 'balance': cents/100.0} for day, cents in days))
+            return ("| %s | $%-10.2f |\n" % (day.isoformat(), cents/100.0) for day, cents in days)
+
+        payday = forecast.next_payday()
+        before_payday = None
+        if payday is not None and payday > forecast.today:
+            before_payday = forecast.lowest(payday-datetime.timedelta(days=1))
+        first_negative = forecast.first_below(0)
+        lowest = forecast.lowest()
+
+        summaries = forecast.month_summaries()
+
+        if api:
+            def low(point):
+                if point is None:
+                    return None
+                return {'balance': point[0]/100.0, 'date': point[1].isoformat()}
+
+            return self._dump({
+                'months': [{
+                    'month': summary['month'],
+                    'opening': summary['opening']/100.0,
+                    'lowest': low((summary['lowest'], summary['lowest_on'])),
+                    'closing': summary['closing']/100.0,
+                } for summary in summaries],
+                'monthly_change': forecast.monthly_net/100.0,
+                'next_payday': payday and payday.isoformat(),
+                'lowest_before_payday': low(before_payday),
+                'lowest': low(lowest),
+                'first_negative': first_negative and first_negative.isoformat(),
+            })
+
+        output = ""
+        output += "CASH FLOW FORECAST\n"
+        output += "Income and bills on their day of the month, budgets spent evenly.\n"
+        output += self._separator
+        output += "| %-8s| %-11s| %-11s| %-11s| %-11s |\n\n" % ("Month", "Opening", "Lowest", "On", "Closing")
+        for summary in summaries:
+            output += "| %-8s| $%-10.2f| $%-10.2f| %-11s| $%-10.2f |\n" % (
+                summary['month'], summary['opening']/100.0, summary['lowest']/100.0, summary['lowest_on'].isoformat(), summary['closing']/100.0
+            )
+
+        output += "\n"
+        output += "Every month after this one changes the balance by $%.2f\n" % (forecast.monthly_net/100.0)
+        if before_payday is not None:
+            output += "Lowest balance before payday (%s): $%.2f on %s\n" % (payday.isoformat(), before_payday[0]/100.0, before_payday[1].isoformat())
+        output += "Lowest balance: $%.2f on %s\n" % (lowest[0]/100.0, lowest[1].isoformat())
+        if first_negative is not None:
+            output += "The balance first goes negative on %s\n" % first_negative.isoformat()
+        else:
+            output += "The balance stays positive through %s\n" % forecast.end.isoformat()
+
+        return output
+
     # -------------
 
     def next_month(self, args):
         # Back up the current data according to the month
+        import datetime
+
+        import rsbm_backup
 
-        date_string = datetime.date.today().strftime("%B_%Y").lower()
-        backup_file_path = CONFIG['path']+"rsbm_"+date_string+".yaml"
+        month = datetime.date.today().strftime("%Y-%m")
 
-        if os.path.exists(backup_file_path):
+        # Older versions made full YAML copies, rsbm_<month>_<year>.yaml
+        if rsbm_backup.has_month(self._storage.path, month) or month in dict(rsbm_backup.yaml_backups(self._storage.path)):
             return "A backup of this month has already been made! If you are sure, delete that backup."
 
-        with open(backup_file_path, 'w') as f:
-            f.write(yaml.dump(self._storage.data))
+        import rsbm_history
+        import rsbm_storage
+
+        # The backup is made before anything is cleared, so a backup that
+        # fails leaves the month as it was. If the cleared month is then
+        # never saved (another process saved first and the command runs
+        # again on the fresh data), the backup goes again with it. The
+        # trend archive can be rebuilt from backups, and is only added to
+        # once the cleared month is saved.
+        data = rsbm_storage.plain_ledger(self._storage.data)
+        path = self._storage.path
+
+        rsbm_backup.backup_month(path, month, data)
+        self._storage.on_rollback(lambda: rsbm_backup.remove_month(path, month))
+        self._storage.after_save(lambda: rsbm_history.archive_month(path, month, data))
 
         for key in self._storage.data.keys():
             # Data to clear
             if key in ['expenses']:
-                self._storage.data[key] = []
+                self._storage.clear_list(key)
 
             # Data to reset paid flag for
             if key in ['monthly_bills', 'income']:
                 index = 0
                 for item in self._storage.data[key]:
-                    self._storage.data[key][index]['paid'] = False
+                    unpaid_item = dict(item)
+                    unpaid_item['paid'] = False
+                    self._storage.replace_item(key, index, unpaid_item)
                     index += 1
 
         self._storage.save()
@@ -0,0 +1,138 @@
+# Opt-in instrumentation for finding out where a command spends its time.
+#
+# Turned on with --profile (or RSBM_PROFILE=1). Records wall time per phase
+# (import, load, dispatch, compute, render, save) and counters like items
+# scanned, index lookups and bytes written, and reports them on stderr when
+# the command is done:
+#
+#   --profile               text summary on stderr
+#   --profile=json          the same as JSON on stderr
+#   --profile=<file.json>   JSON written to that file
+#   --cprofile=<file>       also dump cProfile stats there (RSBM_CPROFILE)
+#
+# Phases nest: a phase's own time excludes the phases that ran inside it.
+# When profiling is off, phase() hands out one shared do-nothing context
+# manager and count() returns straight away.
+
+import os
+import sys
+import time
+import json
+
+ENABLED = False
+OUTPUT = None
+CPROFILE_PATH = None
+
+PHASES = {}
+COUNTERS = {}
+
+_stack = []
+_start_time = time.time()
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._start_time = time.time()
+        self._nested_seconds = 0.00
+        _stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time()-self._start_time
+        _stack.pop()
+        if _stack:
+            _stack[-1]._nested_seconds += seconds
+
+        phase = PHASES.setdefault(self._name, {'calls': 0, 'seconds': 0.00, 'self_seconds': 0.00})
+        phase['calls'] += 1
+        phase['self_seconds'] += seconds-self._nested_seconds
+
+        # A phase inside one of the same name is already in its total
+        if not [outer for outer in _stack if outer._name == self._name]:
+            phase['seconds'] += seconds
+
+        return False
+
+def phase(name):
+    if not ENABLED:
+        return _NULL_PHASE
+
+    return _Phase(name)
+
+def count(name, amount=1):
+    if ENABLED:
+        COUNTERS[name] = COUNTERS.get(name, 0)+amount
+
+# -------------
+
+def configure(argv):
+    # Picks up the environment and the profiling flags, returns argv with
+    # the flags taken out
+    global ENABLED, OUTPUT, CPROFILE_PATH
+
+    setting = os.environ.get('RSBM_PROFILE')
+    CPROFILE_PATH = os.environ.get('RSBM_CPROFILE') or None
+
+    remaining = []
+    for arg in argv:
+        if arg == '--profile':
+            setting = '1'
+        elif arg.startswith('--profile='):
+            setting = arg[len('--profile='):]
+        elif arg.startswith('--cprofile='):
+            CPROFILE_PATH = arg[len('--cprofile='):]
+        else:
+            remaining.append(arg)
+
+    if setting and setting != '0':
+        ENABLED = True
+        if setting not in ['1', 'text']:
+            OUTPUT = setting
+    elif CPROFILE_PATH:
+        ENABLED = True
+
+    return remaining
+
+def summary():
+    return {
+        'total_seconds': time.time()-_start_time,
+        'phases': PHASES,
+        'counters': COUNTERS,
+    }
+
+def report():
+    if not ENABLED:
+        return
+
+    results = summary()
+
+    if OUTPUT == 'json':
+        sys.stderr.write(json.dumps(results, sort_keys=True)+"\n")
+        return
+    elif OUTPUT is not None:
+        with open(OUTPUT, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True)+"\n")
+        return
+
+    output = "PROFILE (%.2fms total)\n" % (results['total_seconds']*1000)
+    output += "%-12s %6s %12s %12s\n" % ("Phase", "Calls", "Total", "Own")
+    for name in sorted(PHASES.keys(), key=lambda name: -PHASES[name]['self_seconds']):
+        phase = PHASES[name]
+        output += "%-12s %6d %10.2fms %10.2fms\n" % (name, phase['calls'], phase['seconds']*1000, phase['self_seconds']*1000)
+    for name in sorted(COUNTERS.keys()):
+        output += "%-25s %d\n" % (name, COUNTERS[name])
+    if CPROFILE_PATH:
+        output += "cProfile stats written to %s\n" % CPROFILE_PATH
+
+    sys.stderr.write(output)
@@ -0,0 +1,189 @@
+# Reports kept on disk between runs.
+#
+# Monitoring asks for the same status, bank and list reports over and over
+# while the ledger sits unchanged. The first time a report is made, what it
+# printed is stored under reports/, keyed by the command line, today's date
+# (for --days) and the ledger's version: something the backend changes with
+# every save and can tell without loading the ledger (see version() on the
+# backends). Asking again before the next save gets the same output back
+# without loading the ledger or working anything out.
+#
+# One file per report. A hit touches the file, and past
+# CONFIG['report_cache_max_entries'] files or CONFIG['report_cache_max_bytes']
+# the least recently used are removed. Reports on older versions of the
+# ledger can never be hit again, so they're the first to go.
+#
+# Only meant for rsbm runs that do one command and exit: a ledger that's
+# kept loaded (shell, server, batch) can have changes that aren't saved yet,
+# and answers from memory quickly anyway.
+
+import os
+import types
+import hashlib
+import datetime
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import rsbm_profile
+from config import *
+
+# Bumped whenever what gets stored changes shape
+REPORT_CACHE_FORMAT = 1
+
+def _replay(text):
+    # Streamed reports come back streamed, in one chunk
+    yield text
+
+class ReportCache(object):
+    def __init__(self, ledger_id=None, max_entries=None, max_bytes=None):
+        if max_entries is None:
+            max_entries = CONFIG['report_cache_max_entries']
+        if max_bytes is None:
+            max_bytes = CONFIG['report_cache_max_bytes']
+
+        self._ledger_id = ledger_id
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+    def _backend(self):
+        # rsbm_storage (and yaml) only get imported once a report is asked for
+        import rsbm_storage
+        return rsbm_storage.open_backend(rsbm_storage.ledger_path(self._ledger_id))
+
+    def _reports_path(self, backend):
+        return backend.path+'reports/'
+
+    # -------------
+
+    def report(self, args, make):
+        # The output of the command in args, from the cache if it's there.
+        # make() runs the command when it isn't.
+        backend = self._backend()
+
+        # Read before the ledger is, so a save in between only means the
+        # report is stored under a version that's already gone
+        version = backend.version()
+        if version is None:
+            return make()
+
+        key = (REPORT_CACHE_FORMAT, version, datetime.date.today().isoformat(), tuple(args[1:]))
+        entry_path = self._reports_path(backend)+hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+        entry = self._read(entry_path, key)
+        if entry is not None:
+            rsbm_profile.count('report_cache_hits')
+            kind, output = entry
+            if kind == 'chunks':
+                return _replay(output)
+            return output
+
+        rsbm_profile.count('report_cache_misses')
+        output = make()
+        if isinstance(output, types.GeneratorType):
+            return self._stream(entry_path, key, output)
+
+        self._store(entry_path, key, ('value', output))
+        return output
+
+    def _stream(self, entry_path, key, chunks):
+        # Passes a streamed report on as it's rendered, and stores it once
+        # it's all been written out, unless it's too big to keep
+        collected = []
+        size = 0
+        for chunk in chunks:
+            if collected is not None:
+                collected.append(chunk)
+                size += len(chunk)
+                if size > self._max_bytes:
+                    collected = None
+
+            yield chunk
+
+        if collected is not None:
+            self._store(entry_path, key, ('chunks', ''.join(collected)))
+
+    def _read(self, entry_path, key):
+        # (kind, output), or None when there's no such report
+        try:
+            with open(entry_path, 'rb') as f:
+                if pickle.load(f) != key:
+                    return None
+
+                entry = pickle.load(f)
+        except Exception:
+            return None
+
+        # Most recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        return entry
+
+    def _store(self, entry_path, key, entry):
+        import rsbm_storage
+
+        contents = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)+pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if len(contents) > self._max_bytes:
+            return
+
+        # Caching is best effort, a report that can't be stored is just
+        # made again next time
+        try:
+            if not os.path.exists(os.path.dirname(entry_path)):
+                os.makedirs(os.path.dirname(entry_path))
+
+            rsbm_storage.atomic_write(entry_path, contents, mode='wb')
+            self._evict(os.path.dirname(entry_path)+'/')
+        except (IOError, OSError):
+            pass
+
+    def _entries(self, reports_path):
+        # [(mtime, size, path)] of every stored report, least recently used
+        # first
+        if not os.path.exists(reports_path):
+            return []
+
+        entries = []
+        for file_name in os.listdir(reports_path):
+            # Another process's store in progress
+            if file_name.endswith('.tmp'):
+                continue
+
+            try:
+                stat = os.stat(reports_path+file_name)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, reports_path+file_name))
+
+        entries.sort()
+        return entries
+
+    def _evict(self, reports_path):
+        entries = self._entries(reports_path)
+        total = sum([size for mtime, size, entry_path in entries])
+
+        while entries and (len(entries) > self._max_entries or total > self._max_bytes):
+            mtime, size, entry_path = entries.pop(0)
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total -= size
+
+    # -------------
+
+    def stats(self):
+        entries = self._entries(self._reports_path(self._backend()))
+
+        return {
+            'entries': len(entries),
+            'bytes': sum([size for mtime, size, entry_path in entries]),
+            'max_entries': self._max_entries,
+            'max_bytes': self._max_bytes,
+        }
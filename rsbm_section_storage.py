@@ -0,0 +1,276 @@
+# Sectioned YAML storage backend. Every list is a file of its own, next to a
+# small header saying which file is current for each list and what is in it:
+#
+#   sections/header.yaml         the generation, and per list the generation
+#                                of its file, its item count and totals
+#   sections/expenses.12.yaml    one list, as of generation 12
+#
+# Lists are only parsed once something uses them (see
+# rsbm_storage.LazyLedger), and the totals status and bank report on come
+# straight from the header, so those don't read any list at all. A save
+# writes the lists that changed to new files and then the header; the header
+# going in is what makes the save happen, and the files it points at always
+# belong together. Files the header no longer points at are removed
+# afterwards. A process that loaded an older header has its files mapped
+# already, so it can still read the lists it hasn't parsed yet.
+#
+# The first load splits current_month.yaml (journal included) up into
+# sections, and leaves it where it is.
+
+import os
+import mmap
+import time
+import yaml
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import rsbm_calculator
+import rsbm_profile
+import rsbm_storage
+from config import *
+
+# Bumped whenever the header changes shape
+SECTIONS_FORMAT = 1
+
+def _section_totals(items):
+    # What the header keeps for a list: its length and totals in cents
+    totals = {'count': len(items), 'cents': 0, 'paid_cents': 0}
+
+    # A column store adds itself up
+    if hasattr(items, 'total_cents'):
+        totals['cents'] = items.total_cents()
+        return totals
+
+    for item in items:
+        price = rsbm_calculator.to_cents(item['price'])
+        totals['cents'] += price
+        if item.get('paid'):
+            totals['paid_cents'] += price
+
+    return totals
+
+class SectionBackend(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = CONFIG['path']
+
+        self.path = path
+        self._sections_path = path+'sections/'
+        self._header_path = self._sections_path+'header.yaml'
+        # Not rsbm.lock, the YAML backend takes that one itself while it's
+        # being migrated
+        self._lock_path = self._sections_path+'sections.lock'
+
+        # The generation of the header we loaded (or last wrote), and its
+        # {list: {'generation', 'count', 'cents', 'paid_cents'}}
+        self._generation = 0
+        self._sections = {}
+
+    def exists(self):
+        return os.path.exists(self._header_path)
+
+    def _disk_generation(self):
+        return rsbm_storage._read_generation(rsbm_storage._read_first_line(self._header_path) or b'')
+
+    def _file_name(self, list_name, generation):
+        return "%s.%d.yaml" % (list_name, generation)
+
+    def _cache_name(self, list_name, generation):
+        return "%s.%d.cache" % (list_name, generation)
+
+    # -------------
+
+    def load(self, read_only=False):
+        # Nothing to read, and a read doesn't create anything
+        if read_only and not self.exists() and not rsbm_storage.YamlBackend(self.path).exists():
+            self._generation = 0
+            self._sections = {}
+            return rsbm_storage.empty_ledger()
+
+        # A ledger that still needs splitting up gets that done even for a
+        # read, once
+        if not self.exists():
+            self.migrate()
+
+        with rsbm_storage.file_lock(self._lock_path, create=not read_only):
+            return self._load(read_only)
+
+    def _load(self, read_only=False):
+        with open(self._header_path, 'rb') as f:
+            contents = f.read()
+        rsbm_profile.count('bytes_read', len(contents))
+
+        header = yaml.load(contents, Loader=rsbm_storage.Loader)
+        if header['format'] > SECTIONS_FORMAT:
+            raise Exception("%s was written by a newer rsbm." % self._header_path)
+
+        self._generation = rsbm_storage._read_generation(contents)
+        self._sections = header['sections']
+
+        # Every list's file is mapped now, while the lock keeps it in place,
+        # but only parsed once it's used
+        mapped = {}
+        for list_name, section in self._sections.items():
+            with open(self._sections_path+self._file_name(list_name, section['generation']), 'rb') as f:
+                mapped[list_name] = (section['generation'], mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        def loader(list_name):
+            generation, contents = mapped.pop(list_name)
+            try:
+                return self._read_section(list_name, generation, contents, read_only)
+            finally:
+                contents.close()
+
+        return rsbm_storage.LazyLedger(sorted(self._sections.keys()), loader)
+
+    def _read_section(self, list_name, generation, contents, read_only=False):
+        start_time = time.time()
+
+        items = None
+        source = 'yaml'
+        if CONFIG['load_cache']:
+            items = self._read_cache(list_name, generation)
+            if items is not None:
+                source = 'cache'
+
+        if items is None:
+            rsbm_profile.count('bytes_read', len(contents))
+            items = yaml.load(contents[:], Loader=rsbm_storage.Loader)
+            if CONFIG['load_cache'] and not read_only:
+                self._write_cache(list_name, generation, items)
+
+        rsbm_storage.count_load(source, time.time()-start_time)
+
+        return items
+
+    def _read_cache(self, list_name, generation):
+        # Section files never change once written, so a cache only has to be
+        # for the right one
+        try:
+            with open(self._sections_path+self._cache_name(list_name, generation), 'rb') as f:
+                if pickle.load(f) != (rsbm_storage.CACHE_FORMAT, self._file_name(list_name, generation)):
+                    return None
+
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _write_cache(self, list_name, generation, items):
+        cache_key = (rsbm_storage.CACHE_FORMAT, self._file_name(list_name, generation))
+        contents = pickle.dumps(cache_key, pickle.HIGHEST_PROTOCOL)+pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+        try:
+            rsbm_storage.atomic_write(self._sections_path+self._cache_name(list_name, generation), contents, mode='wb')
+        except (IOError, OSError):
+            pass
+
+    # -------------
+
+    def _check_version(self):
+        if self._disk_generation() != self._generation:
+            raise rsbm_storage.StaleVersion("%s was saved by another process" % self._header_path)
+
+    def version(self):
+        # Every save writes a new header, see rsbm_report_cache
+        with rsbm_storage.file_lock(self._lock_path, create=False):
+            try:
+                stat = os.stat(self._header_path)
+            except OSError:
+                return None
+
+            return ('sections', self._disk_generation(), stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def _write(self, data, list_names):
+        # Writes list_names to new section files and then the header that
+        # points at them. Needs the exclusive lock.
+        generation = self._generation+1
+
+        sections = dict(self._sections)
+        for list_name in list_names:
+            items = data[list_name]
+            rsbm_storage.atomic_write(self._sections_path+self._file_name(list_name, generation), yaml.dump(list(items), Dumper=rsbm_storage.Dumper))
+
+            sections[list_name] = _section_totals(items)
+            sections[list_name]['generation'] = generation
+
+            # So the next load doesn't parse it again
+            if CONFIG['load_cache']:
+                self._write_cache(list_name, generation, items)
+
+        header = {'format': SECTIONS_FORMAT, 'sections': sections}
+        rsbm_storage.atomic_write(self._header_path, "# rsbm-generation: %d\n%s" % (generation, yaml.dump(header, Dumper=rsbm_storage.Dumper)))
+
+        self._generation = generation
+        self._sections = sections
+
+        self._remove_unused()
+
+    def _remove_unused(self):
+        # Removes the files the header doesn't point at: lists that have been
+        # saved again since, and whatever a save that never finished left
+        keep = set(['header.yaml', 'sections.lock'])
+        for list_name, section in self._sections.items():
+            keep.add(self._file_name(list_name, section['generation']))
+            keep.add(self._cache_name(list_name, section['generation']))
+
+        for file_name in os.listdir(self._sections_path):
+            if file_name in keep:
+                continue
+
+            try:
+                os.remove(self._sections_path+file_name)
+            except OSError:
+                pass
+
+    def commit(self, data, records):
+        with rsbm_storage.file_lock(self._lock_path, exclusive=True):
+            self._check_version()
+
+            # Only the lists something happened to
+            self._write(data, sorted(set([record['list'] for record in records])))
+
+    def compact(self, data):
+        # Lists are rewritten whole whenever they change, all there is to
+        # tidy up is what's left behind
+        with rsbm_storage.file_lock(self._lock_path, exclusive=True):
+            self._check_version()
+            self._remove_unused()
+
+    def migrate(self):
+        # Splits current_month.yaml up into sections, or starts off empty
+        # when there isn't one
+        if not os.path.exists(self._sections_path):
+            os.makedirs(self._sections_path)
+
+        with rsbm_storage.file_lock(self._lock_path, exclusive=True):
+            if self.exists():
+                return
+
+            data = rsbm_storage.YamlBackend(self.path).load(read_only=True)
+
+            self._generation = 0
+            self._sections = {}
+            self._write(data, sorted(data.keys()))
+
+    # -------------
+
+    def summary(self):
+        # Straight from the header, without reading a single list
+        def section(list_name):
+            return self._sections.get(list_name, {'cents': 0, 'paid_cents': 0})
+
+        summary = rsbm_calculator.LedgerSummary()
+        summary.income = section('income')['cents']/100.0
+        summary.paid_income = section('income')['paid_cents']/100.0
+        summary.bills = section('monthly_bills')['cents']/100.0
+        summary.paid_bills = section('monthly_bills')['paid_cents']/100.0
+        summary.spent = section('expenses')['cents']/100.0
+        summary.budgeted = section('budgets')['cents']/100.0
+
+        return summary
+
+    # The header has no per-budget totals, let StorageManager add them up
+    def budget_totals(self):
+        return None
@@ -0,0 +1,233 @@
+# Long-running rsbm server. Keeps the ledger loaded and answers commands
+# sent by rsbm_client over a Unix domain socket, one JSON request per line:
+#
+#   {"args": ["rsbm", "api", "list", "expenses"]}  ->  {"output": "..."}
+#   {"args": [...], "ledger": "smith"}               (one of many ledgers)
+#
+# Only api commands are served, and not those that read stdin or run a loop
+# of their own (see REFUSED_COMMANDS). Clients are served concurrently.
+# Commands run one at a time on the event loop, and the writes of every
+# mutation that arrives within CONFIG['group_commit_ms'] of each other are
+# saved together. A mutating client only gets its answer once that save is
+# done. If another rsbm process
+# saved the ledger in the meantime, the group's commands are run again on the
+# fresh data before saving.
+#
+# Ledgers are kept loaded in a rsbm_storage.LedgerPool, so only the first
+# request for a ledger (or one that has been evicted since) reads it from
+# disk.
+#
+# Needs Python 3 (asyncio).
+
+import os
+import json
+import datetime
+import types
+import asyncio
+import collections
+
+import rsbm_main_interpreter
+import rsbm_storage
+from config import *
+
+# Api commands that don't belong in a server: they read stdin or would run a
+# loop of their own inside this one
+REFUSED_COMMANDS = ['serve', 'shell', 'batch']
+
+class Server(object):
+    def __init__(self, storage=None, socket_path=None, pool=None):
+        if socket_path is None:
+            socket_path = CONFIG['server_socket']
+        if pool is None:
+            pool = rsbm_storage.LedgerPool(self._open_ledger)
+
+        self._socket_path = socket_path
+        self._pool = pool
+
+        self._commit_waiters = []
+        self._commit_handle = None
+
+        # The ledger 'rsbm serve' was started on answers requests without one
+        if storage is not None:
+            storage.begin()
+            self._pool.add(None, storage)
+
+    def _open_ledger(self, ledger_id):
+        storage = rsbm_storage.open_ledger(ledger_id)
+
+        # Saves stay held between group commits
+        storage.begin()
+
+        return storage
+
+    def _execute(self, storage, args, date):
+        try:
+            interpreter = rsbm_main_interpreter.MainInterpreter(storage, pool=self._pool)
+            output = interpreter.interpret(args, date)
+            if isinstance(output, types.GeneratorType):
+                return {'output': ''.join(output), 'stream': True}
+
+            return {'output': output}
+        except Exception as e:
+            return {'error': "%s: %s" % (type(e).__name__, e)}
+
+    def _wait_for_commit(self, storage, args, date, response):
+        # Resolves to the command's response once its writes are saved
+        loop = asyncio.get_event_loop()
+
+        waiter = loop.create_future()
+        self._commit_waiters.append((waiter, storage, args, date, response))
+
+        if self._commit_handle is None:
+            self._commit_handle = loop.call_later(CONFIG['group_commit_ms']/1000.0, self._group_commit)
+
+        return waiter
+
+    def _group_commit(self):
+        self._commit_handle = None
+
+        waiters = self._commit_waiters
+        self._commit_waiters = []
+
+        # One save per ledger written to
+        groups = collections.OrderedDict()
+        for waiter, storage, args, date, response in waiters:
+            groups.setdefault(id(storage), (storage, []))[1].append((waiter, args, date, response))
+
+        for storage, group in groups.values():
+            self._commit(storage, group)
+
+    def _commit(self, storage, waiters):
+        attempt = 0
+        try:
+            while True:
+                try:
+                    storage.commit()
+                    break
+                except rsbm_storage.StaleVersion:
+                    if attempt >= CONFIG['stale_retries']:
+                        raise
+
+                # Somebody else saved first, redo the group on top of that
+                attempt += 1
+                storage.rollback()
+                storage.begin()
+                waiters = [(waiter, args, date, self._execute(storage, args, date)) for waiter, args, date, response in waiters]
+        except Exception as e:
+            # Nothing in this group made it to disk, so none of it stays
+            storage.rollback()
+            for waiter, args, date, response in waiters:
+                waiter.set_exception(e)
+        else:
+            for waiter, args, date, response in waiters:
+                waiter.set_result(response)
+        finally:
+            storage.begin()
+
+    def _discard(self, storage):
+        # Throws away what a failed command changed before it failed: the
+        # ledger goes back to what's saved, and the commands still waiting
+        # for its group commit are run again on top of that
+        storage.rollback()
+        storage.begin()
+
+        waiters = []
+        for waiter, waiting_storage, args, date, response in self._commit_waiters:
+            if waiting_storage is storage:
+                response = self._execute(storage, args, date)
+            waiters.append((waiter, waiting_storage, args, date, response))
+        self._commit_waiters = waiters
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    args = request['args']
+                    ledger_id = request.get('ledger')
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    response = {'error': "Malformed request"}
+                else:
+                    response = await self._respond(args, ledger_id)
+
+                writer.write((json.dumps(response)+'\n').encode('utf-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _allowed(self, args):
+        # Only 'rsbm api ...' commands are served, like rsbm.py only sends
+        # those
+        if not isinstance(args, list) or args[1:2] != ['api']:
+            return False
+
+        command = rsbm_main_interpreter.command_name(args)
+        return command is not None and command not in REFUSED_COMMANDS
+
+    async def _respond(self, args, ledger_id):
+        if not self._allowed(args):
+            return {'error': "Only api commands other than %s can be sent to the server" % ', '.join(REFUSED_COMMANDS)}
+
+        try:
+            storage = self._pool.get(ledger_id)
+        except Exception as e:
+            return {'error': "%s: %s" % (type(e).__name__, e)}
+
+        # Run again after a stale save, the command still goes by the day
+        # it came in
+        date = datetime.date.today().isoformat()
+
+        changes = storage.changes
+        response = self._execute(storage, args, date)
+
+        # A command that failed halfway doesn't get to commit what it did
+        if 'error' in response and storage.changes != changes:
+            self._discard(storage)
+            return response
+
+        # Only commands that changed the ledger wait for it to be saved,
+        # and it stays loaded until then
+        if storage.changes > changes:
+            self._pool.pin(ledger_id)
+            try:
+                response = await self._wait_for_commit(storage, args, date, response)
+            except Exception as e:
+                response = {'error': "Save failed: %s" % e}
+            finally:
+                self._pool.unpin(ledger_id)
+
+        return response
+
+    async def serve_forever(self):
+        # A socket left behind by a server that didn't shut down cleanly
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        server = await asyncio.start_unix_server(self._handle, path=self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+            self._pool.flush()
+
+def serve(storage=None, socket_path=None):
+    server = Server(storage, socket_path)
+
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+    return "Server stopped."
+
+if __name__ == '__main__':
+    print(serve())
@@ -0,0 +1,319 @@
+# Interactive rsbm shell. Loads the ledger once and runs one rsbm command per
+# line against it, printing what the one-shot CLI would have printed:
+#
+#   $ rsbm shell
+#   rsbm> add expense coffee 3.5 eating_out
+#   New expense "coffee" added to expenses
+#   rsbm> save
+#   Saved.
+#
+# Writes are held back and saved together on 'save', on exit ('exit', 'quit'
+# or Ctrl-D) and once the shell has sat idle for
+# CONFIG['shell_autosave_seconds']. If another rsbm process saved the ledger
+# in the meantime, the commands that changed it since our last save are run
+# again on top of that, the way the server does it. Tab completes commands,
+# types and item names where readline is available.
+
+import os
+import sys
+import types
+import datetime
+import shlex
+import threading
+
+try:
+    import readline
+except ImportError:
+    readline = None
+
+import rsbm_interpreter
+import rsbm_main_interpreter
+import rsbm_storage
+from config import *
+
+try:
+    input = raw_input
+except NameError:
+    pass
+
+ITEM_TYPES = ['income', 'budget', 'bill', 'expense']
+
+# The shell's own commands, next to the rsbm ones
+SHELL_COMMANDS = ['save', 'help', 'exit', 'quit']
+
+class Shell(rsbm_interpreter.BaseInterpreter):
+    def __init__(self, storage=None, stdin=None, stdout=None):
+        super(Shell, self).__init__()
+
+        if storage is None:
+            storage = rsbm_storage.StorageManager()
+
+        self._storage = storage
+        self._interpreter = rsbm_main_interpreter.MainInterpreter(storage)
+        self._stdin = stdin or sys.stdin
+        self._stdout = stdout or sys.stdout
+
+        # Every rsbm command except the ones that would start another loop
+        # of their own, plus the shell's own
+        self._funcmap = dict(self._interpreter._funcmap)
+        for command in ['shell', 'serve', 'batch']:
+            self._funcmap.pop(command, None)
+        self._funcmap.update({
+            'save': self.save,
+            'help': self.help,
+            'exit': self.exit,
+            'quit': self.exit,
+        })
+
+        commands = sorted(self._funcmap.keys())
+        self._helpmsg = "Commands: %s" % ', '.join(commands)
+
+        # Commands and the idle save take turns on the ledger
+        self._lock = threading.Lock()
+        self._idle_timer = None
+        self._running = False
+
+        # Lines that changed the ledger since the last save, to run again
+        # if another process saved first
+        self._unsaved = []
+
+        self._completions = []
+
+        # Saves stay held until the shell flushes them
+        self._storage.begin()
+
+    # -------------
+
+    def run(self):
+        self._running = True
+        interactive = self._stdin.isatty()
+
+        if interactive and readline is not None:
+            self._setup_readline()
+
+        try:
+            while self._running:
+                try:
+                    line = self._read_line(interactive)
+                except KeyboardInterrupt:
+                    # Drops the line being typed, like other shells do
+                    self._stdout.write("\n")
+                    continue
+                except EOFError:
+                    if interactive:
+                        self._stdout.write("\n")
+                    break
+
+                self.run_line(line)
+        finally:
+            self._cancel_idle_save()
+
+            with self._lock:
+                try:
+                    self._flush()
+                except Exception as e:
+                    sys.stderr.write("Could not save: %s: %s\n" % (type(e).__name__, e))
+
+            if interactive and readline is not None:
+                self._save_history()
+
+        return None
+
+    def _read_line(self, interactive):
+        if not interactive:
+            line = self._stdin.readline()
+            if not line:
+                raise EOFError()
+            return line
+
+        return input("rsbm> ")
+
+    def run_line(self, line):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            self._stdout.write("%s\n" % e)
+            return
+
+        if not words:
+            return
+
+        self._cancel_idle_save()
+
+        # Run again after a stale save, the line still goes by the day it
+        # was typed
+        date = datetime.date.today().isoformat()
+
+        with self._lock:
+            changes = self._storage.changes
+            try:
+                self._write(self._run(words, date))
+            except Exception as e:
+                self._stdout.write("Error: %s: %s\n" % (type(e).__name__, e))
+
+            if self._storage.changes > changes:
+                self._unsaved.append((words, date))
+
+            if self._unsaved:
+                self._schedule_idle_save()
+
+        self._stdout.flush()
+
+    def _run(self, words, date):
+        # rsbm commands run as of date (YYYY-MM-DD), the day the line was
+        # typed
+        if words[0] in SHELL_COMMANDS or words[0] not in self._funcmap:
+            return self.interpret(['rsbm']+words)
+
+        return self._interpreter.interpret(['rsbm']+words, date)
+
+    def _write(self, output):
+        # Same as rsbm.py writes a command's output
+        if output is False:
+            output = "Unknown command, 'help' lists them."
+
+        if isinstance(output, types.GeneratorType):
+            for chunk in output:
+                self._stdout.write(chunk)
+        elif output not in [True, None]:
+            self._stdout.write("%s\n" % output)
+
+    # -------------
+
+    def _flush(self):
+        # Saves everything held since the last save. Needs self._lock.
+        if not self._unsaved:
+            return False
+
+        attempt = 0
+        try:
+            while True:
+                try:
+                    self._storage.commit()
+                    break
+                except rsbm_storage.StaleVersion:
+                    if attempt >= CONFIG['stale_retries']:
+                        raise
+
+                # Somebody else saved first, redo our changes on top of that
+                attempt += 1
+                self._storage.rollback()
+                self._storage.begin()
+                for words, date in self._unsaved:
+                    output = self._run(words, date)
+                    if isinstance(output, types.GeneratorType):
+                        for chunk in output:
+                            pass
+        finally:
+            self._storage.begin()
+
+        self._unsaved = []
+        return True
+
+    def _schedule_idle_save(self):
+        seconds = CONFIG['shell_autosave_seconds']
+        if not seconds:
+            return
+
+        self._idle_timer = threading.Timer(seconds, self._idle_save)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _cancel_idle_save(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _idle_save(self):
+        with self._lock:
+            try:
+                self._flush()
+            except Exception as e:
+                sys.stderr.write("\nCould not save: %s: %s\n" % (type(e).__name__, e))
+
+    # -------------
+
+    def _history_path(self):
+        return os.path.join(self._storage.path, 'shell_history')
+
+    def _setup_readline(self):
+        readline.set_completer(self.complete)
+        readline.set_completer_delims(" \t\n\"'")
+        readline.parse_and_bind("tab: complete")
+
+        if os.path.exists(self._history_path()):
+            try:
+                readline.read_history_file(self._history_path())
+            except IOError:
+                pass
+
+    def _save_history(self):
+        try:
+            readline.write_history_file(self._history_path())
+        except IOError:
+            pass
+
+    def complete(self, text, state):
+        # readline asks for match number state until it gets None back
+        if state == 0:
+            words = readline.get_line_buffer()[:readline.get_begidx()].split()
+            with self._lock:
+                candidates = self.candidates(words)
+            self._completions = sorted([candidate for candidate in candidates if candidate.startswith(text)])
+
+        if state < len(self._completions):
+            return self._completions[state]
+
+        return None
+
+    def candidates(self, words):
+        # What can come after words: commands, item types or item names
+        if words and words[0] == 'api':
+            words = words[1:]
+            if words and words[0] == '--format':
+                words = words[2:]
+
+        if not words:
+            return self._funcmap.keys()
+
+        command = words[0]
+        data = self._storage.data
+
+        if len(words) == 1:
+            if command in ['add', 'set', 'del']:
+                return ITEM_TYPES
+            elif command in ['check', 'uncheck']:
+                return ['bill', 'income']
+            elif command == 'list':
+                return [list_name for list_name in data.keys() if list_name != 'monthly_bills']+['bills']
+            return []
+
+        if len(words) == 2:
+            if command in ['add', 'set', 'del', 'check', 'uncheck']:
+                list_name = self._interpreter._translate_item_type(words[1])
+                if list_name and command != 'add':
+                    return self._storage.names(list_name)
+            elif command == 'list' and words[1] == 'expenses':
+                return self._storage.names('budgets')
+            return []
+
+        # add/set expense <name> <price> <budget>
+        if len(words) == 4 and command in ['add', 'set'] and words[1] == 'expense':
+            return self._storage.names('budgets')
+
+        return []
+
+    # -------------
+
+    def save(self, args):
+        if self._flush():
+            return "Saved."
+
+        return "Nothing to save."
+
+    def help(self, args):
+        return self._helpmsg
+
+    def exit(self, args):
+        self._running = False
+        return None
@@ -0,0 +1,262 @@
+# SQLite storage backend. Every list item is a row in one indexed table, so
+# totals and per-budget sums come straight out of SQL and each save is a
+# single transaction.
+
+import os
+import time
+import sqlite3
+
+import rsbm_calculator
+import rsbm_storage
+from config import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    list TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    price REAL NOT NULL DEFAULT 0,
+    budget TEXT,
+    day INTEGER,
+    paid INTEGER,
+    date TEXT
+);
+CREATE INDEX IF NOT EXISTS items_position ON items (list, position);
+CREATE INDEX IF NOT EXISTS items_name ON items (list, name);
+CREATE INDEX IF NOT EXISTS items_budget ON items (list, budget);
+"""
+
+# PRAGMA user_version of an up to date database. 1 had no date column, 2
+# copied the old monthly backups into an archive table nothing read.
+SCHEMA_VERSION = 3
+
+def _row_values(item):
+    paid = item.get('paid')
+    if paid is not None:
+        paid = int(bool(paid))
+
+    return (item['name'], float(item['price']), item.get('budget'), item.get('day'), paid, item.get('date'))
+
+def _row_item(row):
+    # Only keep the fields this kind of item actually has
+    name, price, budget, day, paid, date = row
+
+    item = {'name': name, 'price': price}
+    if budget is not None:
+        item['budget'] = budget
+    if day is not None:
+        item['day'] = day
+    if paid is not None:
+        item['paid'] = bool(paid)
+    if date is not None:
+        item['date'] = date
+
+    return item
+
+class SqliteBackend(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = CONFIG['path']
+
+        self.path = path
+        self._db_path = path+'rsbm.sqlite3'
+        self._conn = None
+
+        # PRAGMA data_version as of our last load, it changes whenever
+        # another connection commits
+        self._version = None
+
+    def exists(self):
+        return os.path.exists(self._db_path)
+
+    def _connect(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self._conn = sqlite3.connect(self._db_path)
+        # Plain str on both Python 2 and 3, so YAML output stays clean
+        self._conn.text_factory = str
+
+        # Only one process sets up the database. (Not rsbm.lock, the YAML
+        # backend takes that one itself while it's being migrated.)
+        with rsbm_storage.file_lock(self._db_path+'.lock', exclusive=True):
+            self._conn.executescript(SCHEMA)
+
+            # user_version is set in the same transaction as the import, so an
+            # interrupted migration simply runs again
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                self.migrate()
+            elif version < SCHEMA_VERSION:
+                self.upgrade()
+
+    def _connect_read_only(self):
+        # Opens the database without creating or migrating anything. Returns
+        # False if it has to be set up first.
+        if not os.path.exists(self._db_path):
+            return False
+
+        try:
+            import urllib.parse
+            self._conn = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(self._db_path), uri=True)
+        except ImportError:
+            # Python 2's sqlite3 can't open read-only, but connecting and
+            # selecting doesn't write anything either
+            self._conn = sqlite3.connect(self._db_path)
+        self._conn.text_factory = str
+
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._conn.close()
+            self._conn = None
+            return False
+
+        return True
+
+    def load(self, read_only=False):
+        start_time = time.time()
+
+        # Nothing to read, and a read doesn't create anything
+        if read_only and self._conn is None and not os.path.exists(self.path):
+            return rsbm_storage.empty_ledger()
+
+        # A database that still needs setting up gets that done even for a
+        # read, once
+        if self._conn is None and not (read_only and self._connect_read_only()):
+            self._connect()
+
+        # Read before the rows, so a save that sneaks in between only causes
+        # a needless retry rather than a lost one
+        self._version = self._data_version()
+
+        data = rsbm_storage.empty_ledger()
+        cursor = self._conn.execute("SELECT list, name, price, budget, day, paid, date FROM items ORDER BY list, position")
+        for row in cursor:
+            data.setdefault(row[0], []).append(_row_item(row[1:]))
+
+        rsbm_storage.count_load('sqlite', time.time()-start_time)
+
+        return data
+
+    # -------------
+
+    def _insert(self, list_name, position, item):
+        self._conn.execute(
+            "INSERT INTO items (list, position, name, price, budget, day, paid, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (list_name, position)+_row_values(item)
+        )
+
+    def _apply(self, record):
+        list_name = record['list']
+        op = record['op']
+
+        if op == 'add':
+            position = self._conn.execute("SELECT COALESCE(MAX(position)+1, 0) FROM items WHERE list = ?", (list_name,)).fetchone()[0]
+            self._insert(list_name, position, record['item'])
+        elif op == 'set':
+            self._conn.execute(
+                "UPDATE items SET name = ?, price = ?, budget = ?, day = ?, paid = ?, date = ? WHERE list = ? AND position = ?",
+                _row_values(record['item'])+(list_name, record['position'])
+            )
+        elif op == 'del':
+            self._conn.execute("DELETE FROM items WHERE list = ? AND position = ?", (list_name, record['position']))
+            self._conn.execute("UPDATE items SET position = position-1 WHERE list = ? AND position > ?", (list_name, record['position']))
+        elif op == 'clear':
+            self._conn.execute("DELETE FROM items WHERE list = ?", (list_name,))
+        elif op == 'fill' and record['field'] == 'date':
+            self._conn.execute("UPDATE items SET date = ? WHERE list = ? AND date IS NULL", (record['value'], list_name))
+        else:
+            raise Exception("Unknown journal record %s" % op)
+
+    def _data_version(self):
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def version(self):
+        # SQLite bumps the file change counter in the database header with
+        # every commit, see rsbm_report_cache
+        try:
+            with open(self._db_path, 'rb') as f:
+                change_counter = f.read(28)[24:]
+                stat = os.fstat(f.fileno())
+        except (IOError, OSError):
+            return None
+
+        return ('sqlite', change_counter, stat.st_mtime, stat.st_size)
+
+    def commit(self, data, records):
+        # One transaction per save, rolled back if any statement fails.
+        # BEGIN IMMEDIATE takes SQLite's write lock before the version check,
+        # so nobody can commit between the check and our writes.
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._data_version() != self._version:
+                raise rsbm_storage.StaleVersion("%s was saved by another process" % self._db_path)
+
+            for record in records:
+                self._apply(record)
+
+    def compact(self, data):
+        self._conn.execute("VACUUM")
+
+    # -------------
+
+    def summary(self):
+        row = self._conn.execute("""
+            SELECT
+                COALESCE(SUM(CASE WHEN list = 'income' THEN price END), 0),
+                COALESCE(SUM(CASE WHEN list = 'income' AND paid THEN price END), 0),
+                COALESCE(SUM(CASE WHEN list = 'monthly_bills' THEN price END), 0),
+                COALESCE(SUM(CASE WHEN list = 'monthly_bills' AND paid THEN price END), 0),
+                COALESCE(SUM(CASE WHEN list = 'expenses' THEN price END), 0),
+                COALESCE(SUM(CASE WHEN list = 'budgets' THEN price END), 0)
+            FROM items
+        """).fetchone()
+
+        summary = rsbm_calculator.LedgerSummary()
+        summary.income, summary.paid_income, summary.bills, summary.paid_bills, summary.spent, summary.budgeted = row
+
+        return summary
+
+    def budget_totals(self):
+        # {budget: (cents, count)} for the expenses, added up by SQLite
+        totals = {}
+        cursor = self._conn.execute("SELECT budget, SUM(CAST(ROUND(price*100) AS INTEGER)), COUNT(*) FROM items WHERE list = 'expenses' GROUP BY budget")
+        for budget_name, cents, count in cursor:
+            totals[budget_name] = (int(cents), count)
+        return totals
+
+    # -------------
+
+    def migrate(self):
+        # One-shot import of current_month.yaml. The rsbm_<month>_<year>.yaml
+        # backups made by next_month stay where they are; history and trend
+        # read them through the archive in rsbm_history, which is built from
+        # them here if there isn't one yet.
+        yaml_backend = rsbm_storage.YamlBackend(self.path)
+
+        with self._conn:
+            if yaml_backend.exists():
+                data = yaml_backend.load()
+                for list_name in data.keys():
+                    position = 0
+                    for item in data[list_name]:
+                        self._insert(list_name, position, item)
+                        position += 1
+
+            self._conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+        import rsbm_backup
+        import rsbm_history
+        if not rsbm_history.load_index(self.path)['months'] and rsbm_backup.yaml_backups(self.path):
+            rsbm_history.rebuild(self.path)
+
+    def upgrade(self):
+        # Brings a database made by an older version up to SCHEMA_VERSION
+        with self._conn:
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(items)")]
+            if 'date' not in columns:
+                self._conn.execute("ALTER TABLE items ADD COLUMN date TEXT")
+
+            # Only ever a copy of the backups, which are still there
+            self._conn.execute("DROP TABLE IF EXISTS archive")
+
+            self._conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
@@ -1,35 +1,1260 @@
 # This module handles the saving and loading of data for use by the program
 
 import os
+import re
+import mmap
+import time
+import datetime
+import tempfile
+import contextlib
+import bisect
+import hashlib
+import zlib
+import collections
 import yaml
 
+try:
+    import fcntl
+except ImportError:
+    # No flock() on this platform, processes just aren't kept apart
+    fcntl = None
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import rsbm_calculator
+import rsbm_columns
+import rsbm_profile
 from config import *
 
-class StorageManager():
-    def __init__(self):
-        self.data = []
-        init_data = {
-            'income': [],
-            'budgets': [],
-            'expenses': [],
-            'monthly_bills': [],
-        }
+# libyaml's C implementation is many times faster, use it when PyYAML was
+# built with it
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# How loads went in this process, see load_stats()
+LOAD_STATS = {
+    'cache_hits': 0,
+    'cache_misses': 0,
+    'loads': 0,
+    'load_seconds': 0.00,
+    'last_load_source': None,
+    'last_load_seconds': 0.00,
+}
+
+# Rough memory taken by one income, budget or bill dict, see footprint()
+ITEM_BYTES = 400
+
+class StaleVersion(Exception):
+    # Another process saved the ledger after we loaded it. Whatever we were
+    # about to save was based on old data, so nothing got written.
+    pass
+
+def _remove_position(positions, position):
+    del positions[bisect.bisect_left(positions, position)]
+
+def _shift_position(positions, position):
+    # Moves an item's recorded position one up after a deletion
+    positions[bisect.bisect_left(positions, position)] = position-1
+
+def _copy_list(items):
+    # Items are never changed in place, only replaced, so copying the list
+    # is enough
+    if isinstance(items, rsbm_columns.ExpenseColumns):
+        return items.copy()
+
+    return list(items)
+
+def empty_ledger():
+    return {
+        'income': [],
+        'budgets': [],
+        'expenses': [],
+        'monthly_bills': [],
+    }
+
+def plain_ledger(data):
+    # The ledger as plain lists of dicts, the way it's written to YAML
+    plain = {}
+    for list_name in data.keys():
+        plain[list_name] = list(data[list_name])
+
+    return plain
+
+class LazyLedger(object):
+    # A ledger whose lists are only read in when something first uses them.
+    # loader(list_name) returns a list's items; on_load, when set, is called
+    # with the list's name right after it has been read in.
+    def __init__(self, list_names, loader):
+        self._list_names = list(list_names)
+        self._loader = loader
+        self._lists = {}
+        self.on_load = None
+
+    def keys(self):
+        return list(self._list_names)
+
+    def loaded_keys(self):
+        return [list_name for list_name in self._list_names if list_name in self._lists]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._list_names)
+
+    def __contains__(self, list_name):
+        return list_name in self._list_names
+
+    def __getitem__(self, list_name):
+        if list_name not in self._lists:
+            if list_name not in self._list_names:
+                raise KeyError(list_name)
+
+            self._lists[list_name] = self._loader(list_name)
+            if self.on_load is not None:
+                self.on_load(list_name)
+
+        return self._lists[list_name]
+
+    def __setitem__(self, list_name, items):
+        if list_name not in self._list_names:
+            self._list_names.append(list_name)
+
+        self._lists[list_name] = items
+
+    def items(self):
+        return [(list_name, self[list_name]) for list_name in self._list_names]
+
+    def values(self):
+        return [self[list_name] for list_name in self._list_names]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+def apply_record(data, record):
+    # Replays one saved mutation against plain ledger data
+    op = record['op']
+    if op == 'add':
+        data[record['list']].append(record['item'])
+    elif op == 'set':
+        data[record['list']][record['position']] = record['item']
+    elif op == 'del':
+        del data[record['list']][record['position']]
+    elif op == 'clear':
+        data[record['list']] = []
+    elif op == 'fill':
+        # Gives every item that lacks the field the same value for it
+        items = data[record['list']]
+        if record['field'] == 'date' and hasattr(items, 'fill_dates'):
+            items.fill_dates(record['value'])
+        else:
+            for item in items:
+                item.setdefault(record['field'], record['value'])
+    else:
+        raise Exception("Unknown journal record %s" % op)
+
+def to_bytes(contents):
+    if isinstance(contents, bytes):
+        return contents
+
+    return contents.encode('utf-8')
+
+# Bumped whenever what gets pickled into the cache changes shape, so caches
+# written by older versions are ignored
+CACHE_FORMAT = 3
+
+def _cache_key(stat, contents):
+    return (CACHE_FORMAT, stat.st_mtime, stat.st_size, hashlib.sha1(contents).hexdigest())
+
+def count_load(source, seconds):
+    LOAD_STATS['loads'] += 1
+    LOAD_STATS['load_seconds'] += seconds
+    LOAD_STATS['last_load_source'] = source
+    LOAD_STATS['last_load_seconds'] = seconds
+
+    if source == 'cache':
+        LOAD_STATS['cache_hits'] += 1
+    elif source == 'yaml':
+        LOAD_STATS['cache_misses'] += 1
+
+def load_stats():
+    stats = dict(LOAD_STATS)
+
+    lookups = stats['cache_hits']+stats['cache_misses']
+    stats['cache_hit_rate'] = 0.00
+    if lookups:
+        stats['cache_hit_rate'] = float(stats['cache_hits'])/lookups
+
+    return stats
+
+def atomic_write(path, contents, mode='w'):
+    # Writes to a temporary file next to the target and renames it into
+    # place, so readers only ever see the old or the new file. Every write
+    # gets its own temporary file, so processes can't clobber each other's.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path)+'.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp_path, path)
+        rsbm_profile.count('bytes_written', len(contents))
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    _fsync_dir(os.path.dirname(path))
+
+@contextlib.contextmanager
+def file_lock(path, exclusive=False, create=True):
+    # flock() on a lock file next to the ledger: any number of readers share
+    # it, a writer has it to itself. Without create, a lock file that isn't
+    # there yet isn't made, and nothing gets locked.
+    if fcntl is None or (not create and not os.path.exists(path)):
+        yield
+        return
+
+    if create:
+        f = open(path, 'a')
+    else:
+        f = open(path, 'r')
+    try:
+        if exclusive:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+
+        yield
+    finally:
+        # Closing the file releases the lock
+        f.close()
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _read_first_line(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return f.readline()
+
+def _read_generation(contents):
+    # Snapshots and journals start with a "# rsbm-generation: N" comment
+    first_line = contents.split(b'\n', 1)[0]
+    if not first_line.startswith(b'# rsbm-generation:'):
+        return 0
+
+    return int(first_line.split(b':', 1)[1])
+
+def _snapshot_contents(data, generation):
+    return "# rsbm-generation: %d\n%s" % (generation, yaml.dump(plain_ledger(data), Dumper=Dumper))
+
+# Journals of format 2 and up end every save with a commit line, see
+# _journal_group(). Older ones are taken as they are and folded into the
+# snapshot on the next save.
+JOURNAL_FORMAT = 2
+
+def _journal_header(generation):
+    return "# rsbm-generation: %d\n# rsbm-journal-format: %d\n" % (generation, JOURNAL_FORMAT)
+
+def _journal_format(contents):
+    lines = contents.split(b'\n', 2)
+    if len(lines) < 2 or not lines[1].startswith(b'# rsbm-journal-format:'):
+        return 1
+
+    return int(lines[1].split(b':', 1)[1])
+
+def _journal_line(record):
+    # Every record is a one-line YAML sequence entry, so the whole journal
+    # parses as a single list
+    return "- %s\n" % yaml.dump(record, Dumper=Dumper, default_flow_style=True, width=2**31-1).strip()
+
+def _journal_checksum(contents):
+    return zlib.crc32(contents) & 0xffffffff
+
+def _journal_group(records):
+    # One save's records followed by a commit line with how many there are
+    # and their checksum. The commit line is a YAML comment, so the journal
+    # still parses as a single list.
+    contents = ''.join([_journal_line(record) for record in records])
+    return "%s# commit %d %08x\n" % (contents, len(records), _journal_checksum(to_bytes(contents)))
+
+def _committed_journal(contents):
+    # How much of a journal is whole saves: every save from the start
+    # whose commit line matches the records before it. A save cut short by
+    # a crash (or still being written, for a reader) is left out whole, and
+    # so is anything after it.
+    start = contents.find(b'\n', contents.find(b'\n')+1)+1
+    committed = start
+
+    while True:
+        commit = contents.find(b'\n# commit ', start-1)+1
+        if not commit:
+            break
+
+        end = contents.find(b'\n', commit)
+        if end < 0:
+            break
+
+        try:
+            count, checksum = contents[commit:end].split(b' ')[2:4]
+            count, checksum = int(count), int(checksum, 16)
+        except ValueError:
+            break
+
+        group = contents[start:commit]
+        if (b'\n'+group).count(b'\n- ') != count or _journal_checksum(group) != checksum:
+            break
+
+        start = end+1
+        committed = start
+
+    return committed
+
+def _read_journal(contents):
+    records = yaml.load(contents, Loader=Loader)
+    if records is None:
+        return []
 
-        if not os.path.exists(CONFIG['path']):
-            os.mkdir(CONFIG['path'])
+    return records
+
+class YamlBackend(object):
+    # Keeps the ledger in current_month.yaml. In journal mode changes are
+    # appended to current_month.journal and only folded back into the
+    # snapshot once the journal grows past its limits.
+    #
+    # Loads hold a shared lock on rsbm.lock and saves an exclusive one. A
+    # save first checks that the files are still at the version this
+    # process loaded, and raises StaleVersion if another process got there
+    # first.
+    def __init__(self, path=None):
+        if path is None:
+            path = CONFIG['path']
+
+        self.path = path
+        self._snapshot_path = path+'current_month.yaml'
+        self._journal_path = path+'current_month.journal'
+        self._cache_path = path+'current_month.cache'
+        self._lock_path = path+'rsbm.lock'
+
+        self._generation = 0
+        self._journal_entries = 0
+        self._journal_bytes = 0
+        self._journal_current = False
+        # Whether the journal is of an older format, see JOURNAL_FORMAT
+        self._journal_legacy = False
+        self._version = None
+
+    def exists(self):
+        return os.path.exists(self._snapshot_path)
+
+    def _disk_version(self):
+        # The snapshot's generation and, if it belongs to that snapshot, how
+        # far the journal has grown. Every save changes one or the other.
+        generation = _read_generation(_read_first_line(self._snapshot_path) or b'')
+
+        journal_size = 0
+        journal_line = _read_first_line(self._journal_path)
+        if journal_line is not None and _read_generation(journal_line) == generation:
+            journal_size = os.path.getsize(self._journal_path)
+
+        return (generation, journal_size)
+
+    def _check_version(self):
+        if self._disk_version() != self._version:
+            raise StaleVersion("%s was saved by another process" % self._snapshot_path)
+
+    def version(self):
+        # Changes with every save and can be told without loading anything,
+        # see rsbm_report_cache. None while there's no ledger yet.
+        with file_lock(self._lock_path, create=False):
+            try:
+                stat = os.stat(self._snapshot_path)
+            except OSError:
+                return None
+
+            return ('yaml',)+self._disk_version()+(stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def load(self, read_only=False):
+        # Read-only loads write nothing at all: no directory, save file, lock
+        # file or cache gets created, and a ledger that doesn't exist yet
+        # reads as an empty one
+        if read_only:
+            if not os.path.exists(self._snapshot_path):
+                self._version = self._disk_version()
+                return empty_ledger()
+
+            with file_lock(self._lock_path, create=False):
+                return self._load(read_only)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
 
         # Create our save file
-        if not os.path.exists(CONFIG['path']+'current_month.yaml'):
-            save_file = open(CONFIG['path']+'current_month.yaml', 'w')
-            save_file.write(yaml.dump(init_data))
-            save_file.close()
+        if not os.path.exists(self._snapshot_path):
+            with file_lock(self._lock_path, exclusive=True):
+                if not os.path.exists(self._snapshot_path):
+                    atomic_write(self._snapshot_path, _snapshot_contents(empty_ledger(), 0))
+
+        with file_lock(self._lock_path):
+            return self._load()
+
+    def _load(self, read_only=False):
+        start_time = time.time()
+
+        with open(self._snapshot_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+
+            # Read-only loads map the snapshot rather than copy it in, which
+            # on a cache hit means it's only ever hashed
+            if read_only and stat.st_size:
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                contents = f.read()
+
+        try:
+            cache_key = _cache_key(stat, contents)
+            rsbm_profile.count('bytes_read', len(contents))
+
+            data = None
+            source = 'yaml'
+            if CONFIG['load_cache']:
+                data = self._read_cache(cache_key)
+                if data is not None:
+                    source = 'cache'
+
+            if data is None:
+                data = yaml.load(contents, Loader=Loader)
+                if CONFIG['load_cache'] and not read_only:
+                    self._write_cache(cache_key, data)
+
+            self._generation = _read_generation(contents[:128])
+        finally:
+            if isinstance(contents, mmap.mmap):
+                contents.close()
+
+        self._journal_entries = 0
+        self._journal_bytes = 0
+        self._journal_current = False
+        self._journal_legacy = False
+        self._replay_journal(data, read_only)
+        self._version = self._disk_version()
+
+        count_load(source, time.time()-start_time)
+
+        return data
+
+    def _read_cache(self, cache_key):
+        # The cache holds the parsed snapshot, keyed by the snapshot's mtime,
+        # size and hash. Anything off and we just parse the YAML again.
+        try:
+            with open(self._cache_path, 'rb') as f:
+                if pickle.load(f) != cache_key:
+                    return None
+
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _write_cache(self, cache_key, data):
+        contents = pickle.dumps(cache_key, pickle.HIGHEST_PROTOCOL)+pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        try:
+            atomic_write(self._cache_path, contents, mode='wb')
+        except (IOError, OSError):
+            pass
+
+    def _replay_journal(self, data, read_only=False):
+        if not os.path.exists(self._journal_path):
+            return
+
+        with open(self._journal_path, 'rb') as f:
+            contents = f.read()
+
+        # A journal left over from before the last compaction has already
+        # been folded into the snapshot
+        if _read_generation(contents) != self._generation:
+            return
+
+        self._journal_current = True
+
+        # Drop the tail of an append that never finished (or, for a reader,
+        # is still being written), so the next append starts after the last
+        # whole save
+        if _journal_format(contents) < JOURNAL_FORMAT:
+            self._journal_legacy = True
+            committed = contents.rfind(b'\n')+1
+        else:
+            committed = _committed_journal(contents)
+
+        if committed < len(contents):
+            contents = contents[:committed]
+            if not read_only:
+                with open(self._journal_path, 'r+') as f:
+                    f.truncate(len(contents))
+
+        self._journal_bytes = len(contents)
+
+        for record in _read_journal(contents):
+            apply_record(data, record)
+            self._journal_entries += 1
+
+    def _append_journal(self, records):
+        if not self._journal_current:
+            atomic_write(self._journal_path, _journal_header(self._generation))
+            self._journal_current = True
+
+        contents = _journal_group(records)
+        with open(self._journal_path, 'a') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        rsbm_profile.count('bytes_written', len(contents))
+
+        self._journal_entries += len(records)
+        self._journal_bytes += len(contents)
+
+    def _journal_full(self):
+        return (self._journal_entries >= CONFIG['journal_max_entries']
+                or self._journal_bytes >= CONFIG['journal_max_bytes'])
+
+    def compact(self, data):
+        with file_lock(self._lock_path, exclusive=True):
+            self._check_version()
+            self._compact(data)
+            self._version = self._disk_version()
+
+    def _compact(self, data):
+        # Folds the journal into a fresh snapshot. The snapshot goes first so
+        # a crash in between only leaves behind a journal of an older
+        # generation, which gets ignored on load.
+        self._generation += 1
+        contents = _snapshot_contents(data, self._generation)
+        atomic_write(self._snapshot_path, contents)
+
+        # Refresh the cache right away so the next load doesn't parse
+        if CONFIG['load_cache']:
+            self._write_cache(_cache_key(os.stat(self._snapshot_path), to_bytes(contents)), data)
+
+        if CONFIG['storage_mode'] == 'journal':
+            atomic_write(self._journal_path, _journal_header(self._generation))
+            self._journal_current = True
+        elif os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+            self._journal_current = False
+
+        self._journal_entries = 0
+        self._journal_bytes = 0
+        self._journal_legacy = False
+
+    def commit(self, data, records):
+        with file_lock(self._lock_path, exclusive=True):
+            self._check_version()
+
+            if CONFIG['storage_mode'] != 'journal' or self._journal_legacy:
+                self._compact(data)
+            else:
+                if records:
+                    self._append_journal(records)
+
+                if self._journal_full():
+                    self._compact(data)
+
+            self._version = self._disk_version()
+
+    # The whole ledger is in memory anyway, let StorageManager add it up
+    def summary(self):
+        return None
+
+    def budget_totals(self):
+        return None
+
+def open_backend(path=None):
+    if CONFIG['storage_backend'] == 'sqlite':
+        import rsbm_sqlite_storage
+        return rsbm_sqlite_storage.SqliteBackend(path)
+    elif CONFIG['storage_backend'] == 'sections':
+        import rsbm_section_storage
+        return rsbm_section_storage.SectionBackend(path)
+
+    return YamlBackend(path)
+
+class StorageManager():
+    def __init__(self, backend=None, read_only=False):
+        if backend is None:
+            backend = open_backend()
+
+        self._backend = backend
+
+        # Read-only ledgers are loaded without any write-side setup, and
+        # refuse changes
+        self.read_only = read_only
+
+        # While saves are held (see begin()), save() only notes that one was
+        # asked for
+        self._held = 0
+        self._save_requested = False
+
+        # One per begin() not yet committed or rolled back, see begin()
+        self._savepoints = []
+
+        self._load()
+
+    def _load(self):
+        with rsbm_profile.phase('load'):
+            self._load_data()
+
+    def _load_data(self):
+        self.data = self._backend.load(self.read_only)
+
+        # Maps every list to a {name: [positions]} index so lookups by name
+        # don't have to scan the whole list. When several items share a name
+        # the last one wins, same as the old linear scan did.
+        self._index = {}
+
+        # Totals are only computed when a report first asks for them
+        self._summary = None
+        self._budget_groups = None
+        self._date_index = None
+
+        # Mutations since the last save, handed to the backend on save()
+        self._pending = []
+
+        # Run once they're saved, see after_save()
+        self._after_save = []
+
+        # Run if they're thrown away instead, see on_rollback()
+        self._on_rollback = []
 
-        with open(CONFIG['path']+'current_month.yaml', 'rb') as f:
-            self.data = yaml.safe_load(f.read())
+        # Lists of a lazily loaded ledger are set up as they're read in,
+        # everything else right away
+        if isinstance(self.data, LazyLedger):
+            self.data.on_load = self._list_loaded
+        else:
+            for list_name in list(self.data.keys()):
+                self._list_loaded(list_name)
+                self._build_index(list_name)
+
+    def _list_loaded(self, list_name):
+        if list_name != 'expenses':
+            return
+
+        # Expenses are by far the longest list, keep them in columns
+        if not isinstance(self.data['expenses'], rsbm_columns.ExpenseColumns):
+            self.data['expenses'] = rsbm_columns.ExpenseColumns(self.data['expenses'])
+
+        self._backfill_dates()
+
+    @property
+    def path(self):
+        # The directory this ledger lives in
+        return self._backend.path
+
+    # -------------
+
+    def _build_index(self, list_name):
+        rsbm_profile.count('items_indexed', len(self.data[list_name]))
+
+        if list_name == 'expenses':
+            self._index[list_name] = self.data[list_name].name_positions()
+            return
+
+        index = {}
+        position = 0
+        for item in self.data[list_name]:
+            index.setdefault(item['name'], []).append(position)
+            position += 1
+
+        self._index[list_name] = index
+
+    def _list_index(self, list_name):
+        if list_name not in self._index:
+            self._build_index(list_name)
+
+        return self._index[list_name]
+
+    def _build_budget_groups(self):
+        # The backend can add up what has been saved, leaving only the
+        # positions to find here
+        totals = None
+        if not self._pending:
+            totals = self._backend.budget_totals()
+
+        with rsbm_profile.phase('compute'):
+            rsbm_profile.count('items_scanned', len(self.data['expenses']))
+
+            if totals is None:
+                # One pass over the expense columns gives totals and positions
+                # alike
+                groups = self.data['expenses'].budget_groups()
+            else:
+                positions = self.data['expenses'].budget_positions()
+                groups = {}
+                for budget_name, (cents, count) in totals.items():
+                    groups[budget_name] = {'cents': cents, 'count': count, 'positions': positions.get(budget_name, [])}
+
+            for group in groups.values():
+                group['spent'] = group['cents']/100.0
+
+        self._budget_groups = groups
+
+    def _index_remove(self, list_name, name, position):
+        index = self._list_index(list_name)
+        positions = index[name]
+        _remove_position(positions, position)
+        if not positions:
+            del index[name]
+
+    def _index_insert(self, list_name, name, position):
+        positions = self._list_index(list_name).setdefault(name, [])
+        bisect.insort(positions, position)
+
+    def _group_add(self, groups, expense, position):
+        group = groups.get(expense['budget'])
+        if group is None:
+            group = {'cents': 0, 'spent': 0.00, 'count': 0, 'positions': []}
+            groups[expense['budget']] = group
+
+        group['cents'] += rsbm_calculator.to_cents(expense['price'])
+        group['spent'] = group['cents']/100.0
+        group['count'] += 1
+        bisect.insort(group['positions'], position)
+
+    def _group_remove(self, groups, expense, position):
+        group = groups[expense['budget']]
+        group['cents'] -= rsbm_calculator.to_cents(expense['price'])
+        group['spent'] = group['cents']/100.0
+        group['count'] -= 1
+        _remove_position(group['positions'], position)
+
+        if not group['count']:
+            del groups[expense['budget']]
+
+    def _backfill_dates(self):
+        # Expenses recorded before they had dates are taken to be from the
+        # start of this month. Saved along with the next change.
+        if not self.data['expenses'].undated():
+            return
+
+        first_of_month = datetime.date.today().replace(day=1).isoformat()
+        if not self.read_only:
+            self._record({'op': 'fill', 'list': 'expenses', 'field': 'date', 'value': first_of_month})
+        self.data['expenses'].fill_dates(first_of_month)
+
+    def _date_remove(self, date, position):
+        index = self._date_index
+        del index[bisect.bisect_left(index, (date, position))]
+
+    @property
+    def date_index(self):
+        # [(date, position)] of all dated expenses, sorted by date
+        if self._date_index is None:
+            with rsbm_profile.phase('compute'):
+                self._date_index = self.data['expenses'].date_index()
+
+        return self._date_index
+
+    def expenses_between(self, first=None, last=None):
+        # Positions of the expenses dated first..last (YYYY-MM-DD, both
+        # included, either can be left open), oldest first. Found by
+        # bisecting the date index.
+        index = self.date_index
+
+        start = 0
+        if first is not None:
+            start = bisect.bisect_left(index, (first, -1))
+
+        end = len(index)
+        if last is not None:
+            end = bisect.bisect_right(index, (last, len(self.data['expenses'])))
+
+        rsbm_profile.count('items_scanned', end-start)
+
+        return [position for date, position in index[start:end]]
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            # The backend can only answer for what has been saved
+            if not self._pending:
+                self._summary = self._backend.summary()
+            if self._summary is None:
+                with rsbm_profile.phase('compute'):
+                    self._summary = rsbm_calculator.LedgerSummary(self.data)
+
+        return self._summary
+
+    @property
+    def budget_groups(self):
+        # {budget: {'cents': total, 'spent': total, 'count': expenses,
+        # 'positions': [...]}}
+        if self._budget_groups is None:
+            self._build_budget_groups()
+
+        return self._budget_groups
+
+    def budget_group(self, budget_name):
+        group = self.budget_groups.get(budget_name)
+        if group is None:
+            return {'cents': 0, 'spent': 0.00, 'count': 0, 'positions': []}
+
+        return group
+
+    def find(self, list_name, name):
+        rsbm_profile.count('lookups')
+        positions = self._list_index(list_name).get(name)
+        if not positions:
+            return None
+
+        return positions[-1]
+
+    def find_all(self, list_name, name):
+        rsbm_profile.count('lookups')
+        return list(self._list_index(list_name).get(name, []))
+
+    def names(self, list_name):
+        # Every name in a list, once each
+        return list(self._list_index(list_name).keys())
+
+    def add_item(self, list_name, item):
+        # The list is read in (if it hadn't been) before anything is recorded
+        items = self.data[list_name]
+        self._record({'op': 'add', 'list': list_name, 'item': item})
+
+        position = len(items)
+        items.append(item)
+        self._index_insert(list_name, item['name'], position)
+
+        if self._summary is not None:
+            self._summary.add(list_name, item)
+        if list_name == 'expenses' and self._budget_groups is not None:
+            self._group_add(self._budget_groups, item, position)
+        if list_name == 'expenses' and self._date_index is not None and 'date' in item:
+            bisect.insort(self._date_index, (item['date'], position))
+
+        return position
+
+    def replace_item(self, list_name, position, item):
+        # Setting an item to what it already is changes nothing
+        old_item = self.data[list_name][position]
+        if old_item == item:
+            return
+
+        self._record({'op': 'set', 'list': list_name, 'position': position, 'item': item})
+
+        self.data[list_name][position] = item
+
+        if old_item['name'] != item['name']:
+            self._index_remove(list_name, old_item['name'], position)
+            self._index_insert(list_name, item['name'], position)
+
+        if self._summary is not None:
+            self._summary.replace(list_name, old_item, item)
+        if list_name == 'expenses' and self._budget_groups is not None:
+            self._group_remove(self._budget_groups, old_item, position)
+            self._group_add(self._budget_groups, item, position)
+        if list_name == 'expenses' and self._date_index is not None:
+            if 'date' in old_item:
+                self._date_remove(old_item['date'], position)
+            if 'date' in item:
+                bisect.insort(self._date_index, (item['date'], position))
+
+    def delete_item(self, list_name, position):
+        items = self.data[list_name]
+        self._record({'op': 'del', 'list': list_name, 'position': position})
+
+        self._index_remove(list_name, items[position]['name'], position)
+
+        if self._summary is not None:
+            self._summary.remove(list_name, items[position])
+
+        groups = None
+        if list_name == 'expenses' and self._budget_groups is not None:
+            groups = self._budget_groups
+            self._group_remove(groups, items[position], position)
+
+        if list_name == 'expenses' and self._date_index is not None:
+            if 'date' in items[position]:
+                self._date_remove(items[position]['date'], position)
+
+            # Shifting keeps the order, every later position moves by one
+            self._date_index = [(date, later-1 if later > position else later) for date, later in self._date_index]
+
+        del items[position]
+
+        # Everything after the deleted item moved up by one
+        index = self._list_index(list_name)
+        for new_position in range(position, len(items)):
+            item = items[new_position]
+            _shift_position(index[item['name']], new_position+1)
+            if groups is not None:
+                _shift_position(groups[item['budget']]['positions'], new_position+1)
+
+    def clear_list(self, list_name):
+        if not len(self.data[list_name]):
+            return
+
+        self._record({'op': 'clear', 'list': list_name})
+
+        if list_name == 'expenses':
+            self.data[list_name] = rsbm_columns.ExpenseColumns()
+        else:
+            self.data[list_name] = []
+        self._index[list_name] = {}
+
+        # Cheaper to rebuild on demand than to subtract every item
+        self._summary = None
+        if list_name == 'expenses':
+            self._budget_groups = None
+            self._date_index = None
+
+    # -------------
+
+    def _record(self, record):
+        if self.read_only:
+            raise Exception("This ledger was opened read-only.")
+
+        # Savepoints keep the list as it was before their first change to
+        # it. Those that don't have it yet all had it the way it is now, so
+        # they share one copy.
+        copied = None
+        for savepoint in self._savepoints:
+            if savepoint['lists'] is None or record['list'] in savepoint['lists']:
+                continue
+
+            if copied is None:
+                copied = _copy_list(self.data[record['list']])
+            savepoint['lists'][record['list']] = copied
+
+        self._pending.append(record)
+
+    def compact(self):
+        self._backend.compact(self.data)
+
+    @property
+    def dirty(self):
+        return bool(self._pending)
+
+    @property
+    def changes(self):
+        # How many mutations are waiting to be saved
+        return len(self._pending)
+
+    def footprint(self):
+        # Rough bytes of memory this ledger takes up, for LedgerPool
+        list_names = self.data.keys()
+        if isinstance(self.data, LazyLedger):
+            # Lists that haven't been read in take up no memory
+            list_names = self.data.loaded_keys()
+
+        size = 0
+        for list_name in list_names:
+            if list_name == 'expenses':
+                size += self.data[list_name].footprint()
+            else:
+                size += ITEM_BYTES*len(self.data[list_name])
+
+        return size
+
+    def flush(self):
+        # Saves right away, even while saves are held
+        if not self._pending and not self._after_save:
+            return
+
+        held = self._held
+        self._held = 0
+        try:
+            self.save()
+        finally:
+            self._held = held
 
     def save(self):
-        with open(CONFIG['path']+'current_month.yaml', 'w') as f:
-            return f.write(yaml.dump(self.data))
+        # Nothing changed, nothing to write
+        if not self._pending and not self._after_save:
+            return
+
+        if self._held:
+            self._save_requested = True
+            return
+
+        self._save_requested = False
+
+        if self._pending:
+            with rsbm_profile.phase('save'):
+                rsbm_profile.count('records_saved', len(self._pending))
+                self._backend.commit(self.data, self._pending)
+            self._pending = []
+            self._on_rollback = []
+
+            # What's saved can't be rolled back any more, open savepoints
+            # now start from here
+            for savepoint in self._savepoints:
+                savepoint['pending'] = 0
+                savepoint['after_save'] = 0
+                savepoint['on_rollback'] = 0
+                if savepoint['lists'] is not None:
+                    savepoint['lists'] = {}
+
+        callbacks = self._after_save
+        self._after_save = []
+        for callback in callbacks:
+            callback()
+
+    def after_save(self, callback):
+        # Calls callback() once everything changed so far has been saved,
+        # for writes outside the ledger that must only happen if the
+        # ledger's do: not while saves are held, not if the save turns out
+        # stale, and never if it's all rolled back
+        self._after_save.append(callback)
+
+    def on_rollback(self, callback):
+        # Calls callback() if everything changed so far is rolled back
+        # before it's saved, to undo writes outside the ledger that had to
+        # happen before the ledger's
+        self._on_rollback.append(callback)
+
+    def _undo_outside(self, count=0):
+        # Runs the on_rollback() callbacks past the first count, last first
+        callbacks = self._on_rollback[count:]
+        del self._on_rollback[count:]
+        for callback in reversed(callbacks):
+            callback()
+
+    # Saves between begin() and commit() are held back and written as one,
+    # which is how batches and the server group their writes. begin() can
+    # be nested; rollback() goes back to where the innermost one was.
+
+    def begin(self):
+        # A savepoint: how much was pending, and a copy of each list as it
+        # was, made when the list is first changed (see _record()). The
+        # outermost one, begun with nothing unsaved, goes back to the saved
+        # ledger instead, so it never copies anything.
+        savepoint = {
+            'pending': len(self._pending),
+            'after_save': len(self._after_save),
+            'on_rollback': len(self._on_rollback),
+            'save_requested': self._save_requested,
+            'lists': {},
+        }
+        if not self._savepoints and not self._pending:
+            savepoint['lists'] = None
+
+        self._savepoints.append(savepoint)
+        self._held += 1
+
+    def commit(self):
+        self._savepoints.pop()
+        self._held -= 1
+
+        if not self._held and self._save_requested:
+            self.save()
+
+    def rollback(self):
+        # Throws away everything since the innermost begin(), or since the
+        # last save when nothing is held
+        if not self._savepoints or self._savepoints[-1]['lists'] is None:
+            self._undo_outside()
+            self._savepoints = []
+            self._held = 0
+            self._save_requested = False
+            self._load()
+            return
+
+        savepoint = self._savepoints.pop()
+        self._held -= 1
+        self._undo_outside(savepoint['on_rollback'])
+
+        for list_name, items in savepoint['lists'].items():
+            self.data[list_name] = items
+            self._index.pop(list_name, None)
+
+            # Savepoints further out that shared the copy had the list the
+            # same way, and copy it again when it's next changed
+            for outer in self._savepoints:
+                if outer['lists'] is not None and outer['lists'].get(list_name) is items:
+                    del outer['lists'][list_name]
+
+        if savepoint['lists']:
+            self._summary = None
+            self._budget_groups = None
+            self._date_index = None
+
+        del self._pending[savepoint['pending']:]
+        del self._after_save[savepoint['after_save']:]
+        self._save_requested = savepoint['save_requested']
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+
+        self.commit()
 
     def debug(self):
-        print self.data
+        print(self.data)
+
+# -------------
+
+# Separate ledgers, for running rsbm for many households at once. Each
+# ledger id gets a directory of its own under CONFIG['ledgers_path']; no
+# ledger id is the usual one at CONFIG['path'].
+
+def ledger_path(ledger_id=None):
+    if ledger_id is None:
+        return CONFIG['path']
+
+    if not re.match(r'^[A-Za-z0-9_-]+$', ledger_id):
+        raise Exception("Ledger ids can only have letters, digits, '-' and '_' in them.")
+
+    return os.path.join(CONFIG['ledgers_path'], ledger_id)+'/'
+
+def open_ledger(ledger_id=None, read_only=False):
+    return StorageManager(open_backend(ledger_path(ledger_id)), read_only)
+
+class LedgerPool(object):
+    # Keeps recently used ledgers loaded, so requests for them don't parse
+    # the ledger from disk again. Past CONFIG['ledger_pool_max_ledgers']
+    # ledgers or CONFIG['ledger_pool_max_bytes'] of (estimated) memory, the
+    # least recently used are saved if they have changes and dropped.
+    def __init__(self, opener=None, max_ledgers=None, max_bytes=None):
+        if opener is None:
+            opener = open_ledger
+        if max_ledgers is None:
+            max_ledgers = CONFIG['ledger_pool_max_ledgers']
+        if max_bytes is None:
+            max_bytes = CONFIG['ledger_pool_max_bytes']
+
+        self._opener = opener
+        self._max_ledgers = max_ledgers
+        self._max_bytes = max_bytes
+
+        # Least recently used first
+        self._ledgers = collections.OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+
+        # Ledgers that mustn't be evicted right now, see pin()
+        self._pins = {}
+
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'flushes': 0,
+            'flush_failures': 0,
+        }
+
+    def __len__(self):
+        return len(self._ledgers)
+
+    def __contains__(self, ledger_id):
+        return ledger_id in self._ledgers
+
+    def get(self, ledger_id=None):
+        storage = self._ledgers.pop(ledger_id, None)
+        if storage is not None:
+            self._stats['hits'] += 1
+        else:
+            self._stats['misses'] += 1
+            storage = self._opener(ledger_id)
+
+        self.add(ledger_id, storage)
+
+        return storage
+
+    def add(self, ledger_id, storage):
+        # (Re)inserts a ledger as the most recently used one
+        self._ledgers.pop(ledger_id, None)
+        self._ledgers[ledger_id] = storage
+
+        # Ledgers grow while they're loaded, so sizes are taken again on use
+        self._bytes -= self._sizes.get(ledger_id, 0)
+        self._sizes[ledger_id] = storage.footprint()
+        self._bytes += self._sizes[ledger_id]
+
+        self._evict()
+
+    def _over_budget(self):
+        return len(self._ledgers) > self._max_ledgers or self._bytes > self._max_bytes
+
+    def _evict(self):
+        # Never the one just used, even if it alone is over the budget
+        for ledger_id in list(self._ledgers.keys())[:-1]:
+            if not self._over_budget():
+                break
+
+            if ledger_id in self._pins:
+                continue
+
+            if self.release(ledger_id):
+                self._stats['evictions'] += 1
+
+    def pin(self, ledger_id):
+        # Keeps a ledger loaded until it's unpinned as often as it was
+        # pinned, for one whose changes are still waiting to be saved
+        self._pins[ledger_id] = self._pins.get(ledger_id, 0)+1
+
+    def unpin(self, ledger_id):
+        self._pins[ledger_id] -= 1
+        if not self._pins[ledger_id]:
+            del self._pins[ledger_id]
+
+    def release(self, ledger_id):
+        # Saves a ledger and drops it from the pool. One that can't be saved
+        # right now stays, returns whether it went.
+        storage = self._ledgers.get(ledger_id)
+        if storage is None:
+            return False
+
+        if storage.dirty:
+            try:
+                storage.flush()
+            except Exception:
+                self._stats['flush_failures'] += 1
+                return False
+            self._stats['flushes'] += 1
+
+        del self._ledgers[ledger_id]
+        self._bytes -= self._sizes.pop(ledger_id)
+
+        return True
+
+    def flush(self):
+        # Saves every loaded ledger that has changes
+        for storage in self._ledgers.values():
+            if storage.dirty:
+                storage.flush()
+                self._stats['flushes'] += 1
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['ledgers'] = len(self._ledgers)
+        stats['bytes'] = self._bytes
+        stats['max_ledgers'] = self._max_ledgers
+        stats['max_bytes'] = self._max_bytes
+
+        lookups = stats['hits']+stats['misses']
+        stats['hit_rate'] = 0.00
+        if lookups:
+            stats['hit_rate'] = float(stats['hits'])/lookups
+
+        return stats
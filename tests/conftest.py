@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# The rsbm modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import CONFIG
+import rsbm_main_interpreter
+
+@pytest.fixture
+def ledger_path(tmp_path, monkeypatch):
+    # A ledger of its own for every test
+    path = str(tmp_path)+'/'
+    monkeypatch.setitem(CONFIG, 'path', path)
+    monkeypatch.setitem(CONFIG, 'ledgers_path', path+'ledgers/')
+    monkeypatch.setitem(CONFIG, 'server_socket', path+'rsbm.sock')
+    return path
+
+@pytest.fixture
+def rsbm(ledger_path):
+    # Runs one command the way rsbm.py does, loading the ledger afresh
+    def run(*words):
+        interpreter = rsbm_main_interpreter.MainInterpreter()
+        return interpreter.interpret(['rsbm']+list(words))
+
+    return run
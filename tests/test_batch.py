@@ -0,0 +1,60 @@
+import json
+
+import yaml
+
+def write_batch(tmp_path, lines):
+    path = tmp_path/'batch.txt'
+    path.write_text(''.join([line+'\n' for line in lines]))
+    return str(path)
+
+def expense_names(rsbm):
+    return [item['name'] for item in yaml.safe_load(rsbm('api', 'list', 'expenses'))]
+
+def test_batch_saves_every_command(rsbm, tmp_path):
+    path = write_batch(tmp_path, ['add expense coffee 3.50 food', 'add expense bread 2 food'])
+
+    result = yaml.safe_load(rsbm('batch', path))
+
+    assert result['ok'] and result['saved']
+    assert [line['ok'] for line in result['results']] == [True, True]
+    assert expense_names(rsbm) == ['coffee', 'bread']
+
+def test_batch_honors_api_format(rsbm, tmp_path):
+    path = write_batch(tmp_path, ['add expense coffee 3.50 food'])
+
+    result = json.loads(rsbm('api', '--format', 'json', 'batch', path))
+
+    assert result['ok']
+    assert result['results'][0]['command'] == 'add expense coffee 3.50 food'
+
+def test_batch_reports_failed_commands(rsbm, tmp_path):
+    path = write_batch(tmp_path, ['add nonsense coffee 3.50'])
+
+    result = yaml.safe_load(rsbm('batch', path))
+
+    assert not result['ok']
+    assert not result['results'][0]['ok']
+
+def test_batch_rejects_interactive_commands(rsbm, tmp_path):
+    path = write_batch(tmp_path, ['shell', 'serve', 'batch'])
+
+    result = yaml.safe_load(rsbm('batch', path))
+
+    assert [line['error'] for line in result['results']] == ["Command not allowed in a batch"]*3
+
+def test_failed_command_keeps_the_others(rsbm, tmp_path):
+    path = write_batch(tmp_path, ['add expense a 1 food', 'import '+str(tmp_path/'missing.csv'), 'add expense b 2 food'])
+
+    result = yaml.safe_load(rsbm('batch', path))
+
+    assert result['saved']
+    assert [line['ok'] for line in result['results']] == [True, False, True]
+    assert expense_names(rsbm) == ['a', 'b']
+
+def test_strict_batch_saves_nothing_after_a_failure(rsbm, tmp_path):
+    path = write_batch(tmp_path, ['add expense a 1 food', 'add nonsense b 2', 'add expense c 3 food'])
+
+    result = yaml.safe_load(rsbm('batch', path, '--strict'))
+
+    assert not result['saved']
+    assert expense_names(rsbm) == []
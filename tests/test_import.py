@@ -0,0 +1,73 @@
+import os
+
+import yaml
+
+def write_statement(tmp_path, rows, name='statement.csv'):
+    path = tmp_path/name
+    path.write_text("Date,Description,Amount\n"+''.join([','.join(row)+'\n' for row in rows]))
+    return str(path)
+
+def expenses(rsbm):
+    return [(item['name'], item['price'], item.get('date')) for item in yaml.safe_load(rsbm('api', 'list', 'expenses'))]
+
+def test_hand_entered_expense_matches_one_line_on_its_date(rsbm, tmp_path):
+    rsbm('add', 'expense', 'coffee', '3.5', 'uncategorized', '--date', '2026-09-02')
+    path = write_statement(tmp_path, [
+        ('2026-09-01', 'COFFEE', '-3.50'),
+        ('2026-09-02', 'COFFEE', '-3.50'),
+        ('2026-09-03', 'COFFEE', '-3.50'),
+    ])
+
+    stats = yaml.safe_load(rsbm('api', 'import', path))
+
+    assert stats == {'expenses': 2, 'income': 0, 'duplicates': 1}
+    assert sorted([date for name, price, date in expenses(rsbm)]) == ['2026-09-01', '2026-09-02', '2026-09-03']
+
+def test_same_charge_in_another_month_is_imported(rsbm, tmp_path):
+    rsbm('api', 'import', write_statement(tmp_path, [('2026-09-05', 'NETFLIX', '-9.99')], 'september.csv'))
+
+    stats = yaml.safe_load(rsbm('api', 'import', write_statement(tmp_path, [('2026-10-05', 'NETFLIX', '-9.99')], 'october.csv')))
+
+    assert stats['expenses'] == 1
+    assert len(expenses(rsbm)) == 2
+
+def test_importing_a_statement_again_skips_all_of_it(rsbm, tmp_path):
+    path = write_statement(tmp_path, [
+        ('2026-09-01', 'COFFEE', '-3.50'),
+        ('2026-09-01', 'COFFEE', '-3.50'),
+        ('2026-09-02', 'SALARY', '2000.00'),
+    ])
+    rsbm('api', 'import', path)
+
+    stats = yaml.safe_load(rsbm('api', 'import', path))
+
+    assert stats == {'expenses': 0, 'income': 0, 'duplicates': 3}
+
+def test_overlapping_statement_imports_only_the_new_lines(rsbm, tmp_path):
+    rsbm('api', 'import', write_statement(tmp_path, [('2026-09-01', 'COFFEE', '-3.50')], 'first.csv'))
+
+    stats = yaml.safe_load(rsbm('api', 'import', write_statement(tmp_path, [
+        ('2026-09-01', 'COFFEE', '-3.50'),
+        ('2026-09-01', 'COFFEE', '-3.50'),
+    ], 'second.csv')))
+
+    assert stats == {'expenses': 1, 'income': 0, 'duplicates': 1}
+
+def test_failed_import_adds_nothing_and_remembers_nothing(rsbm, ledger_path, tmp_path):
+    bad = write_statement(tmp_path, [('2026-09-01', 'COFFEE', '-3.50'), ('2026-09-02', 'BAKERY', 'oops')], 'bad.csv')
+
+    try:
+        rsbm('api', 'import', bad)
+    except ValueError:
+        pass
+
+    assert expenses(rsbm) == []
+    assert not os.path.exists(ledger_path+'import_fingerprints')
+
+    stats = yaml.safe_load(rsbm('api', 'import', write_statement(tmp_path, [('2026-09-01', 'COFFEE', '-3.50')], 'good.csv')))
+    assert stats['expenses'] == 1
+
+def test_rules_option_needs_a_file(rsbm, tmp_path):
+    path = write_statement(tmp_path, [('2026-09-01', 'COFFEE', '-3.50')])
+
+    assert rsbm('import', path, '--rules').startswith("Usage: import")
@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+
+import rsbm_backup
+import rsbm_history
+import rsbm_main_interpreter
+import rsbm_storage
+
+MONTH = datetime.date.today().strftime("%Y-%m")
+
+def expense_names(data):
+    return [item['name'] for item in data['expenses']]
+
+def test_next_month_backs_up_and_clears(rsbm, ledger_path):
+    rsbm('add', 'expense', 'coffee', '3.5', 'food')
+    rsbm('add', 'income', 'salary', '2000', '25')
+    rsbm('check', 'income', 'salary')
+
+    assert rsbm('next_month').startswith("All relevant data has been cleared")
+
+    assert expense_names(rsbm_backup.restore_month(ledger_path, MONTH)) == ['coffee']
+    assert rsbm_history.find_month(ledger_path, MONTH)['spent'] == 3.5
+
+    ledger = rsbm_storage.StorageManager()
+    assert expense_names(ledger.data) == []
+    assert [item['paid'] for item in ledger.data['income']] == [False]
+
+def test_next_month_runs_once_a_month(rsbm):
+    rsbm('add', 'expense', 'coffee', '3.5', 'food')
+    rsbm('next_month')
+
+    assert rsbm('next_month').startswith("A backup of this month has already been made")
+
+def test_failed_backup_leaves_the_month_alone(rsbm, ledger_path):
+    rsbm('add', 'expense', 'coffee', '3.5', 'food')
+    # Nothing can be stored under backups/ when it's a file
+    open(ledger_path+'backups', 'w').close()
+
+    with pytest.raises(EnvironmentError):
+        rsbm('next_month')
+
+    assert expense_names(rsbm_storage.StorageManager().data) == ['coffee']
+    assert rsbm_history.find_month(ledger_path, MONTH) is None
+
+def test_stale_next_month_backs_up_the_fresh_ledger(rsbm, ledger_path):
+    rsbm('add', 'expense', 'coffee', '3.5', 'food')
+    storage = rsbm_storage.StorageManager()
+
+    # Another process saves after this one loaded
+    rsbm('add', 'expense', 'bread', '2', 'food')
+
+    output = rsbm_main_interpreter.MainInterpreter(storage).interpret(['rsbm', 'next_month'])
+
+    assert output.startswith("All relevant data has been cleared")
+    assert expense_names(rsbm_backup.restore_month(ledger_path, MONTH)) == ['coffee', 'bread']
+    assert expense_names(rsbm_storage.StorageManager().data) == []
+
+def test_rolled_back_next_month_removes_its_backup(rsbm, ledger_path):
+    rsbm('add', 'expense', 'coffee', '3.5', 'food')
+    storage = rsbm_storage.StorageManager()
+
+    # Held, the way the shell and server run commands
+    storage.begin()
+    rsbm_main_interpreter.MainInterpreter(storage).interpret(['rsbm', 'next_month'])
+    assert rsbm_backup.has_month(ledger_path, MONTH)
+
+    storage.rollback()
+
+    assert not rsbm_backup.has_month(ledger_path, MONTH)
+    assert expense_names(storage.data) == ['coffee']
+    assert expense_names(rsbm_storage.StorageManager().data) == ['coffee']
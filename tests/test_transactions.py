@@ -0,0 +1,113 @@
+import pytest
+
+import rsbm_storage
+
+def expense(name, price=1.0):
+    return {'name': name, 'price': price, 'budget': 'food', 'date': '2026-10-01'}
+
+def names(storage, list_name='expenses'):
+    return [item['name'] for item in storage.data[list_name]]
+
+def saved_names(list_name='expenses'):
+    return names(rsbm_storage.StorageManager(), list_name)
+
+def test_transaction_saves_once_at_the_end(ledger_path):
+    storage = rsbm_storage.StorageManager()
+
+    with storage.transaction():
+        storage.add_item('expenses', expense('a'))
+        storage.save()
+        assert saved_names() == []
+
+    assert saved_names() == ['a']
+
+def test_inner_rollback_keeps_the_outer_changes(ledger_path):
+    storage = rsbm_storage.StorageManager()
+    storage.begin()
+    storage.add_item('expenses', expense('a'))
+
+    with pytest.raises(ValueError):
+        with storage.transaction():
+            storage.add_item('expenses', expense('b'))
+            storage.add_item('budgets', {'name': 'food', 'price': 100.0})
+            raise ValueError()
+
+    assert names(storage) == ['a']
+    assert names(storage, 'budgets') == []
+    assert storage.find('expenses', 'b') is None
+    assert storage.summary.spent == 1.0
+    assert storage.budget_group('food')['count'] == 1
+
+    storage.add_item('expenses', expense('c'))
+    storage.save()
+    storage.commit()
+
+    assert saved_names() == ['a', 'c']
+
+def test_rollback_of_nested_savepoints_goes_back_one_at_a_time(ledger_path):
+    storage = rsbm_storage.StorageManager()
+    storage.begin()
+    storage.add_item('expenses', expense('a'))
+    storage.begin()
+    storage.add_item('expenses', expense('b'))
+    storage.begin()
+    storage.delete_item('expenses', 0)
+
+    storage.rollback()
+    assert names(storage) == ['a', 'b']
+
+    storage.rollback()
+    assert names(storage) == ['a']
+
+    storage.rollback()
+    assert names(storage) == []
+
+def test_outermost_rollback_goes_back_to_what_is_saved(ledger_path):
+    storage = rsbm_storage.StorageManager()
+    storage.add_item('expenses', expense('a'))
+    storage.save()
+
+    storage.begin()
+    storage.add_item('expenses', expense('b'))
+    storage.rollback()
+
+    assert names(storage) == ['a']
+    assert not storage.dirty
+
+def test_hooks_follow_the_changes_they_belong_to(ledger_path):
+    storage = rsbm_storage.StorageManager()
+    calls = []
+
+    storage.begin()
+    storage.add_item('expenses', expense('a'))
+    storage.after_save(lambda: calls.append('saved a'))
+    storage.on_rollback(lambda: calls.append('undo a'))
+
+    storage.begin()
+    storage.add_item('expenses', expense('b'))
+    storage.after_save(lambda: calls.append('saved b'))
+    storage.on_rollback(lambda: calls.append('undo b'))
+    storage.rollback()
+
+    assert calls == ['undo b']
+
+    storage.save()
+    storage.commit()
+
+    assert calls == ['undo b', 'saved a']
+
+    storage.rollback()
+    assert calls == ['undo b', 'saved a']
+
+def test_stale_save_is_refused(ledger_path):
+    storage = rsbm_storage.StorageManager()
+    other = rsbm_storage.StorageManager()
+
+    other.add_item('expenses', expense('a'))
+    other.save()
+
+    storage.add_item('expenses', expense('b'))
+    with pytest.raises(rsbm_storage.StaleVersion):
+        storage.save()
+
+    assert saved_names() == ['a']